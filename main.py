@@ -1,11 +1,22 @@
 #!/usr/bin/env python
 
+"""Runs moggio as a UCI engine, or one of:
+
+   main.py perftsuite [depth]     - the perft test suite
+   main.py benchmark [options]    - the benchmarks of moggio.benchmark (see --help)
+   main.py profile [depth]        - the perft test suite under cProfile
+   main.py pgn <file> [n]         - games/second and plies/second of replaying a PGN file
+"""
+
+import sys
+
 try:
     import psyco
     psyco.full()
-    print "Psyco loaded!"
+    # stdout belongs to the UCI protocol.
+    print >>sys.stderr, "Psyco loaded!"
 except ImportError:
-    print "Psyco not installed."
+    print >>sys.stderr, "Psyco not installed."
     pass
 
 import moggio.defines as defs
@@ -13,10 +24,29 @@ import moggio.cache
 import moggio.state
 import moggio.test
 import moggio.move
+import moggio.uci
+import moggio.benchmark
+import moggio.pgn
+
+if sys.argv[1:2] == ['perftsuite']:
+    moggio.cache.preprocess()
+    moggio.test.perftsuite(int(sys.argv[2]) if sys.argv[2:] else 3)
+elif sys.argv[1:2] == ['benchmark']:
+    sys.exit(moggio.benchmark.main(sys.argv[2:]))
+elif sys.argv[1:2] == ['pgn'] and sys.argv[2:]:
+    moggio.cache.preprocess()
+    moggio.pgn.benchmark(sys.argv[2], int(sys.argv[3]) if sys.argv[3:] else 1)
+elif sys.argv[1:2] == ['profile']:
+    import cProfile, pstats
+    moggio.cache.preprocess()
+    prof = cProfile.Profile()
+    prof.run('moggio.test.perftsuite(%d)' % (int(sys.argv[2]) if sys.argv[2:] else 2))
 
-moggio.cache.preprocess()
-
-moggio.test.perftsuite(3)
+    stats = pstats.Stats(prof)
+    stats.sort_stats("time")
+    stats.print_stats(80)
+else:
+    moggio.uci.main()
 
 if False:
     position = moggio.state.State('8/8/8/8/PK6/8/1k6/8 b - a3 0 1')
@@ -25,12 +55,3 @@ if False:
 
     print position
     print moggio.test.divide(position, 2)
-
-if False:
-    import cProfile, pstats
-    prof = cProfile.Profile()
-    prof.run('moggio.test.perftsuite(2)')
-
-    stats = pstats.Stats(prof)
-    stats.sort_stats("time")
-    stats.print_stats(80)
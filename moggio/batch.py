@@ -0,0 +1,194 @@
+"""Computing attacks, mobility and material for many positions at once, with NumPy.
+
+   This module requires NumPy, which the rest of moggio doesn't. A Batch holds the
+   bitboards of N positions as uint64 arrays, laid out like State.pieces, and every
+   computation is done on all N positions by the same array operation. Knight, king and
+   pawn attacks are shifts of the piece bitboards, and slider attacks are gathered from the
+   magic bitboard tables of moggio.cache, one square at a time.
+"""
+
+import numpy
+
+import moggio.cache as cache
+import moggio.defines as defs
+import moggio.evaluate
+
+_U64 = numpy.uint64
+
+def _u64(n):
+    """NumPy turns large Python ints into floats when mixed with uint64 arrays; this doesn't."""
+    return _U64(n & cache.MASK_64)
+
+_FILE_A = 0x0101010101010101
+_FILE_H = _FILE_A << 7
+_NOT_A = _u64(~_FILE_A)
+_NOT_H = _u64(~_FILE_H)
+_NOT_AB = _u64(~(_FILE_A | _FILE_A << 1))
+_NOT_GH = _u64(~(_FILE_H | _FILE_H >> 1))
+
+_SHIFTS = [_U64(n) for n in xrange(64)]
+_BITS = [_u64(1 << n) for n in xrange(64)]
+
+# (shift, left, mask) of every leaper step: the targets of a step are
+# (bitboard << shift) & mask if left is set, and (bitboard >> shift) & mask otherwise. The
+# mask removes the targets that wrapped around to the other side of the board.
+_KNIGHT_STEPS = (
+    (_SHIFTS[17], True, _NOT_A),  (_SHIFTS[15], True, _NOT_H),
+    (_SHIFTS[10], True, _NOT_AB), (_SHIFTS[6], True, _NOT_GH),
+    (_SHIFTS[6], False, _NOT_AB), (_SHIFTS[10], False, _NOT_GH),
+    (_SHIFTS[15], False, _NOT_A), (_SHIFTS[17], False, _NOT_H),
+)
+_KING_STEPS = (
+    (_SHIFTS[8], True, None),  (_SHIFTS[8], False, None),
+    (_SHIFTS[1], True, _NOT_A), (_SHIFTS[1], False, _NOT_H),
+    (_SHIFTS[9], True, _NOT_A), (_SHIFTS[7], True, _NOT_H),
+    (_SHIFTS[7], False, _NOT_A), (_SHIFTS[9], False, _NOT_H),
+)
+_PAWN_STEPS = (
+    ((_SHIFTS[9], True, _NOT_A), (_SHIFTS[7], True, _NOT_H)),   # WHITE
+    ((_SHIFTS[7], False, _NOT_A), (_SHIFTS[9], False, _NOT_H)), # BLACK
+)
+
+def popcount(bitboards):
+    """Returns the number of set bits in every element of a uint64 array."""
+    x = bitboards - ((bitboards >> _SHIFTS[1]) & _u64(0x5555555555555555))
+    x = (x & _u64(0x3333333333333333)) + ((x >> _SHIFTS[2]) & _u64(0x3333333333333333))
+    x = (x + (x >> _SHIFTS[4])) & _u64(0x0F0F0F0F0F0F0F0F)
+    return ((x * _u64(0x0101010101010101)) >> _SHIFTS[56]).astype(numpy.int32)
+
+def _step(bitboards, step):
+    shift, left, mask = step
+    if left:
+        targets = bitboards << shift
+    else:
+        targets = bitboards >> shift
+    if mask is not None:
+        targets &= mask
+    return targets
+
+# The magic bitboard tables of moggio.cache as arrays: for every square the mask, magic,
+# shift and offset into one array with the attacks of all the squares. Built when first needed.
+_magic_arrays = {}
+
+def _magic_table(piece):
+    if piece not in _magic_arrays:
+        if piece == defs.BISHOP:
+            entries = cache.magic_bishop_idx
+        else:
+            entries = cache.magic_rook_idx
+
+        offsets = []
+        attacks = []
+        for mask, magic, shift, square_attacks in entries:
+            offsets.append(len(attacks))
+            attacks.extend(bits or 0 for bits in square_attacks)
+
+        _magic_arrays[piece] = (
+            [_u64(entry[0]) for entry in entries],
+            [_u64(entry[1]) for entry in entries],
+            [_SHIFTS[entry[2]] for entry in entries],
+            offsets,
+            numpy.array(attacks, dtype=numpy.uint64),
+        )
+    return _magic_arrays[piece]
+
+class Batch:
+
+    """A number of positions, held as NumPy arrays.
+
+        This class has the variables:
+        size        - Number of positions.
+        pieces      - uint64 array of shape (2, 6, size); pieces[color][piece] holds the
+                      bitboards of every position, like State.pieces.
+        occupied    - uint64 array of shape (3, size), like State.occupied.
+        turn        - uint8 array with the player in turn of every position.
+    """
+
+    def __init__(self, states):
+        """Makes a batch of an iterable of moggio.state.State."""
+        states = list(states)
+        self.size = len(states)
+
+        self.pieces = numpy.zeros((2, 6, self.size), dtype=numpy.uint64)
+        for color in (defs.WHITE, defs.BLACK):
+            for piece in xrange(6):
+                self.pieces[color][piece] = [state.pieces[color][piece] for state in states]
+
+        self.occupied = numpy.zeros((3, self.size), dtype=numpy.uint64)
+        self.occupied[defs.WHITE] = numpy.bitwise_or.reduce(self.pieces[defs.WHITE], axis=0)
+        self.occupied[defs.BLACK] = numpy.bitwise_or.reduce(self.pieces[defs.BLACK], axis=0)
+        self.occupied[defs.BOTH] = self.occupied[defs.WHITE] | self.occupied[defs.BLACK]
+
+        self.turn = numpy.array([state.turn for state in states], dtype=numpy.uint8)
+
+    def piece_attacks(self):
+        """Returns (attacks, mobility).
+
+           attacks is a uint64 array of shape (2, 6, size) with the squares attacked by the
+           pieces of each kind, for every position. Sliders are blocked by every piece, and
+           squares with pieces of the same color count as attacked (they are defended).
+
+           mobility is an int32 array of shape (2, size) with the number of squares the
+           knights, bishops, rooks, queens and king of each color attack that aren't
+           occupied by their own pieces; the same as the number of moves they have, without
+           castling and ignoring checks and pins.
+        """
+        attacks = numpy.zeros((2, 6, self.size), dtype=numpy.uint64)
+        mobility = numpy.zeros((2, self.size), dtype=numpy.int32)
+        occupied_both = self.occupied[defs.BOTH]
+
+        for color in (defs.WHITE, defs.BLACK):
+            pieces = self.pieces[color]
+            not_own = ~self.occupied[color]
+
+            for step in _PAWN_STEPS[color]:
+                attacks[color][defs.PAWN] |= _step(pieces[defs.PAWN], step)
+
+            # Every step of every leaper is a different move, so mobility can be counted
+            # per step.
+            for piece, steps in ((defs.KNIGHT, _KNIGHT_STEPS), (defs.KING, _KING_STEPS)):
+                for step in steps:
+                    targets = _step(pieces[piece], step)
+                    attacks[color][piece] |= targets
+                    mobility[color] += popcount(targets & not_own)
+
+            for slider in (defs.BISHOP, defs.ROOK):
+                masks, magics, shifts, offsets, table = _magic_table(slider)
+                slider_pieces = pieces[slider] | pieces[defs.QUEEN]
+
+                for square_idx in xrange(64):
+                    # Only the positions with a slider on the square are looked up.
+                    positions = numpy.flatnonzero(slider_pieces & _BITS[square_idx])
+                    if not len(positions):
+                        continue
+
+                    idx = ((occupied_both[positions] & masks[square_idx]) * magics[square_idx]) \
+                        >> shifts[square_idx]
+                    targets = table[offsets[square_idx] + idx.astype(numpy.intp)]
+
+                    mobility[color][positions] += popcount(targets & not_own[positions])
+
+                    is_queen = (pieces[defs.QUEEN][positions] & _BITS[square_idx]) != 0
+                    attacks[color][defs.QUEEN][positions[is_queen]] |= targets[is_queen]
+                    is_slider = ~is_queen
+                    attacks[color][slider][positions[is_slider]] |= targets[is_slider]
+
+        return attacks, mobility
+
+    def attacks(self):
+        """Returns a uint64 array of shape (2, size) with the squares each color attacks."""
+        return numpy.bitwise_or.reduce(self.piece_attacks()[0], axis=1)
+
+    def mobility(self):
+        """Returns the mobility of each color; see piece_attacks."""
+        return self.piece_attacks()[1]
+
+    def material(self, endgame=False):
+        """Returns an int32 array with white's material minus black's, in moggio.evaluate values."""
+        values = moggio.evaluate.material_eg if endgame else moggio.evaluate.material_mg
+
+        material = numpy.zeros(self.size, dtype=numpy.int32)
+        for piece in xrange(defs.KING):
+            material += values[piece] * (popcount(self.pieces[defs.WHITE][piece])
+                                         - popcount(self.pieces[defs.BLACK][piece]))
+        return material
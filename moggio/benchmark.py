@@ -0,0 +1,202 @@
+"""Benchmarks of the hot paths of moggio, with JSON output and comparison against a baseline.
+
+   Every workload runs over the positions of perftsuite.esp a number of times after a
+   warm-up run, and reports the median and 95th percentile of the run times, and the
+   operations per second of the median run. Workloads that take less than min_time are
+   repeated within each run (as many times as the warm-up shows is needed), so that timer
+   resolution and noise matter less. A result can be saved as a baseline, and later
+   results compared against it to catch regressions:
+
+       python -m moggio.benchmark --save baseline.json
+       python -m moggio.benchmark --baseline baseline.json --threshold 0.1
+
+   The second command exits with status 1 if any workload got more than 10% slower.
+"""
+
+import json
+import sys
+import time
+
+import moggio.cache
+import moggio.defines as defs
+import moggio.epd
+import moggio.move
+import moggio.state
+import moggio.test
+
+# Increased when the workloads change, so that results aren't compared against baselines
+# that measured something else.
+FORMAT_VERSION = 1
+
+def _positions(path):
+    handle = open(path, 'r')
+    states = [state for state, operations in moggio.epd.read_positions(handle)]
+    handle.close()
+    return states
+
+def _movegen(states, buffers):
+    """Generates the legal moves of every position. Counts generated moves."""
+    count = 0
+    for state, moves in zip(states, buffers):
+        count += len(moggio.move.generate_legal_moves(state, moves))
+    return count
+
+def _make_unmake(states, buffers):
+    """Makes and unmakes every legal move of every position. Counts moves."""
+    count = 0
+    for state, moves in zip(states, buffers):
+        for move in moves:
+            state.make_move(move)
+            state.unmake_move(move)
+        count += len(moves)
+    return count
+
+def _is_attacked(states, buffers):
+    """Checks every square of every position for attacks by both colors. Counts checks."""
+    is_attacked = moggio.move.is_attacked
+    squares = [1 << square_idx for square_idx in xrange(64)]
+    for state in states:
+        for square in squares:
+            is_attacked(state, square, defs.WHITE)
+            is_attacked(state, square, defs.BLACK)
+    return len(states) * 128
+
+def _perft(depth):
+    def perft(states, buffers):
+        """Runs perft_legal on every position. Counts nodes."""
+        return sum(moggio.test.perft_legal(state, depth, False) for state in states)
+    return perft
+
+def _percentile(times, fraction):
+    """Returns the value at fraction of the sorted times (nearest rank)."""
+    times = sorted(times)
+    return times[min(len(times) - 1, int(fraction * len(times)))]
+
+def run(path='perftsuite.esp', repetitions=5, warmup=1, depths=(2, 3), workloads=None, min_time=0.2):
+    """Runs the workloads and returns the results as a dictionary (see the module docstring).
+
+       workloads is a list of workload names to run, or None for all of them.
+    """
+    moggio.cache.preprocess()
+    states = _positions(path)
+
+    # The move lists for make_unmake are generated up front, so it measures only that.
+    buffers = [moggio.move.generate_legal_moves(state, []) for state in states]
+
+    all_workloads = [
+        ('movegen', _movegen),
+        ('make_unmake', _make_unmake),
+        ('is_attacked', _is_attacked),
+    ] + [('perft_%d' % depth, _perft(depth)) for depth in depths]
+
+    results = {}
+    for name, workload in all_workloads:
+        if workloads is not None and name not in workloads:
+            continue
+
+        passes = 1
+        for i in xrange(max(warmup, 1)):
+            start = time.time()
+            workload(states, buffers)
+            time_spent = time.time() - start
+            if time_spent < min_time:
+                passes = max(passes, int(min_time / max(time_spent, 1e-6)) + 1)
+
+        times = []
+        for i in xrange(repetitions):
+            start = time.time()
+            for j in xrange(passes):
+                ops = workload(states, buffers)
+            times.append(time.time() - start)
+        ops *= passes
+
+        median = _percentile(times, 0.5)
+        results[name] = {
+            'ops': ops,
+            'repetitions': repetitions,
+            'passes': passes,
+            'median': median,
+            'p95': _percentile(times, 0.95),
+            'nps': ops / max(median, 1e-9),
+        }
+
+    return {
+        'version': FORMAT_VERSION,
+        'positions': len(states),
+        'python': sys.version.split()[0],
+        'workloads': results,
+    }
+
+def compare(results, baseline, threshold=0.1):
+    """Compares results against a baseline.
+
+       Returns [(workload, baseline nps, nps), ...] of the workloads whose nps is more than
+       threshold (a fraction) lower than in the baseline.
+    """
+    if baseline.get('version') != results.get('version'):
+        raise ValueError("The baseline is of version %s, but the results are of version %s" %
+                         (baseline.get('version'), results.get('version')))
+
+    regressions = []
+    for name, result in sorted(results['workloads'].items()):
+        if name not in baseline['workloads']:
+            continue
+        baseline_nps = baseline['workloads'][name]['nps']
+        if result['nps'] < baseline_nps * (1 - threshold):
+            regressions.append((name, baseline_nps, result['nps']))
+    return regressions
+
+def main(args=None):
+    """Command line interface; see the module docstring or --help. Returns the exit status."""
+    import optparse
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--positions', default='perftsuite.esp', help='EPD file with the positions')
+    parser.add_option('--repetitions', type='int', default=5)
+    parser.add_option('--warmup', type='int', default=1)
+    parser.add_option('--min-time', type='float', default=0.2,
+                      help='repeat quicker workloads within each run up to this many seconds')
+    parser.add_option('--depths', default='2,3', help='perft depths, comma separated')
+    parser.add_option('--workloads', help='workloads to run, comma separated (default all)')
+    parser.add_option('--output', help='write the results to this file instead of stdout')
+    parser.add_option('--save', help='write the results to this file as a baseline')
+    parser.add_option('--baseline', help='compare the results against this baseline')
+    parser.add_option('--threshold', type='float', default=0.1,
+                      help='allowed drop in nps compared to the baseline (default 0.1)')
+    options, args = parser.parse_args(args)
+
+    results = run(options.positions, options.repetitions, options.warmup,
+                  [int(depth) for depth in options.depths.split(',') if depth],
+                  options.workloads and options.workloads.split(','), options.min_time)
+
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        handle = open(options.output, 'w')
+        handle.write(text + '\n')
+        handle.close()
+    else:
+        print text
+
+    if options.save:
+        handle = open(options.save, 'w')
+        handle.write(text + '\n')
+        handle.close()
+
+    status = 0
+    if options.baseline:
+        handle = open(options.baseline, 'r')
+        baseline = json.load(handle)
+        handle.close()
+
+        regressions = compare(results, baseline, options.threshold)
+        for name, baseline_nps, nps in regressions:
+            print >>sys.stderr, "REGRESSION %s: %d nps, baseline %d nps (%.1f%% slower)" % \
+                (name, nps, baseline_nps, (1 - nps / baseline_nps) * 100)
+        if regressions:
+            status = 1
+        else:
+            print >>sys.stderr, "No regressions against %s" % options.baseline
+
+    return status
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,5 +1,11 @@
 """This module contains cached variables that are used for efficiency in the moggio library."""
 
+import array
+import os
+import struct
+import sys
+import zlib
+
 import moggio.util
 import moggio.defines as defs
 
@@ -51,16 +57,245 @@ promotion_rank = (
     defs.A1 | defs.B1 | defs.C1 | defs.D1 | defs.E1 | defs.F1 | defs.G1 | defs.H1,
 )
 
+# Random keys used for Zobrist hashing of a position. The key of a position is the xor of
+# zobrist_pieces[color][piece][square] for every piece on the board, zobrist_turn if it's
+# blacks turn, zobrist_castling[castling] and zobrist_en_passant[en_passant].
+zobrist_pieces = tuple(tuple(_entry.copy() for piece in xrange(6)) for color in xrange(2))
+zobrist_turn = 0
+# Keyed by every possible value of State.castling.
+zobrist_castling = {}
+# Keyed by the en passant square, but only the file of the square matters.
+zobrist_en_passant = _entry.copy()
+zobrist_en_passant[0] = 0
+
+# Material plus piece-square values of every piece on every square, for the midgame and
+# endgame. Positive for white and negative for black; see moggio.evaluate.square_value.
+psqt_mg = tuple(tuple(_entry.copy() for piece in xrange(6)) for color in xrange(2))
+psqt_eg = tuple(tuple(_entry.copy() for piece in xrange(6)) for color in xrange(2))
+
+# Magic bitboards for bishop and rook moves (queens use both). For every square we
+# store a (mask, magic, shift, attacks) tuple. The mask contains the squares whose
+# occupancy matters for the piece on that square (the edges are left out since they
+# can't block anything), and ((occupied & mask) * magic) & MASK_64 >> shift gives a
+# unique index into attacks for every relevant occupancy.
+magic_bishop = _entry.copy()
+magic_rook = _entry.copy()
+
+MASK_64 = 0xFFFFFFFFFFFFFFFF
+
+# The magic numbers, indexed by square. These were found with find_magic() and are
+# hardcoded since searching for them takes far too long to do at startup.
+_magics_rook = (
+    0x128012C0008000E0, 0x0240002000401001, 0x4100200041001008, 0x8280100008018004,
+    0x2080080002040080, 0x1300010004008208, 0x04000208A9101408, 0x020000204A018F04,
+    0x1080800040008020, 0x0000C01000402001, 0x0080808010002000, 0x0408800800801000,
+    0x0010800801040080, 0x4804800400804200, 0x0304800D00800200, 0x010200040081006A,
+    0x8280044020084000, 0x042000C010004021, 0x2010002004080020, 0x0040210010000900,
+    0x0008004004020041, 0x0004008080040200, 0x1C20040070610208, 0x1020A20000508104,
+    0x0100C00380008120, 0x4001200280400080, 0x0200100080200080, 0x0000401200082200,
+    0xC02C080080040080, 0x0840040080020080, 0x2102004040800100, 0x0042079A00004104,
+    0x0000400424800280, 0x4820100020400040, 0x5010002000801880, 0x9061080081801002,
+    0x208A050011000800, 0x000200080E003094, 0xA010018204003008, 0x2000288042001401,
+    0x400181C000228000, 0x0200402010004000, 0x8388928600420021, 0x400021001001000A,
+    0x2100080011010004, 0x1002020004008080, 0x0802000804020001, 0x88004410408A0001,
+    0x010508C030800100, 0x4000400080310100, 0x0030200010048080, 0x2000800800100080,
+    0x0100040008008080, 0x0022000204008080, 0x0108020170284400, 0x1001010084004200,
+    0x0004890141902202, 0x0100881100220042, 0x0100102001000841, 0x4408050020081001,
+    0x0002008884201002, 0x2002000490410802, 0x0020014800900204, 0x0100082081044402,
+)
+_magics_bishop = (
+    0x0010104088840042, 0x0110104081004062, 0x0091142082000100, 0x0108208821008100,
+    0x0101104000080000, 0x010104200404001C, 0x0C01040202C00010, 0x0001004800841080,
+    0xCA8B46100E280102, 0x001010D00085024C, 0x4180089881020120, 0x8010082050411000,
+    0x0800020210100000, 0x0002120905201200, 0xC000040404040510, 0x0110410101100200,
+    0x0042201408020C27, 0xA882000404440C20, 0x0002000102040100, 0x800200202202C200,
+    0x4002005012101401, 0x2441014880600200, 0x0214020104018400, 0x000180004414410A,
+    0x0105410C10020800, 0x0004200084013400, 0x200582045004001B, 0x1000404004010200,
+    0x0001001081004021, 0x2400430202008628, 0x000604C144230800, 0x04004840008A1804,
+    0x4010045000220210, 0x2012100400500120, 0x10001C0205900081, 0x0020880800360A00,
+    0x8500460020060080, 0x0420008209010110, 0x0010020250008C00, 0x8010A40100004104,
+    0x00008208400022C8, 0x0008410450402100, 0x0008920110004104, 0x43A8011044002024,
+    0x0029102021900602, 0x2270101000212040, 0x0020C41112004040, 0x3004840550C42200,
+    0x5002022202404480, 0x0402822309200840, 0x0032010423240048, 0x2000CA0384110008,
+    0x4001140410440000, 0x2092E50810011010, 0x0140040852005041, 0x00200200C1010104,
+    0x40120202020104E0, 0xA000010042300500, 0x400048004A009001, 0x4200800400411081,
+    0x0010040604105400, 0x0107004210024080, 0x0004423004210040, 0xC220023088010040,
+)
+
+def _ray_attacks(occupied, square, dirs):
+    """Returns the squares attacked from square by sliding in the directions dirs, given
+       the board occupancy. The first blocker in each direction is included.
+
+       Only used while generating the magic bitboards.
+    """
+    attacks = 0
+    for dir in dirs:
+        ray = directions[dir][square]
+        blockers = ray & occupied
+        if blockers:
+            # North and east going rays are blocked by their lowest bit, while
+            # south and west going rays are blocked by their highest bit.
+            if dir in (defs.NORTH, defs.EAST, defs.NW, defs.NE):
+                blocker = blockers & -blockers
+            else:
+                blocker = 1 << (blockers.bit_length() - 1)
+            ray ^= directions[dir][blocker]
+        attacks |= ray
+    return attacks
+
+def _occupancy_subsets(mask):
+    """Yields every subset of the bits in mask (the carry-rippler trick)."""
+    subset = 0
+    while True:
+        yield subset
+        subset = (subset - mask) & mask
+        if not subset:
+            break
+
+def _magic_entry(square, mask, magic, dirs):
+    """Builds the (mask, magic, shift, attacks) tuple of one square.
+
+       Returns None if magic maps two occupancies with different attacks to the same index.
+    """
+    shift = 64 - bin(mask).count('1')
+    attacks = [None] * (1 << (64 - shift))
+
+    for subset in _occupancy_subsets(mask):
+        idx = ((subset * magic) & MASK_64) >> shift
+        subset_attacks = _ray_attacks(subset, square, dirs)
+        if attacks[idx] is None:
+            attacks[idx] = subset_attacks
+        elif attacks[idx] != subset_attacks:
+            return None
+
+    return (mask, magic, shift, attacks)
+
+def find_magic(square, piece, rng=None):
+    """Searches for a magic number for a bishop or rook on square.
+
+       This is slow, and only needed if the hardcoded magics are to be regenerated.
+       Must be called after preprocess().
+    """
+    import random
+    rng = rng or random.Random()
+
+    if piece == defs.BISHOP:
+        mask, dirs = magic_bishop[square][0], _bishop_dirs
+    else:
+        mask, dirs = magic_rook[square][0], _rook_dirs
+
+    while True:
+        # Magics with few bits set tend to work best.
+        magic = rng.getrandbits(64) & rng.getrandbits(64) & rng.getrandbits(64)
+        if bin((mask * magic) & 0xFF00000000000000).count('1') < 6:
+            continue
+        if _magic_entry(square, mask, magic, dirs):
+            return magic
+
+_bishop_dirs = (defs.NE, defs.NW, defs.SE, defs.SW)
+_rook_dirs = (defs.NORTH, defs.EAST, defs.SOUTH, defs.WEST)
+
+# The same tables as above, but indexed by square index (0 == A1, 63 == H8) instead of by
+# the bit of the square. Indexing a list is cheaper than hashing a 64bit int, so these are
+# used by the move generator. They are filled in at the end of preprocess().
+attacks_pawn_idx = ([0] * 64, [0] * 64)
+moves_pawn_one_idx = ([0] * 64, [0] * 64)
+moves_pawn_two_idx = ([0] * 64, [0] * 64)
+attacked_by_pawn_idx = ([0] * 64, [0] * 64)
+moves_knight_idx = [0] * 64
+moves_king_idx = [0] * 64
+castling_availability_idx = (([0] * 64, [0] * 64),
+                             ([0] * 64, [0] * 64))
+magic_bishop_idx = [None] * 64
+magic_rook_idx = [None] * 64
+directions_idx = tuple([0] * 64 for direction in directions)
+
+# Masks used for evaluating the pawn structure. file_masks and rank_masks are indexed by
+# file (0 == A) and rank (0 == rank 1). The others are indexed by color and square index:
+# passed_pawn_idx has the squares in front of a pawn on its own and the adjacent files
+# (a pawn is passed if there are no opposing pawns there), forward_file_idx the squares in
+# front of it on its own file, and pawn_support_idx the squares beside and behind it on the
+# adjacent files. adjacent_files_idx[square index] has both files next to the square.
+file_masks = tuple(0x0101010101010101 << x for x in xrange(8))
+rank_masks = tuple(0xFF << (y * 8) for y in xrange(8))
+adjacent_files_idx = [0] * 64
+passed_pawn_idx = ([0] * 64, [0] * 64)
+forward_file_idx = ([0] * 64, [0] * 64)
+pawn_support_idx = ([0] * 64, [0] * 64)
+
+def _fill_pawn_masks():
+    """Fills in the pawn structure masks, which only depend on file_masks and rank_masks."""
+    for idx in xrange(64):
+        y, x = idx / 8, idx % 8
+
+        adjacent = 0
+        if x > 0:
+            adjacent |= file_masks[x - 1]
+        if x < 7:
+            adjacent |= file_masks[x + 1]
+        adjacent_files_idx[idx] = adjacent
+
+        # The ranks in front of the square, as seen by white and black.
+        white_front = black_front = 0
+        for rank in xrange(y + 1, 8):
+            white_front |= rank_masks[rank]
+        for rank in xrange(0, y):
+            black_front |= rank_masks[rank]
+
+        for color, front in ((defs.WHITE, white_front), (defs.BLACK, black_front)):
+            passed_pawn_idx[color][idx] = front & (adjacent | file_masks[x])
+            forward_file_idx[color][idx] = front & file_masks[x]
+            pawn_support_idx[color][idx] = ~front & adjacent & MASK_64
+
+# between_idx[a][b] contains the squares between square index a and b if they are on the same
+# rank, file or diagonal, and 0 otherwise.
+between_idx = [[0] * 64 for i in xrange(64)]
+
+def _fill_idx(table_idx, table):
+    """Fills a square index-keyed list with the values of a square bit-keyed dictionary."""
+    table_idx[:] = [table[1 << idx] for idx in xrange(64)]
+
+# Set when preprocess() has been run.
+preprocessed = False
+
 def preprocess():
-    """Generates the cache from scratch.
-    
-       Should only be called once.
+    """Generates the cache from scratch, unless it has already been generated or loaded from
+       a file made by save().
     """
-    castling_availability[defs.WHITE][0][defs.E1] = defs.A1
-    castling_availability[defs.WHITE][1][defs.E1] = defs.H1
-    castling_availability[defs.BLACK][0][defs.E8] = defs.A8
-    castling_availability[defs.BLACK][1][defs.E8] = defs.H8
+    global zobrist_turn, preprocessed
+
+    if preprocessed:
+        return
+
+    # The Zobrist keys are always the same, so that hashes can be compared between runs.
+    import random
+    rng = random.Random(_ZOBRIST_SEED)
+    for color in xrange(2):
+        for piece in xrange(6):
+            for idx in xrange(64):
+                zobrist_pieces[color][piece][1 << idx] = rng.getrandbits(64)
+    zobrist_turn = rng.getrandbits(64)
 
+    castling_keys = dict((square, rng.getrandbits(64)) for square in (defs.A1, defs.H1, defs.A8, defs.H8))
+    for rights in xrange(16):
+        castling = 0
+        key = 0
+        for bit, square in enumerate((defs.A1, defs.H1, defs.A8, defs.H8)):
+            if rights & (1 << bit):
+                castling |= square
+                key ^= castling_keys[square]
+        zobrist_castling[castling] = key
+
+    file_keys = [rng.getrandbits(64) for x in xrange(8)]
+    for idx in xrange(64):
+        zobrist_en_passant[1 << idx] = file_keys[idx % 8]
+
+    import moggio.evaluate
+    for color in xrange(2):
+        for piece in xrange(6):
+            for idx in xrange(64):
+                psqt_mg[color][piece][1 << idx] = moggio.evaluate.square_value(color, piece, idx)
+                psqt_eg[color][piece][1 << idx] = moggio.evaluate.square_value(color, piece, idx, True)
     for y in xrange(0, 8):
         for x in xrange(0, 8):
             idx = y * 8 + x
@@ -104,6 +339,8 @@ def preprocess():
                     moves_knight[cache_idx] |= 1 << (y2 * 8 + x2)
 
             # BISHOP & QUEEN
+            # The magic mask is the rays without their last square.
+            magic_mask = 0
             for ydir, xdir, dir in [(1, 1, defs.NE), (1, -1, defs.NW), \
                                     (-1, 1, defs.SE), (-1, -1, defs.SW)]:
                 y2 = y + ydir
@@ -112,8 +349,12 @@ def preprocess():
                     directions[dir][cache_idx] |= 1 << (y2 * 8 + x2)
                     y2 = y2 + ydir
                     x2 = x2 + xdir
+                    if y2 >= 0 and x2 >= 0 and y2 <= 7 and x2 <= 7:
+                        magic_mask |= 1 << ((y2 - ydir) * 8 + x2 - xdir)
+            magic_bishop[cache_idx] = (magic_mask, _magics_bishop[idx])
 
             # ROOK & QUEEN
+            magic_mask = 0
             for ydir, xdir, dir in [(1, 0, defs.NORTH), (0, 1, defs.EAST), \
                         (-1, 0, defs.SOUTH), (0, -1, defs.WEST)]:
                 x2 = x + xdir
@@ -122,6 +363,9 @@ def preprocess():
                     directions[dir][cache_idx] |= 1 << (y2 * 8 + x2)
                     x2 += xdir
                     y2 += ydir
+                    if x2 >= 0 and y2 >= 0 and x2 <= 7 and y2 <= 7:
+                        magic_mask |= 1 << ((y2 - ydir) * 8 + x2 - xdir)
+            magic_rook[cache_idx] = (magic_mask, _magics_rook[idx])
 
             # KING
             for ydir, xdir in [(1, 0), (1, 1), (0, 1), (-1, 1), \
@@ -130,3 +374,228 @@ def preprocess():
                 x2 = x + xdir
                 if x2 >= 0 and y2 >= 0 and x2 <= 7 and y2 <= 7:
                     moves_king[cache_idx] |= 1 << (y2 * 8 + x2)
+
+    # The attack tables need every direction to be filled in, so they are built last.
+    for cache_idx in magic_bishop:
+        mask, magic = magic_bishop[cache_idx]
+        magic_bishop[cache_idx] = _magic_entry(cache_idx, mask, magic, _bishop_dirs)
+
+        mask, magic = magic_rook[cache_idx]
+        magic_rook[cache_idx] = _magic_entry(cache_idx, mask, magic, _rook_dirs)
+
+    # BETWEEN
+    for y in xrange(0, 8):
+        for x in xrange(0, 8):
+            idx = y * 8 + x
+            for ydir, xdir in [(1, 0), (1, 1), (0, 1), (-1, 1), \
+                               (-1, 0), (-1, -1), (0, -1), (1, -1)]:
+                y2 = y + ydir
+                x2 = x + xdir
+                steps = 0
+                while x2 >= 0 and y2 >= 0 and x2 <= 7 and y2 <= 7:
+                    between_idx[idx][y2 * 8 + x2] = steps
+                    steps |= 1 << (y2 * 8 + x2)
+                    y2 += ydir
+                    x2 += xdir
+
+    _finish()
+
+def _finish():
+    """Fills in the tables that are derived from the generated (or loaded) ones."""
+    global preprocessed
+
+    castling_availability[defs.WHITE][0][defs.E1] = defs.A1
+    castling_availability[defs.WHITE][1][defs.E1] = defs.H1
+    castling_availability[defs.BLACK][0][defs.E8] = defs.A8
+    castling_availability[defs.BLACK][1][defs.E8] = defs.H8
+
+    for color in (defs.WHITE, defs.BLACK):
+        _fill_idx(attacks_pawn_idx[color], attacks_pawn[color])
+        _fill_idx(moves_pawn_one_idx[color], moves_pawn_one[color])
+        _fill_idx(moves_pawn_two_idx[color], moves_pawn_two[color])
+        _fill_idx(attacked_by_pawn_idx[color], attacked_by_pawn[color])
+        _fill_idx(castling_availability_idx[color][0], castling_availability[color][0])
+        _fill_idx(castling_availability_idx[color][1], castling_availability[color][1])
+    _fill_idx(moves_knight_idx, moves_knight)
+    _fill_idx(moves_king_idx, moves_king)
+    _fill_idx(magic_bishop_idx, magic_bishop)
+    _fill_idx(magic_rook_idx, magic_rook)
+    for direction, table in enumerate(directions):
+        _fill_idx(directions_idx[direction], table)
+    _fill_pawn_masks()
+
+    preprocessed = True
+
+# The tables can be saved to a file with save(), which is loaded when this module is
+# imported so that preprocess() doesn't have to generate them again. The file starts with a
+# header (see _HEADER), followed by the bitboards and keys as unsigned 64bit ints and then
+# the piece-square values as signed 64bit ints, in the order of _dump_tables().
+#
+# FORMAT_VERSION must be increased whenever the layout or the way the tables are generated
+# changes. Changes to the magics, the Zobrist seed or the evaluation tables are caught by
+# the fingerprint in the header.
+FORMAT_VERSION = 1
+TABLES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tables.bin')
+
+# Identifier, format version, fingerprint, number of unsigned values, number of signed
+# values and the CRC32 of everything after the header.
+_HEADER = struct.Struct('<4sIIIII')
+_FILE_ID = 'MOGT'
+
+_ZOBRIST_SEED = 0x6d6f6767
+
+# The castling values, in the order zobrist_castling is saved.
+_castling_values = [sum(square for bit, square in enumerate((defs.A1, defs.H1, defs.A8, defs.H8))
+                        if rights & (1 << bit)) for rights in xrange(16)]
+
+def _fingerprint():
+    """Returns a checksum of everything the tables are generated from, besides the code."""
+    import moggio.evaluate
+    return zlib.crc32(repr((
+        FORMAT_VERSION, _ZOBRIST_SEED, _magics_rook, _magics_bishop,
+        moggio.evaluate.material_mg, moggio.evaluate.material_eg,
+        moggio.evaluate.psqt_mg, moggio.evaluate.psqt_eg,
+        sys.byteorder, array.array('L').itemsize,
+    ))) & 0xFFFFFFFF
+
+def _dump_tables():
+    """Returns the generated tables as (unsigned values, signed values)."""
+    squares = [1 << idx for idx in xrange(64)]
+    unsigned = []
+    signed = []
+
+    for color in (defs.WHITE, defs.BLACK):
+        for table in (attacks_pawn, moves_pawn_one, moves_pawn_two, attacked_by_pawn):
+            unsigned.extend(table[color][square] for square in squares)
+    for table in (moves_knight, moves_king) + directions:
+        unsigned.extend(table[square] for square in squares)
+    for row in between_idx:
+        unsigned.extend(row)
+
+    for color in (defs.WHITE, defs.BLACK):
+        for piece in xrange(6):
+            unsigned.extend(zobrist_pieces[color][piece][square] for square in squares)
+            signed.extend(psqt_mg[color][piece][square] for square in squares)
+            signed.extend(psqt_eg[color][piece][square] for square in squares)
+    unsigned.append(zobrist_turn)
+    unsigned.extend(zobrist_castling[castling] for castling in _castling_values)
+    unsigned.extend(zobrist_en_passant[square] for square in squares)
+
+    # The magic numbers are in the fingerprint, and the shift follows from the mask.
+    for table in (magic_bishop, magic_rook):
+        for square in squares:
+            mask, magic, shift, attacks = table[square]
+            unsigned.append(mask)
+            # Indexes that no occupancy maps to are saved as 0.
+            unsigned.extend(bits or 0 for bits in attacks)
+
+    return unsigned, signed
+
+def _load_tables(unsigned, signed):
+    """Fills in the tables from values in the order of _dump_tables."""
+    global zobrist_turn
+
+    unsigned = iter(unsigned)
+    signed = iter(signed)
+    next_unsigned = unsigned.next
+    next_signed = signed.next
+    squares = [1 << idx for idx in xrange(64)]
+
+    for color in (defs.WHITE, defs.BLACK):
+        for table in (attacks_pawn, moves_pawn_one, moves_pawn_two, attacked_by_pawn):
+            for square in squares:
+                table[color][square] = next_unsigned()
+    for table in (moves_knight, moves_king) + directions:
+        for square in squares:
+            table[square] = next_unsigned()
+    for row in between_idx:
+        row[:] = [next_unsigned() for idx in xrange(64)]
+
+    for color in (defs.WHITE, defs.BLACK):
+        for piece in xrange(6):
+            for square in squares:
+                zobrist_pieces[color][piece][square] = next_unsigned()
+            for square in squares:
+                psqt_mg[color][piece][square] = next_signed()
+            for square in squares:
+                psqt_eg[color][piece][square] = next_signed()
+    zobrist_turn = next_unsigned()
+    for castling in _castling_values:
+        zobrist_castling[castling] = next_unsigned()
+    for square in squares:
+        zobrist_en_passant[square] = next_unsigned()
+
+    for table, magics in ((magic_bishop, _magics_bishop), (magic_rook, _magics_rook)):
+        for idx, square in enumerate(squares):
+            mask = next_unsigned()
+            shift = 64 - bin(mask).count('1')
+            attacks = [next_unsigned() for i in xrange(1 << (64 - shift))]
+            table[square] = (mask, magics[idx], shift, attacks)
+
+def save(path=TABLES_FILE):
+    """Writes the tables to a file, which is loaded instead of generating them from then on.
+
+       Generates the tables first if needed.
+    """
+    preprocess()
+
+    unsigned, signed = _dump_tables()
+    payload = array.array('L', unsigned).tostring() + array.array('l', signed).tostring()
+    header = _HEADER.pack(_FILE_ID, FORMAT_VERSION, _fingerprint(), len(unsigned), len(signed),
+                          zlib.crc32(payload) & 0xFFFFFFFF)
+
+    # Write to a temporary file first, so that a process starting at the same time never
+    # sees half a file.
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    handle = open(tmp_path, 'wb')
+    try:
+        handle.write(header)
+        handle.write(payload)
+    finally:
+        handle.close()
+    os.rename(tmp_path, path)
+
+def load(path=TABLES_FILE):
+    """Loads the tables from a file made by save().
+
+       Returns True if the tables were loaded, and False if the file is missing, damaged or
+       was made from other tables (in which case preprocess() has to generate them).
+    """
+    if preprocessed:
+        return True
+
+    try:
+        handle = open(path, 'rb')
+        try:
+            data = handle.read()
+        finally:
+            handle.close()
+    except (IOError, OSError):
+        return False
+
+    if len(data) < _HEADER.size:
+        return False
+    file_id, version, fingerprint, n_unsigned, n_signed, checksum = _HEADER.unpack_from(data)
+    if file_id != _FILE_ID or version != FORMAT_VERSION or fingerprint != _fingerprint():
+        return False
+
+    payload = buffer(data, _HEADER.size)
+    unsigned = array.array('L')
+    signed = array.array('l')
+    if len(payload) != (n_unsigned * unsigned.itemsize + n_signed * signed.itemsize) \
+        or zlib.crc32(payload) & 0xFFFFFFFF != checksum:
+        return False
+
+    unsigned.fromstring(payload[:n_unsigned * unsigned.itemsize])
+    signed.fromstring(payload[n_unsigned * unsigned.itemsize:])
+
+    # The array gives longs, but the rest of the code expects ints where they fit.
+    _load_tables(map(int, unsigned), signed.tolist())
+    _finish()
+    return True
+
+load()
+
+if __name__ == '__main__':
+    # python -m moggio.cache [path] builds the tables file.
+    save(*sys.argv[1:2])
@@ -13,6 +13,9 @@ del _count
 FEN_INIT = 'rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1'
 FEN_TEST = FEN_INIT
 
+# The maximum depth of a search.
+MAX_PLY = 256
+
 WHITE = 0
 BLACK = 1
 BOTH = 2
@@ -24,6 +27,22 @@ ROOK = 3
 QUEEN = 4
 KING = 5
 
+# Used in packed moves when there is no captured piece.
+NO_PIECE = 7
+
+# Layout of moves packed into a single int (see moggio.move.pack_move):
+# bits 0-5 from square index, 6-11 to square index, 12-14 moving piece,
+# 15-17 captured piece (NO_PIECE if none), 18-20 promotion piece (0 if none)
+# and the flags below.
+MOVE_TO_SHIFT = 6
+MOVE_PIECE_SHIFT = 12
+MOVE_CAPTURE_SHIFT = 15
+MOVE_PROMOTION_SHIFT = 18
+MOVE_EN_PASSANT = 1 << 21
+MOVE_CASTLE = 1 << 22
+MOVE_DOUBLE_PUSH = 1 << 23
+MOVE_FLAGS = MOVE_EN_PASSANT | MOVE_CASTLE | MOVE_DOUBLE_PUSH
+
 NORTH = 0
 EAST = 1
 SOUTH = 2
@@ -0,0 +1,135 @@
+"""Reading positions from EPD and FEN files, one line at a time.
+
+   An EPD line is the first four fields of a FEN (board, turn, castling and en passant),
+   followed by operations like 'bm e4;' or 'id "test 1";'. Lines may also be complete FENs,
+   optionally followed by operations. Perft suites write the expected node counts as
+   ';D1 20 ;D2 400' or, like perftsuite.esp, as ';20;400'; both give the operations D1, D2
+   and so on.
+"""
+
+import time
+
+import moggio.state
+
+def _split_operations(text):
+    """Splits text on the semicolons that aren't inside double quotes."""
+    if '"' not in text:
+        return text.split(';')
+
+    parts = []
+    start = 0
+    quoted = False
+    for i, c in enumerate(text):
+        if c == '"':
+            quoted = not quoted
+        elif c == ';' and not quoted:
+            parts.append(text[start:i])
+            start = i + 1
+    parts.append(text[start:])
+    return parts
+
+def _operands(text):
+    """Splits the operands of an operation on whitespace, keeping quoted strings whole."""
+    if '"' not in text:
+        return text.split()
+
+    operands = []
+    for i, part in enumerate(text.split('"')):
+        if i % 2:
+            operands.append(part)
+        else:
+            operands.extend(part.split())
+    return operands
+
+def parse_epd(line):
+    """Parses an EPD or FEN line.
+
+       Returns (fen, operations), where fen is a complete FEN (the halfmove and fullmove
+       numbers are taken from the hmvc and fmvn operations, or are 0 and 1 if they are
+       missing) and operations is a dictionary from opcode to a list of operands. Returns
+       None for empty lines and comments (starting with #).
+    """
+    parts = _split_operations(line)
+    fields = parts[0].split()
+    if not fields or fields[0].startswith('#'):
+        return None
+    if len(fields) < 4:
+        raise ValueError("Invalid EPD: '%s'" % line.strip())
+
+    operations = {}
+
+    # A FEN has the move numbers after the en passant field, where an EPD line has its
+    # first operation.
+    rest = fields[4:]
+    if len(rest) >= 2 and rest[0].isdigit() and rest[1].isdigit():
+        halfmove, fullmove = rest[0], rest[1]
+        rest = rest[2:]
+    else:
+        halfmove, fullmove = None, None
+    if rest:
+        parts[0] = ' '.join(rest)
+    else:
+        parts = parts[1:]
+
+    depth = 0
+    for part in parts:
+        operands = _operands(part)
+        if not operands:
+            continue
+
+        depth += 1
+        if operands[0].isdigit():
+            # Bare perft node counts are the answers for depth 1, 2 and so on.
+            operations['D%d' % depth] = operands
+        else:
+            operations[operands[0]] = operands[1:]
+
+    if halfmove is None:
+        halfmove = operations.get('hmvc', ['0'])[0]
+        fullmove = operations.get('fmvn', ['1'])[0]
+
+    fen = '%s %s %s %s %s %s' % (fields[0], fields[1], fields[2], fields[3], halfmove, fullmove)
+    return fen, operations
+
+def read_epd(handle):
+    """Yields (fen, operations) for every position in a file object; see parse_epd.
+
+       The lines are read as they are needed, so files of any size can be read.
+    """
+    for line in handle:
+        record = parse_epd(line)
+        if record:
+            yield record
+
+def read_positions(handle, state=None):
+    """Yields (state, operations) for every position in a file object.
+
+       If state is given, it is set to every position in turn instead of making a new State
+       for each of them, which is faster. The caller must then copy it if it's needed after
+       the next position has been read.
+    """
+    for fen, operations in read_epd(handle):
+        if state is None:
+            yield moggio.state.State(fen), operations
+        else:
+            state.set_fen(fen)
+            yield state, operations
+
+def benchmark(path='perftsuite.esp', repetitions=100):
+    """Reads a file of positions repeatedly, and prints how many positions per second are parsed.
+
+       Returns positions per second when reusing a single State.
+    """
+    state = moggio.state.State()
+    count = 0
+    start = time.time()
+    for i in xrange(repetitions):
+        handle = open(path, 'r')
+        for position, operations in read_positions(handle, state):
+            count += 1
+        handle.close()
+    time_spent = time.time() - start
+
+    per_second = count / time_spent
+    print "%d positions in %.2f seconds, %d positions/second" % (count, time_spent, per_second)
+    return per_second
@@ -0,0 +1,244 @@
+"""Static evaluation of positions.
+
+   The evaluation is material plus piece-square tables, with separate midgame and endgame
+   values that are blended by the game phase. State keeps the sums up to date in make_move,
+   so evaluate() doesn't have to look at the pieces at all. On top of that comes the pawn
+   structure, which only changes when a pawn moves or is captured, so it can be cached by
+   the pawn bitboards in a moggio.hashtable.PawnTable.
+"""
+
+import moggio.cache as cache
+import moggio.defines as defs
+
+# Game phase of each piece. The phase goes from PHASE_MAX with all pieces on the
+# board (midgame) down to 0 with only kings and pawns left (endgame).
+phase_values = (0, 1, 1, 2, 4, 0)
+PHASE_MAX = 24
+
+# Piece values, midgame and endgame.
+material_mg = (82, 337, 365, 477, 1025, 0)
+material_eg = (94, 281, 297, 512, 936, 0)
+
+# Piece-square tables from whites point of view, with A8 first and H1 last so that they
+# look like the board. Black uses the same tables, mirrored.
+_pawn_mg = (
+      0,   0,   0,   0,   0,   0,   0,   0,
+     50,  50,  50,  50,  50,  50,  50,  50,
+     10,  10,  20,  30,  30,  20,  10,  10,
+      5,   5,  10,  25,  25,  10,   5,   5,
+      0,   0,   0,  20,  20,   0,   0,   0,
+      5,  -5, -10,   0,   0, -10,  -5,   5,
+      5,  10,  10, -20, -20,  10,  10,   5,
+      0,   0,   0,   0,   0,   0,   0,   0,
+)
+_pawn_eg = (
+      0,   0,   0,   0,   0,   0,   0,   0,
+     80,  80,  80,  80,  80,  80,  80,  80,
+     50,  50,  50,  50,  50,  50,  50,  50,
+     30,  30,  30,  30,  30,  30,  30,  30,
+     15,  15,  15,  15,  15,  15,  15,  15,
+      5,   5,   5,   5,   5,   5,   5,   5,
+      0,   0,   0,   0,   0,   0,   0,   0,
+      0,   0,   0,   0,   0,   0,   0,   0,
+)
+_knight = (
+    -50, -40, -30, -30, -30, -30, -40, -50,
+    -40, -20,   0,   0,   0,   0, -20, -40,
+    -30,   0,  10,  15,  15,  10,   0, -30,
+    -30,   5,  15,  20,  20,  15,   5, -30,
+    -30,   0,  15,  20,  20,  15,   0, -30,
+    -30,   5,  10,  15,  15,  10,   5, -30,
+    -40, -20,   0,   5,   5,   0, -20, -40,
+    -50, -40, -30, -30, -30, -30, -40, -50,
+)
+_bishop = (
+    -20, -10, -10, -10, -10, -10, -10, -20,
+    -10,   0,   0,   0,   0,   0,   0, -10,
+    -10,   0,   5,  10,  10,   5,   0, -10,
+    -10,   5,   5,  10,  10,   5,   5, -10,
+    -10,   0,  10,  10,  10,  10,   0, -10,
+    -10,  10,  10,  10,  10,  10,  10, -10,
+    -10,   5,   0,   0,   0,   0,   5, -10,
+    -20, -10, -10, -10, -10, -10, -10, -20,
+)
+_rook = (
+      0,   0,   0,   0,   0,   0,   0,   0,
+      5,  10,  10,  10,  10,  10,  10,   5,
+     -5,   0,   0,   0,   0,   0,   0,  -5,
+     -5,   0,   0,   0,   0,   0,   0,  -5,
+     -5,   0,   0,   0,   0,   0,   0,  -5,
+     -5,   0,   0,   0,   0,   0,   0,  -5,
+     -5,   0,   0,   0,   0,   0,   0,  -5,
+      0,   0,   0,   5,   5,   0,   0,   0,
+)
+_queen = (
+    -20, -10, -10,  -5,  -5, -10, -10, -20,
+    -10,   0,   0,   0,   0,   0,   0, -10,
+    -10,   0,   5,   5,   5,   5,   0, -10,
+     -5,   0,   5,   5,   5,   5,   0,  -5,
+      0,   0,   5,   5,   5,   5,   0,  -5,
+    -10,   5,   5,   5,   5,   5,   0, -10,
+    -10,   0,   5,   0,   0,   0,   0, -10,
+    -20, -10, -10,  -5,  -5, -10, -10, -20,
+)
+_king_mg = (
+    -30, -40, -40, -50, -50, -40, -40, -30,
+    -30, -40, -40, -50, -50, -40, -40, -30,
+    -30, -40, -40, -50, -50, -40, -40, -30,
+    -30, -40, -40, -50, -50, -40, -40, -30,
+    -20, -30, -30, -40, -40, -30, -30, -20,
+    -10, -20, -20, -20, -20, -20, -20, -10,
+     20,  20,   0,   0,   0,   0,  20,  20,
+     20,  30,  10,   0,   0,  10,  30,  20,
+)
+_king_eg = (
+    -50, -40, -30, -20, -20, -30, -40, -50,
+    -30, -20, -10,   0,   0, -10, -20, -30,
+    -30, -10,  20,  30,  30,  20, -10, -30,
+    -30, -10,  30,  40,  40,  30, -10, -30,
+    -30, -10,  30,  40,  40,  30, -10, -30,
+    -30, -10,  20,  30,  30,  20, -10, -30,
+    -30, -30,   0,   0,   0,   0, -30, -30,
+    -50, -30, -30, -30, -30, -30, -30, -50,
+)
+
+# Indexed by piece.
+psqt_mg = (_pawn_mg, _knight, _bishop, _rook, _queen, _king_mg)
+psqt_eg = (_pawn_eg, _knight, _bishop, _rook, _queen, _king_eg)
+
+def square_value(color, piece, square_idx, endgame=False):
+    """Returns material plus piece-square value of a piece on a square.
+
+       The value is positive for white and negative for black, so that the values of all the
+       pieces on the board can simply be added up. moggio.cache keeps these by square.
+    """
+    y, x = square_idx / 8, square_idx % 8
+    if color == defs.WHITE:
+        table_idx = (7 - y) * 8 + x
+    else:
+        table_idx = y * 8 + x
+
+    if endgame:
+        value = material_eg[piece] + psqt_eg[piece][table_idx]
+    else:
+        value = material_mg[piece] + psqt_mg[piece][table_idx]
+
+    if color == defs.BLACK:
+        return -value
+    return value
+
+def compute_scores(state):
+    """Calculates (midgame score, endgame score, phase) of a position from scratch.
+
+       This is what State keeps up to date incrementally; use it for verification.
+    """
+    score_mg = score_eg = phase = 0
+
+    for color, piece in defs.COLOR_PIECES:
+        bits = state.pieces[color][piece]
+        while bits:
+            square = bits & -bits
+            bits &= bits - 1
+            square_idx = square.bit_length() - 1
+
+            score_mg += square_value(color, piece, square_idx)
+            score_eg += square_value(color, piece, square_idx, True)
+            phase += phase_values[piece]
+
+    return score_mg, score_eg, phase
+
+# Pawn structure bonuses and penalties, midgame and endgame. The passed pawn bonus is
+# indexed by the rank of the pawn as seen by its own color (0 == its first rank).
+passed_mg = (0, 5, 10, 15, 25, 40, 60, 0)
+passed_eg = (0, 10, 15, 25, 45, 70, 110, 0)
+doubled_mg, doubled_eg = -10, -20
+isolated_mg, isolated_eg = -10, -15
+backward_mg, backward_eg = -8, -10
+
+# The ranks pawns can stand on. set_fen accepts pawns on the first and last ranks too, but
+# the tables and masks above only make sense for the ranks in between.
+pawn_ranks = 0xFFFFFFFFFFFF00
+
+def pawn_structure(white_pawns, black_pawns):
+    """Returns (midgame score, endgame score) of the pawn structure, from whites point of view.
+
+       Passed pawns get a bonus that grows as they advance. Doubled pawns (with a pawn of the
+       same color in front of them), isolated pawns (without pawns of the same color on the
+       adjacent files) and backward pawns (that can't be supported by a pawn of the same
+       color, and whose square in front is attacked by an opposing pawn) are penalized.
+       Pawns on the first and last ranks are left out.
+    """
+    white_pawns &= pawn_ranks
+    black_pawns &= pawn_ranks
+
+    adjacent_files_idx = cache.adjacent_files_idx
+    attacked_by_pawn_idx = cache.attacked_by_pawn_idx
+
+    score_mg = score_eg = 0
+    for color, own, enemy, step, sign in ((defs.WHITE, white_pawns, black_pawns, 8, 1),
+                                          (defs.BLACK, black_pawns, white_pawns, -8, -1)):
+        passed_pawn_idx = cache.passed_pawn_idx[color]
+        forward_file_idx = cache.forward_file_idx[color]
+        pawn_support_idx = cache.pawn_support_idx[color]
+        enemy_attacks_idx = attacked_by_pawn_idx[1 - color]
+
+        mg = eg = 0
+        bits = own
+        while bits:
+            square = bits & -bits
+            bits &= bits - 1
+            square_idx = square.bit_length() - 1
+
+            if not passed_pawn_idx[square_idx] & enemy:
+                rank = square_idx / 8
+                if color == defs.BLACK:
+                    rank = 7 - rank
+                mg += passed_mg[rank]
+                eg += passed_eg[rank]
+
+            if forward_file_idx[square_idx] & own:
+                mg += doubled_mg
+                eg += doubled_eg
+
+            if not adjacent_files_idx[square_idx] & own:
+                mg += isolated_mg
+                eg += isolated_eg
+            elif not pawn_support_idx[square_idx] & own \
+                and enemy_attacks_idx[square_idx + step] & enemy:
+                mg += backward_mg
+                eg += backward_eg
+
+        score_mg += sign * mg
+        score_eg += sign * eg
+
+    return score_mg, score_eg
+
+def evaluate(state, pawn_table=None):
+    """Returns the score of a position, from the point of view of the player in turn.
+
+       The midgame and endgame scores kept by State, plus the pawn structure, are blended
+       by the game phase. The pawn structure is looked up in (and stored to) pawn_table,
+       a moggio.hashtable.PawnTable, when one is given.
+    """
+    phase = state.phase
+    if phase > PHASE_MAX:
+        phase = PHASE_MAX
+
+    white_pawns = state.pieces[defs.WHITE][defs.PAWN]
+    black_pawns = state.pieces[defs.BLACK][defs.PAWN]
+    if pawn_table is None:
+        pawns_mg, pawns_eg = pawn_structure(white_pawns, black_pawns)
+    else:
+        entry = pawn_table.probe(white_pawns, black_pawns)
+        if entry is None:
+            pawns_mg, pawns_eg = pawn_structure(white_pawns, black_pawns)
+            pawn_table.store(white_pawns, black_pawns, pawns_mg, pawns_eg)
+        else:
+            pawns_mg, pawns_eg = entry
+
+    score = ((state.score_mg + pawns_mg) * phase
+             + (state.score_eg + pawns_eg) * (PHASE_MAX - phase)) / PHASE_MAX
+
+    if state.turn == defs.BLACK:
+        return -score
+    return score
@@ -0,0 +1,248 @@
+"""Fixed size hash tables keyed by the Zobrist hash of a position (State.hash), or by its pawns."""
+
+import array
+
+# The tables use array.array('L') for 64bit keys and counts, which requires a platform
+# where a C long is 64 bits wide.
+_KEY_TYPE = 'L'
+
+class PerftTable:
+
+    """Caches perft node counts by position and remaining depth.
+
+        The table is allocated up front and never grows. It consists of buckets of two
+        entries each: the first entry keeps the deepest result seen for its bucket
+        (depth-preferred), and the second entry is always replaced.
+
+        This class has the variables:
+        keys        - Zobrist hash of the position in each entry.
+        depths      - Remaining depth of each entry; 0 means the entry is empty.
+        counts      - Node count of each entry.
+        probes      - Number of calls to probe().
+        hits        - Number of calls to probe() that found an entry.
+    """
+
+    # Bytes used by a single entry: key, count and depth.
+    ENTRY_SIZE = 8 + 8 + 1
+
+    def __init__(self, size_mb=16):
+        """Allocates a table using at most size_mb megabytes."""
+        buckets = 1
+        while buckets * 4 * self.ENTRY_SIZE <= size_mb * 1024 * 1024:
+            buckets *= 2
+
+        self.mask = buckets - 1
+        self.size = buckets * 2
+        self.keys = array.array(_KEY_TYPE, [0]) * self.size
+        self.counts = array.array(_KEY_TYPE, [0]) * self.size
+        self.depths = array.array('B', [0]) * self.size
+        self.probes = 0
+        self.hits = 0
+
+    def clear(self):
+        """Empties the table and resets the statistics."""
+        self.depths = array.array('B', [0]) * self.size
+        self.probes = 0
+        self.hits = 0
+
+    def probe(self, key, depth):
+        """Returns the node count stored for a position and depth, or None if it isn't stored."""
+        self.probes += 1
+        idx = (key & self.mask) << 1
+
+        if self.keys[idx] == key and self.depths[idx] == depth:
+            self.hits += 1
+            return self.counts[idx]
+
+        idx += 1
+        if self.keys[idx] == key and self.depths[idx] == depth:
+            self.hits += 1
+            return self.counts[idx]
+
+        return None
+
+    def store(self, key, depth, count):
+        """Stores the node count of a position searched to depth."""
+        idx = (key & self.mask) << 1
+
+        if depth >= self.depths[idx]:
+            # The old depth-preferred entry gets another chance in the always-replace slot.
+            self.keys[idx + 1] = self.keys[idx]
+            self.depths[idx + 1] = self.depths[idx]
+            self.counts[idx + 1] = self.counts[idx]
+        else:
+            idx += 1
+
+        self.keys[idx] = key
+        self.depths[idx] = depth
+        self.counts[idx] = count
+
+    def hit_rate(self):
+        """Returns the fraction of probes that found an entry."""
+        if not self.probes:
+            return 0.0
+        return float(self.hits) / self.probes
+
+# The kinds of scores stored in a TranspositionTable. 0 means the entry is empty.
+EXACT = 1
+LOWER = 2 # The score is a lower bound (the search failed high).
+UPPER = 3 # The score is an upper bound (the search failed low).
+
+class TranspositionTable:
+
+    """Caches search results by position.
+
+        The table is allocated up front and never grows. Every position maps to a single
+        entry, which is replaced unless it holds a deeper result for the same position.
+
+        This class has the variables:
+        keys        - Zobrist hash of the position in each entry.
+        moves       - Best move (packed) of each entry, or 0.
+        scores      - Score of each entry.
+        depths      - Depth each entry was searched to.
+        bounds      - EXACT, LOWER or UPPER; 0 means the entry is empty.
+        probes      - Number of calls to probe().
+        hits        - Number of calls to probe() that found an entry.
+    """
+
+    # Bytes used by a single entry: key, move, score, depth and bound. The depth doesn't
+    # fit in a byte, since searches go up to defs.MAX_PLY - 1.
+    ENTRY_SIZE = 8 + 8 + 8 + 2 + 1
+
+    def __init__(self, size_mb=16):
+        """Allocates a table using at most size_mb megabytes."""
+        entries = 1
+        while entries * 2 * self.ENTRY_SIZE <= size_mb * 1024 * 1024:
+            entries *= 2
+
+        self.mask = entries - 1
+        self.size = entries
+        self.keys = array.array(_KEY_TYPE, [0]) * entries
+        self.moves = array.array(_KEY_TYPE, [0]) * entries
+        self.scores = array.array('l', [0]) * entries
+        self.depths = array.array('h', [0]) * entries
+        self.bounds = array.array('B', [0]) * entries
+        self.probes = 0
+        self.hits = 0
+
+    def clear(self):
+        """Empties the table and resets the statistics."""
+        self.bounds = array.array('B', [0]) * self.size
+        self.probes = 0
+        self.hits = 0
+
+    def probe(self, key):
+        """Returns (depth, score, bound, move) stored for a position, or None if it isn't stored."""
+        self.probes += 1
+        idx = key & self.mask
+
+        if self.keys[idx] != key or not self.bounds[idx]:
+            return None
+
+        self.hits += 1
+        # The array gives longs, but moggio.state.State.make_move wants packed moves as ints.
+        return self.depths[idx], self.scores[idx], self.bounds[idx], int(self.moves[idx])
+
+    def store(self, key, depth, score, bound, move):
+        """Stores the result of searching a position to depth."""
+        idx = key & self.mask
+
+        if self.keys[idx] == key and self.bounds[idx] and self.depths[idx] > depth:
+            return
+
+        # Keep the old best move if the new search didn't find one.
+        if not move and self.keys[idx] == key:
+            move = self.moves[idx]
+
+        self.keys[idx] = key
+        self.depths[idx] = depth
+        self.scores[idx] = score
+        self.bounds[idx] = bound
+        self.moves[idx] = move
+
+    def hashfull(self):
+        """Returns how full the table is in permille, estimated from the first 1000 entries."""
+        sample = min(1000, self.size)
+        used = sum(1 for bound in self.bounds[:sample] if bound)
+        return used * 1000 / sample
+
+    def hit_rate(self):
+        """Returns the fraction of probes that found an entry."""
+        if not self.probes:
+            return 0.0
+        return float(self.hits) / self.probes
+
+class PawnTable:
+
+    """Caches pawn structure scores by the pawn bitboards of both colors.
+
+        The table is allocated up front and never grows. Every pawn structure maps to a
+        single entry, which is simply overwritten by the next structure that maps to it.
+
+        This class has the variables:
+        white       - White pawn bitboard of each entry.
+        black       - Black pawn bitboard of each entry.
+        scores_mg   - Midgame score of each entry.
+        scores_eg   - Endgame score of each entry.
+        used        - 1 for the entries that have been stored.
+        probes      - Number of calls to probe().
+        hits        - Number of calls to probe() that found an entry.
+    """
+
+    # Bytes used by a single entry: both bitboards, both scores and used.
+    ENTRY_SIZE = 8 + 8 + 8 + 8 + 1
+
+    # Multipliers that mix the two bitboards into an index.
+    _WHITE_MULTIPLIER = 0x9E3779B97F4A7C15
+    _BLACK_MULTIPLIER = 0xC2B2AE3D27D4EB4F
+
+    def __init__(self, size_mb=1):
+        """Allocates a table using at most size_mb megabytes."""
+        bits = 0
+        while (2 << bits) * self.ENTRY_SIZE <= size_mb * 1024 * 1024:
+            bits += 1
+
+        self.shift = 64 - bits
+        self.size = 1 << bits
+        self.white = array.array(_KEY_TYPE, [0]) * self.size
+        self.black = array.array(_KEY_TYPE, [0]) * self.size
+        self.scores_mg = array.array('l', [0]) * self.size
+        self.scores_eg = array.array('l', [0]) * self.size
+        self.used = array.array('B', [0]) * self.size
+        self.probes = 0
+        self.hits = 0
+
+    def clear(self):
+        """Empties the table and resets the statistics."""
+        self.used = array.array('B', [0]) * self.size
+        self.probes = 0
+        self.hits = 0
+
+    def _index(self, white, black):
+        return ((white * self._WHITE_MULTIPLIER ^ black * self._BLACK_MULTIPLIER)
+                & 0xFFFFFFFFFFFFFFFF) >> self.shift
+
+    def probe(self, white, black):
+        """Returns (midgame score, endgame score) stored for a pawn structure, or None."""
+        self.probes += 1
+        idx = self._index(white, black)
+
+        if self.used[idx] and self.white[idx] == white and self.black[idx] == black:
+            self.hits += 1
+            return self.scores_mg[idx], self.scores_eg[idx]
+        return None
+
+    def store(self, white, black, score_mg, score_eg):
+        """Stores the scores of a pawn structure."""
+        idx = self._index(white, black)
+        self.white[idx] = white
+        self.black[idx] = black
+        self.scores_mg[idx] = score_mg
+        self.scores_eg[idx] = score_eg
+        self.used[idx] = 1
+
+    def hit_rate(self):
+        """Returns the fraction of probes that found an entry."""
+        if not self.probes:
+            return 0.0
+        return float(self.hits) / self.probes
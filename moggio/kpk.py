@@ -0,0 +1,298 @@
+"""The king and pawn versus king (KPK) endgame bitbase.
+
+   Every KPK position is either won for the side with the pawn or a draw. The bitbase holds
+   one bit per position, set if it's won, and is generated by retrograde analysis: starting
+   from the positions where the pawn promotes safely or black is mated, wins are propagated
+   backwards through the moves that lead to them, until nothing changes. Everything that
+   isn't won by then is a draw.
+
+   Positions are indexed with white as the side with the pawn, and with the pawn on the
+   files A-D (other positions are mirrored); see index(). That gives 196608 positions, or
+   24KB. The bitbase is saved to a file with a small header, which is memory-mapped when
+   loaded:
+
+       python -m moggio.kpk [path]
+"""
+
+import mmap
+import os
+import struct
+import zlib
+
+import moggio.cache as cache
+import moggio.defines as defs
+
+# Number of squares a (white) pawn is indexed by: files A-D of ranks 2-7.
+PAWN_SQUARES = 24
+# Number of positions in the bitbase.
+SIZE = 2 * 64 * 64 * PAWN_SQUARES
+
+# FORMAT_VERSION must be increased whenever the indexing or the file layout changes.
+FORMAT_VERSION = 1
+BITBASE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'kpk.bin')
+
+# Identifier, format version, number of positions and the CRC32 of the bits.
+_HEADER = struct.Struct('<4sIII')
+_FILE_ID = 'MKPK'
+
+# Results of the positions while generating.
+_UNKNOWN = 0
+_DRAW = 1
+_WIN = 2
+_INVALID = 3
+
+def index(turn, white_king, black_king, pawn):
+    """Returns the index of a position, given as square indexes.
+
+       White must be the side with the pawn, and the pawn must be on the files A-D of the
+       ranks 2-7.
+    """
+    return turn | black_king << 1 | white_king << 7 | (((pawn >> 3) - 1) * 4 + (pawn & 7)) << 13
+
+def _squares(bits):
+    """Returns the square indexes of the bits in a bitboard."""
+    squares = []
+    while bits:
+        square = bits & -bits
+        bits &= bits - 1
+        squares.append(square.bit_length() - 1)
+    return squares
+
+def _pawn_square(pawn_idx):
+    """Reverses the pawn part of index()."""
+    return (pawn_idx / 4 + 1) * 8 + pawn_idx % 4
+
+def generate():
+    """Generates the bitbase by retrograde analysis, and returns it as a Bitbase."""
+    cache.preprocess()
+    moves_king_idx = cache.moves_king_idx
+    attacks_pawn_idx = cache.attacks_pawn_idx[defs.WHITE]
+    moves_pawn_one_idx = cache.moves_pawn_one_idx[defs.WHITE]
+    moves_pawn_two_idx = cache.moves_pawn_two_idx[defs.WHITE]
+
+    king_targets = [_squares(moves_king_idx[square_idx]) for square_idx in xrange(64)]
+    # The squares a pawn on each square could have been pushed from.
+    pawn_sources = [[source for source in xrange(8, 56) if moves_pawn_two_idx[source] & (1 << square_idx)]
+                    for square_idx in xrange(64)]
+
+    results = bytearray(SIZE)
+    # Number of legal moves of each position with black to move that aren't known to lose.
+    moves_left = bytearray(SIZE)
+    won = []
+
+    for pawn_idx in xrange(PAWN_SQUARES):
+        pawn = _pawn_square(pawn_idx)
+        promotion = pawn + 8
+        pawn_attacks = attacks_pawn_idx[pawn]
+
+        for white_king in xrange(64):
+            white_king_moves = moves_king_idx[white_king]
+            guarded = white_king_moves | pawn_attacks
+
+            for black_king in xrange(64):
+                idx = index(defs.WHITE, white_king, black_king, pawn)
+                black_king_bit = 1 << black_king
+
+                if white_king == pawn or black_king == pawn or white_king == black_king \
+                    or white_king_moves & black_king_bit:
+                    results[idx] = results[idx | 1] = _INVALID
+                    continue
+
+                # White to move. Black can't be in check, and promoting wins when the new
+                # queen can't be captured.
+                if pawn_attacks & black_king_bit:
+                    results[idx] = _INVALID
+                elif pawn >> 3 == 6 and promotion != white_king and promotion != black_king \
+                    and (not moves_king_idx[black_king] & (1 << promotion)
+                         or white_king_moves & (1 << promotion)):
+                    results[idx] = _WIN
+                    won.append(idx)
+
+                # Black to move. Capturing the pawn draws; otherwise black is mated or
+                # stalemated without legal moves.
+                idx |= 1
+                targets = moves_king_idx[black_king] & ~guarded
+                if targets & (1 << pawn):
+                    results[idx] = _DRAW
+                elif targets:
+                    moves_left[idx] = bin(targets).count('1')
+                elif pawn_attacks & black_king_bit:
+                    results[idx] = _WIN
+                    won.append(idx)
+                else:
+                    results[idx] = _DRAW
+
+    while won:
+        idx = won.pop()
+        black_king = idx >> 1 & 63
+        white_king = idx >> 7 & 63
+
+        if idx & 1 == defs.WHITE:
+            # Black's king came from one of the squares next to it. The position before is
+            # won once every one of black's moves leads to a win.
+            base = idx & ~(63 << 1) | 1
+            for square_idx in king_targets[black_king]:
+                previous = base | square_idx << 1
+                if results[previous] == _UNKNOWN:
+                    moves_left[previous] -= 1
+                    if not moves_left[previous]:
+                        results[previous] = _WIN
+                        won.append(previous)
+        else:
+            # White's king came from one of the squares next to it, or the pawn was pushed.
+            # A single winning move is enough.
+            base = idx & ~(63 << 7) & ~1
+            previous_positions = [base | square_idx << 7 for square_idx in king_targets[white_king]]
+
+            pawn = _pawn_square(idx >> 13)
+            for source in pawn_sources[pawn]:
+                if moves_pawn_one_idx[source] != 1 << pawn:
+                    # A double push passes the square in front of the pawn.
+                    if white_king == source + 8 or black_king == source + 8:
+                        continue
+                previous_positions.append(index(defs.WHITE, white_king, black_king, source))
+
+            for previous in previous_positions:
+                if results[previous] == _UNKNOWN:
+                    results[previous] = _WIN
+                    won.append(previous)
+
+    bits = bytearray(SIZE / 8)
+    for idx in xrange(SIZE):
+        if results[idx] == _WIN:
+            bits[idx >> 3] |= 1 << (idx & 7)
+
+    return Bitbase(str(bits))
+
+class Bitbase:
+
+    """The KPK bitbase.
+
+        This class has the variables:
+        path        - The file the bitbase was loaded from, or None if it was generated.
+    """
+
+    def __init__(self, data, path=None, offset=0):
+        """Makes a bitbase of SIZE / 8 bytes of data (a string or a mmap) starting at offset."""
+        self._data = data
+        self._offset = offset
+        self.path = path
+
+    def close(self):
+        """Unmaps the file, if the bitbase was loaded from one."""
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+        self._data = None
+
+    def bits(self):
+        """Returns the bits as a string."""
+        return self._data[self._offset:self._offset + SIZE / 8]
+
+    def probe(self, turn, white_king, black_king, pawn):
+        """Returns True if a position is won for white, and False if it's a draw.
+
+           The position is given as square indexes, with white as the side with the pawn.
+        """
+        if pawn & 7 > 3:
+            white_king ^= 7
+            black_king ^= 7
+            pawn ^= 7
+
+        idx = index(turn, white_king, black_king, pawn)
+        return bool(ord(self._data[self._offset + (idx >> 3)]) >> (idx & 7) & 1)
+
+    def probe_state(self, state):
+        """Returns None if a position isn't KPK, and otherwise True if it's won for the side
+           with the pawn and False if it's a draw.
+        """
+        if state.phase:
+            return None
+
+        pieces = state.pieces
+        white_pawns = pieces[defs.WHITE][defs.PAWN]
+        black_pawns = pieces[defs.BLACK][defs.PAWN]
+        pawns = white_pawns | black_pawns
+        if not pawns or pawns & (pawns - 1):
+            return None
+
+        pawn = pawns.bit_length() - 1
+        white_king = pieces[defs.WHITE][defs.KING].bit_length() - 1
+        black_king = pieces[defs.BLACK][defs.KING].bit_length() - 1
+
+        if white_pawns:
+            return self.probe(state.turn, white_king, black_king, pawn)
+
+        # Black has the pawn; flip the board so that it's white's.
+        return self.probe(1 - state.turn, black_king ^ 56, white_king ^ 56, pawn ^ 56)
+
+    def save(self, path=BITBASE_FILE):
+        """Writes the bitbase to a file that load() can map."""
+        bits = self.bits()
+        header = _HEADER.pack(_FILE_ID, FORMAT_VERSION, SIZE, zlib.crc32(bits) & 0xFFFFFFFF)
+
+        # Write to a temporary file first, so that a process starting at the same time never
+        # sees half a file.
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        handle = open(tmp_path, 'wb')
+        try:
+            handle.write(header)
+            handle.write(bits)
+        finally:
+            handle.close()
+        os.rename(tmp_path, path)
+
+def load(path=BITBASE_FILE):
+    """Memory-maps a bitbase saved by Bitbase.save.
+
+       Returns None if the file is missing, damaged or of another version.
+    """
+    try:
+        handle = open(path, 'rb')
+    except (IOError, OSError):
+        return None
+
+    try:
+        if os.fstat(handle.fileno()).st_size != _HEADER.size + SIZE / 8:
+            return None
+        data = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        # The map stays valid after the file is closed.
+        handle.close()
+
+    file_id, version, size, checksum = _HEADER.unpack_from(data)
+    if file_id != _FILE_ID or version != FORMAT_VERSION or size != SIZE \
+        or zlib.crc32(data[_HEADER.size:]) & 0xFFFFFFFF != checksum:
+        data.close()
+        return None
+
+    return Bitbase(data, path, _HEADER.size)
+
+_shared = None
+
+def shared():
+    """Returns the bitbase in BITBASE_FILE, generating (and trying to save) it first if needed.
+
+       The bitbase is only loaded once per process.
+    """
+    global _shared
+    if _shared is None:
+        bitbase = load()
+        if bitbase is None:
+            bitbase = generate()
+            try:
+                bitbase.save()
+            except (IOError, OSError):
+                pass
+        _shared = bitbase
+    return _shared
+
+if __name__ == '__main__':
+    # python -m moggio.kpk [path] generates the bitbase file.
+    import sys
+    import time
+
+    start = time.time()
+    bitbase = generate()
+    path = sys.argv[1] if len(sys.argv) > 1 else BITBASE_FILE
+    bitbase.save(path)
+    print "Generated %s in %.2f seconds" % (path, time.time() - start)
@@ -4,9 +4,15 @@ import moggio.cache as cache
 
 """Module containing functions for generating moves"""
 
-class Move:
+class Move(object):
     
-    """Contains all the information of a move on the chess board"""
+    """Contains all the information of a move on the chess board
+
+       The move generator can also produce moves packed into a single int (see pack_move),
+       which is much cheaper. Move.unpack turns those into a Move.
+    """
+
+    __slots__ = ('from_square', 'to_square', 'from_piece', 'capture', 'promotion')
 
     def __init__(self, from_square, to_square, from_piece, capture=None, promotion=None):
         self.from_square = from_square
@@ -14,7 +20,23 @@ class Move:
         self.from_piece = from_piece
         self.capture = capture
         self.promotion = promotion
-    
+
+    @classmethod
+    def unpack(cls, move):
+        """Makes a Move from a packed move."""
+        return cls(1 << move_from_idx(move), 1 << move_to_idx(move), move_piece(move),
+                   move_capture(move), move_promotion(move))
+
+    def pack(self):
+        """Returns the move packed into an int. The flags are not set."""
+        return pack_move(cache.bitpos_to_square_idx[self.from_square],
+                         cache.bitpos_to_square_idx[self.to_square],
+                         self.from_piece, self.capture, self.promotion)
+
+    def uci(self):
+        """Returns the move in UCI notation (e2e4, e7e8q)."""
+        return move_uci(self.pack())
+
     def __str__(self):
         from_square = cache.bitpos_to_square_idx[self.from_square]
         to_square = cache.bitpos_to_square_idx[self.to_square]
@@ -32,6 +54,61 @@ class Move:
 
         return ret
 
+def pack_move(from_idx, to_idx, from_piece, capture=None, promotion=None, flags=0):
+    """Packs a move into a single int. The layout is described in moggio.defines."""
+    if capture == None:
+        capture = defs.NO_PIECE
+
+    return from_idx | to_idx << defs.MOVE_TO_SHIFT \
+        | from_piece << defs.MOVE_PIECE_SHIFT \
+        | capture << defs.MOVE_CAPTURE_SHIFT \
+        | (promotion or 0) << defs.MOVE_PROMOTION_SHIFT \
+        | flags
+
+def move_from_idx(move):
+    """Returns the square index a packed move is made from."""
+    return move & 0x3f
+
+def move_to_idx(move):
+    """Returns the square index a packed move is made to."""
+    return move >> defs.MOVE_TO_SHIFT & 0x3f
+
+def move_piece(move):
+    """Returns the piece making a packed move."""
+    return move >> defs.MOVE_PIECE_SHIFT & 7
+
+def move_capture(move):
+    """Returns the piece captured by a packed move, or None."""
+    capture = move >> defs.MOVE_CAPTURE_SHIFT & 7
+    if capture == defs.NO_PIECE:
+        return None
+    return capture
+
+def move_promotion(move):
+    """Returns the piece a packed move promotes to, or None."""
+    return (move >> defs.MOVE_PROMOTION_SHIFT & 7) or None
+
+def move_flags(move):
+    """Returns the MOVE_EN_PASSANT, MOVE_CASTLE and MOVE_DOUBLE_PUSH flags of a packed move."""
+    return move & defs.MOVE_FLAGS
+
+def move_str(move):
+    """Formats a packed move the same way as Move.__str__ (e2 e4, e4xd5)."""
+    seperator = (' ', 'x')[move_capture(move) != None]
+    return "%s%s%s" % (util.square_to_chars(move_from_idx(move)), \
+                       seperator, \
+                       util.square_to_chars(move_to_idx(move)))
+
+def move_uci(move):
+    """Formats a packed move in UCI notation (e2e4, e7e8q)."""
+    ret = util.square_to_chars(move_from_idx(move)) + util.square_to_chars(move_to_idx(move))
+
+    promotion = move_promotion(move)
+    if promotion:
+        ret += util.piece_to_char(defs.BLACK, promotion)
+
+    return ret
+
 def generate_moves(state):
     """Returns a list of the available moves/captures/promotions in a position, for the player in turn.
 
@@ -78,6 +155,361 @@ def generate_moves(state):
                     moves.append(Move(from_square, to_square, piece, capture))
     return moves
 
+def generate_moves_packed(state, moves):
+    """Same as generate_moves, but produces packed moves (see pack_move), with flags.
+
+       The moves are put in the list moves, which is emptied first, so that a search can reuse
+       one list per ply instead of allocating a new one at every node. Returns moves, or None
+       if the king of the opponent can be captured.
+    """
+    color = state.turn
+    opponent = 1 - color
+    occupied_opponent = state.occupied[opponent]
+    pieces_opponent = state.pieces[opponent]
+    en_passant = state.en_passant
+    promotion_rank = cache.promotion_rank[color]
+
+    del moves[:]
+    append = moves.append
+
+    for piece in xrange(defs.KING + 1):
+        bits = state.pieces[color][piece]
+
+        while bits:
+            from_square = bits & -bits
+            bits &= bits - 1
+
+            base = (from_square.bit_length() - 1) | piece << defs.MOVE_PIECE_SHIFT
+
+            valid_moves = generate_piece_moves(state, color, piece, from_square)
+            while valid_moves:
+                to_square = valid_moves & -valid_moves
+                valid_moves &= valid_moves - 1
+
+                move = base | (to_square.bit_length() - 1) << defs.MOVE_TO_SHIFT
+
+                # Check if it's a capture. If so, set the captured piece.
+                if to_square & occupied_opponent:
+                    for capture in xrange(defs.KING + 1):
+                        if to_square & pieces_opponent[capture]:
+                            break
+
+                    if capture == defs.KING:
+                        return None
+
+                    move |= capture << defs.MOVE_CAPTURE_SHIFT
+
+                # En passant is a capture as well.
+                elif piece == defs.PAWN and to_square & en_passant:
+                    move |= defs.PAWN << defs.MOVE_CAPTURE_SHIFT | defs.MOVE_EN_PASSANT
+
+                else:
+                    move |= defs.NO_PIECE << defs.MOVE_CAPTURE_SHIFT
+
+                if piece == defs.PAWN:
+                    # Check if it's a promotion. If so, generate a move for all possible promotions.
+                    if to_square & promotion_rank:
+                        for promotion in xrange(defs.KNIGHT, defs.KING):
+                            append(move | promotion << defs.MOVE_PROMOTION_SHIFT)
+                        continue
+
+                    if to_square == from_square << 16 or to_square == from_square >> 16:
+                        move |= defs.MOVE_DOUBLE_PUSH
+
+                elif piece == defs.KING:
+                    if to_square == from_square << 2 or to_square == from_square >> 2:
+                        move |= defs.MOVE_CASTLE
+
+                append(move)
+
+    return moves
+
+# The kinds of moves generate_legal_moves can generate.
+CAPTURES = 1 # Captures, en passant and promotions.
+QUIETS = 2 # Everything else.
+ALL = CAPTURES | QUIETS
+
+def _legal_king_targets(state, color, king, king_idx):
+    """Returns the squares the king of color can move to without being attacked, except for castling."""
+    opponent = 1 - color
+    occupied = state.occupied
+
+    # The king itself is removed from the board when testing this, so that it can't hide
+    # from a slider behind itself.
+    occupied_no_king = occupied[defs.BOTH] ^ king
+
+    ret = 0
+    targets = cache.moves_king_idx[king_idx] & ~occupied[color]
+    while targets:
+        to_square = targets & -targets
+        targets &= targets - 1
+
+        if not square_attacked(state, to_square.bit_length() - 1, opponent, occupied_no_king):
+            ret |= to_square
+
+    return ret
+
+def _checks_and_pins(state, color, king_idx):
+    """Returns (checkers, check_mask, pinned, pin_rays) for the king of color.
+
+       checkers are the opponent pieces giving check, and check_mask is the squares other
+       pieces than the king must move to when in single check (all squares when not in check).
+       A piece is pinned if it's the only piece between the king and an opponent slider
+       looking at the king. It can then only move to the squares in pin_rays[piece square].
+    """
+    opponent = 1 - color
+    pieces_opponent = state.pieces[opponent]
+    occupied_both = state.occupied[defs.BOTH]
+    between = cache.between_idx[king_idx]
+
+    checkers = attackers_by(state, king_idx, opponent, occupied_both)
+
+    if checkers:
+        # The checker must be captured or, if it's a slider, blocked.
+        check_mask = checkers | between[checkers.bit_length() - 1]
+    else:
+        check_mask = cache.MASK_64
+
+    pinned = 0
+    pin_rays = None
+    snipers = (bishop_attacks(0, king_idx) & (pieces_opponent[defs.BISHOP] | pieces_opponent[defs.QUEEN])) \
+        | (rook_attacks(0, king_idx) & (pieces_opponent[defs.ROOK] | pieces_opponent[defs.QUEEN]))
+    while snipers:
+        sniper = snipers & -snipers
+        snipers &= snipers - 1
+        ray = between[sniper.bit_length() - 1]
+
+        blockers = ray & occupied_both
+        if blockers and not blockers & (blockers - 1) and blockers & state.occupied[color]:
+            pinned |= blockers
+            if pin_rays is None:
+                pin_rays = {}
+            pin_rays[blockers] = ray | sniper
+
+    return checkers, check_mask, pinned, pin_rays
+
+def _en_passant_legal(state, color, from_square, king_idx, checkers, check_mask):
+    """Checks if the pawn on from_square can legally capture en passant.
+
+       En passant removes two pieces from the rank of the king, and the captured pawn might be
+       the checker, so it's tested by looking at the board after the move.
+    """
+    opponent = 1 - color
+    pieces_opponent = state.pieces[opponent]
+    en_passant = state.en_passant
+    captured = cache.moves_pawn_one_idx[opponent][en_passant.bit_length() - 1]
+
+    if not (check_mask & en_passant or checkers & captured):
+        return False
+
+    occupied_after = state.occupied[defs.BOTH] ^ from_square ^ captured | en_passant
+    return not (bishop_attacks(occupied_after, king_idx) & (pieces_opponent[defs.BISHOP] | pieces_opponent[defs.QUEEN])) \
+        and not (rook_attacks(occupied_after, king_idx) & (pieces_opponent[defs.ROOK] | pieces_opponent[defs.QUEEN]))
+
+def checks_and_pins(state):
+    """Returns (checkers, check_mask, pinned, pin_rays) for the player in turn.
+
+       This can be given to generate_legal_moves and is_legal_move, to avoid calculating it
+       more than once per position. See _checks_and_pins.
+    """
+    return _checks_and_pins(state, state.turn, state.pieces[state.turn][defs.KING].bit_length() - 1)
+
+def generate_legal_moves(state, moves, kind=ALL, checks=None):
+    """Same as generate_moves_packed, but only generates legal moves.
+
+       The pieces checking the king, the pinned pieces and the squares that resolve a check
+       are calculated once (or given as checks, see checks_and_pins), and the moves of each
+       piece are masked with them, so the moves never have to be made to find out whether
+       they leave the king in check.
+
+       kind is CAPTURES (captures, en passant and promotions), QUIETS (the rest) or ALL.
+       Returns moves.
+    """
+    return _generate_legal(state, moves, kind, checks, cache.MASK_64)
+
+def is_legal_move(state, move, checks=None):
+    """Checks if a packed move is legal in a position.
+
+       Used for moves that might come from another position, like moves from a transposition
+       table or killer moves. Only the moves of the piece on the from square are generated.
+    """
+    from_square = 1 << (move & 0x3f)
+    if not state.pieces[state.turn][move >> defs.MOVE_PIECE_SHIFT & 7] & from_square:
+        return False
+
+    return move in _generate_legal(state, [], ALL, checks, from_square)
+
+def _generate_legal(state, moves, kind, checks, from_mask):
+    """Implements generate_legal_moves, for the pieces on the squares in from_mask."""
+    color = state.turn
+    opponent = 1 - color
+    pieces = state.pieces[color]
+    pieces_opponent = state.pieces[opponent]
+    occupied_opponent = state.occupied[opponent]
+    en_passant = state.en_passant
+    promotion_rank = cache.promotion_rank[color]
+
+    # Which destinations to generate moves for; pawns are special since their promotions
+    # are generated with the captures.
+    if kind == ALL:
+        target_mask = pawn_target_mask = cache.MASK_64
+    elif kind == CAPTURES:
+        target_mask = occupied_opponent
+        pawn_target_mask = occupied_opponent | promotion_rank
+    else:
+        target_mask = ~occupied_opponent
+        pawn_target_mask = ~(occupied_opponent | promotion_rank)
+
+    del moves[:]
+    append = moves.append
+
+    king = pieces[defs.KING]
+    king_idx = king.bit_length() - 1
+
+    base = king_idx | defs.KING << defs.MOVE_PIECE_SHIFT
+    if king & from_mask:
+        targets = _legal_king_targets(state, color, king, king_idx) & target_mask
+    else:
+        targets = 0
+    while targets:
+        to_square = targets & -targets
+        targets &= targets - 1
+
+        move = base | (to_square.bit_length() - 1) << defs.MOVE_TO_SHIFT
+        if to_square & occupied_opponent:
+            for capture in xrange(defs.KING):
+                if to_square & pieces_opponent[capture]:
+                    break
+            append(move | capture << defs.MOVE_CAPTURE_SHIFT)
+        else:
+            append(move | defs.NO_PIECE << defs.MOVE_CAPTURE_SHIFT)
+
+    checkers, check_mask, pinned, pin_rays = checks or _checks_and_pins(state, color, king_idx)
+
+    if checkers:
+        # In double check, only the king can move.
+        if checkers & (checkers - 1):
+            return moves
+    elif kind & QUIETS and king & from_mask:
+        # Castling is only legal when not in check. generate_piece_moves checks the rest.
+        castles = generate_piece_moves(state, color, defs.KING, king) & (king << 2 | king >> 2)
+        while castles:
+            to_square = castles & -castles
+            castles &= castles - 1
+            append(base | (to_square.bit_length() - 1) << defs.MOVE_TO_SHIFT \
+                   | defs.NO_PIECE << defs.MOVE_CAPTURE_SHIFT | defs.MOVE_CASTLE)
+
+    for piece in xrange(defs.KING):
+        bits = pieces[piece] & from_mask
+
+        while bits:
+            from_square = bits & -bits
+            bits &= bits - 1
+
+            base = (from_square.bit_length() - 1) | piece << defs.MOVE_PIECE_SHIFT
+
+            valid_moves = generate_piece_moves(state, color, piece, from_square)
+
+            if piece == defs.PAWN:
+                if valid_moves & en_passant:
+                    valid_moves ^= en_passant
+                    if kind & CAPTURES \
+                        and _en_passant_legal(state, color, from_square, king_idx, checkers, check_mask):
+                        append(base | (en_passant.bit_length() - 1) << defs.MOVE_TO_SHIFT \
+                               | defs.PAWN << defs.MOVE_CAPTURE_SHIFT | defs.MOVE_EN_PASSANT)
+                valid_moves &= pawn_target_mask
+            else:
+                valid_moves &= target_mask
+
+            valid_moves &= check_mask
+            if from_square & pinned:
+                valid_moves &= pin_rays[from_square]
+
+            while valid_moves:
+                to_square = valid_moves & -valid_moves
+                valid_moves &= valid_moves - 1
+
+                move = base | (to_square.bit_length() - 1) << defs.MOVE_TO_SHIFT
+
+                if to_square & occupied_opponent:
+                    for capture in xrange(defs.KING):
+                        if to_square & pieces_opponent[capture]:
+                            break
+                    move |= capture << defs.MOVE_CAPTURE_SHIFT
+                else:
+                    move |= defs.NO_PIECE << defs.MOVE_CAPTURE_SHIFT
+
+                if piece == defs.PAWN:
+                    if to_square & promotion_rank:
+                        for promotion in xrange(defs.KNIGHT, defs.KING):
+                            append(move | promotion << defs.MOVE_PROMOTION_SHIFT)
+                        continue
+
+                    if to_square == from_square << 16 or to_square == from_square >> 16:
+                        move |= defs.MOVE_DOUBLE_PUSH
+
+                append(move)
+
+    return moves
+
+def count_legal_moves(state):
+    """Returns the number of legal moves in a position, without generating them.
+
+       Uses the same checks and pins as generate_legal_moves, but pop-counts the destination
+       bitboard of every piece instead of making moves out of them. This is what perft needs
+       at depth 1.
+    """
+    color = state.turn
+    pieces = state.pieces[color]
+    en_passant = state.en_passant
+    promotion_rank = cache.promotion_rank[color]
+
+    king = pieces[defs.KING]
+    king_idx = king.bit_length() - 1
+
+    count = bin(_legal_king_targets(state, color, king, king_idx)).count('1')
+
+    checkers, check_mask, pinned, pin_rays = _checks_and_pins(state, color, king_idx)
+
+    if checkers:
+        if checkers & (checkers - 1):
+            return count
+    else:
+        castles = generate_piece_moves(state, color, defs.KING, king) & (king << 2 | king >> 2)
+        count += bin(castles).count('1')
+
+    for piece in xrange(defs.KING):
+        bits = pieces[piece]
+
+        while bits:
+            from_square = bits & -bits
+            bits &= bits - 1
+
+            valid_moves = generate_piece_moves(state, color, piece, from_square)
+
+            if piece == defs.PAWN:
+                if valid_moves & en_passant:
+                    valid_moves ^= en_passant
+                    if _en_passant_legal(state, color, from_square, king_idx, checkers, check_mask):
+                        count += 1
+
+                valid_moves &= check_mask
+                if from_square & pinned:
+                    valid_moves &= pin_rays[from_square]
+
+                # Every promotion is four moves.
+                if valid_moves & promotion_rank:
+                    count += 3 * bin(valid_moves & promotion_rank).count('1')
+            else:
+                valid_moves &= check_mask
+                if from_square & pinned:
+                    valid_moves &= pin_rays[from_square]
+
+            if valid_moves:
+                count += bin(valid_moves).count('1')
+
+    return count
+
 def generate_piece_moves(state, color, piece, from_square):
     """Returns a 64bit int containing the valid moves/captures of one specific piece in a position
     
@@ -88,37 +520,37 @@ def generate_piece_moves(state, color, piece, from_square):
     occupied = state.occupied
     pieces = state.pieces
 
+    # The cache tables are indexed by square index, which is cheaper than looking up the bit.
+    from_idx = from_square.bit_length() - 1
+
     if piece == defs.PAWN:
         # First, we check if a one-step move is available, and if so,
         # we set valid_moves to two steps forwards (since we know
         # that the first step wasn't blocked by a piece).
-        valid_moves = cache.moves_pawn_one[color][from_square] \
+        valid_moves = cache.moves_pawn_one_idx[color][from_idx] \
                 & ~occupied[defs.BOTH]
 
         if valid_moves:
-            valid_moves = cache.moves_pawn_two[color][from_square] \
+            valid_moves = cache.moves_pawn_two_idx[color][from_idx] \
                 & ~occupied[defs.BOTH]
 
-        valid_moves |= cache.attacks_pawn[color][from_square] \
-            & state.en_passant
-
         # Check the attack-pattern against opponents and/or en passant availablility.
-        valid_moves |= cache.attacks_pawn[color][from_square] \
-            & occupied[opponent]
+        valid_moves |= cache.attacks_pawn_idx[color][from_idx] \
+            & (occupied[opponent] | state.en_passant)
 
     elif piece == defs.KNIGHT:
-        valid_moves = cache.moves_knight[from_square] \
+        valid_moves = cache.moves_knight_idx[from_idx] \
             & ~occupied[color]
 
     elif piece == defs.KING:
-        valid_moves = cache.moves_king[from_square] \
+        valid_moves = cache.moves_king_idx[from_idx] \
             & ~occupied[color]
 
         # We need to first check if the path is free and that castling is available in that direction.
         # Then we need to see if the king or any of the "stepping" squares
         # (F1 and G1 for white king side castle, for instance) are being attacked.
 
-        left_castle = cache.castling_availability[color][0][from_square]
+        left_castle = cache.castling_availability_idx[color][0][from_idx]
         if left_castle & state.castling:
             steps = cache.castling_steps[color][0]
             move_steps = steps | left_castle << 1
@@ -126,113 +558,339 @@ def generate_piece_moves(state, color, piece, from_square):
                 and not is_attacked(state, steps | from_square, opponent):
                 valid_moves |= left_castle << 2
 
-        right_castle = cache.castling_availability[color][1][from_square]
+        right_castle = cache.castling_availability_idx[color][1][from_idx]
         if right_castle & state.castling:
             steps = cache.castling_steps[color][1]
             if (not steps & occupied[defs.BOTH]) \
                 and not is_attacked(state, steps | from_square, opponent):
                 valid_moves |= right_castle >> 1
     else:
-        # TODO: Needs more rotated or magic or something bitboards!
-        directions = cache.directions
+        # Magic bitboards; see moggio.cache for how the tables are built.
         occupied_both = occupied[defs.BOTH]
 
-        if piece == defs.BISHOP or piece == defs.QUEEN:
-            nw_moves = directions[defs.NW][from_square] & occupied_both
-            nw_moves = (nw_moves << 7) | (nw_moves << 14) \
-                        | (nw_moves << 21) | (nw_moves << 28) \
-                        | (nw_moves << 35) | (nw_moves << 42)
-            nw_moves &= directions[defs.NW][from_square]
-            nw_moves ^= directions[defs.NW][from_square]
-
-            ne_moves = directions[defs.NE][from_square] & occupied_both
-            ne_moves = (ne_moves << 9) | (ne_moves << 18) \
-                        | (ne_moves << 27) | (ne_moves << 36) \
-                        | (ne_moves << 45) | (ne_moves << 54)
-            ne_moves &= directions[defs.NE][from_square]
-            ne_moves ^= directions[defs.NE][from_square]
-
-            se_moves = directions[defs.SE][from_square] & occupied_both
-            se_moves = (se_moves >> 7) | (se_moves >> 14) \
-                        | (se_moves >> 21) | (se_moves >> 28) \
-                        | (se_moves >> 35) | (se_moves >> 42)
-            se_moves &= directions[defs.SE][from_square]
-            se_moves ^= directions[defs.SE][from_square]
-
-            sw_moves = directions[defs.SW][from_square] & occupied_both
-            sw_moves = (sw_moves >> 9) | (sw_moves >> 18) \
-                        | (sw_moves >> 27) | (sw_moves >> 36) \
-                        | (sw_moves >> 45) | (sw_moves >> 54)
-            sw_moves &= directions[defs.SW][from_square]
-            sw_moves ^= directions[defs.SW][from_square]
-
-            valid_moves |= (nw_moves | ne_moves | se_moves | sw_moves) \
-                & ~occupied[color]
-
-        if piece == defs.ROOK or piece == defs.QUEEN:
-            right_moves = directions[defs.EAST][from_square] & occupied_both
-            right_moves = (right_moves << 1) | (right_moves << 2) \
-                        | (right_moves << 3) | (right_moves << 4) \
-                        | (right_moves << 5) | (right_moves << 6)
-            right_moves &= directions[defs.EAST][from_square]
-            right_moves ^= directions[defs.EAST][from_square]
-
-            left_moves = directions[defs.WEST][from_square] & occupied_both
-            left_moves = (left_moves >> 1) | (left_moves >> 2) \
-                        | (left_moves >> 3) | (left_moves >> 4) \
-                        | (left_moves >> 5) | (left_moves >> 6)
-            left_moves &= directions[defs.WEST][from_square]
-            left_moves ^= directions[defs.WEST][from_square]
-
-            up_moves = directions[defs.NORTH][from_square] & occupied_both
-            up_moves = (up_moves << 8) | (up_moves << 16) \
-                        | (up_moves << 24) | (up_moves << 32) \
-                        | (up_moves << 40) | (up_moves << 48)
-            up_moves &= directions[defs.NORTH][from_square]
-            up_moves ^= directions[defs.NORTH][from_square]
-
-            down_moves = directions[defs.SOUTH][from_square] & occupied_both
-            down_moves = (down_moves >> 8) | (down_moves >> 16) \
-                        | (down_moves >> 24) | (down_moves >> 32) \
-                        | (down_moves >> 40) | (down_moves >> 48)
-            down_moves &= directions[defs.SOUTH][from_square]
-            down_moves ^= directions[defs.SOUTH][from_square]
-
-            valid_moves |= (right_moves | left_moves | up_moves | down_moves) \
-                & ~occupied[color]
+        if piece != defs.ROOK:
+            mask, magic, shift, attacks = cache.magic_bishop_idx[from_idx]
+            valid_moves = attacks[((occupied_both & mask) * magic & cache.MASK_64) >> shift]
+
+        if piece != defs.BISHOP:
+            mask, magic, shift, attacks = cache.magic_rook_idx[from_idx]
+            valid_moves |= attacks[((occupied_both & mask) * magic & cache.MASK_64) >> shift]
+
+        valid_moves &= ~occupied[color]
 
     return valid_moves
 
 
+def slider_attacks_reference(occupied_both, piece, from_square):
+    """Returns a 64bit int containing the squares a bishop, rook or queen attacks from a square.
+
+       The first blocker in each direction is included, regardless of its color. This is
+       the old shift-and-mask ray fill, which is much slower than the magic bitboards used
+       by generate_piece_moves. It is kept as a reference implementation for cross-checking.
+    """
+    valid_moves = 0
+    directions = cache.directions
+
+    if piece == defs.BISHOP or piece == defs.QUEEN:
+        nw_moves = directions[defs.NW][from_square] & occupied_both
+        nw_moves = (nw_moves << 7) | (nw_moves << 14) \
+                    | (nw_moves << 21) | (nw_moves << 28) \
+                    | (nw_moves << 35) | (nw_moves << 42)
+        nw_moves &= directions[defs.NW][from_square]
+        nw_moves ^= directions[defs.NW][from_square]
+
+        ne_moves = directions[defs.NE][from_square] & occupied_both
+        ne_moves = (ne_moves << 9) | (ne_moves << 18) \
+                    | (ne_moves << 27) | (ne_moves << 36) \
+                    | (ne_moves << 45) | (ne_moves << 54)
+        ne_moves &= directions[defs.NE][from_square]
+        ne_moves ^= directions[defs.NE][from_square]
+
+        se_moves = directions[defs.SE][from_square] & occupied_both
+        se_moves = (se_moves >> 7) | (se_moves >> 14) \
+                    | (se_moves >> 21) | (se_moves >> 28) \
+                    | (se_moves >> 35) | (se_moves >> 42)
+        se_moves &= directions[defs.SE][from_square]
+        se_moves ^= directions[defs.SE][from_square]
+
+        sw_moves = directions[defs.SW][from_square] & occupied_both
+        sw_moves = (sw_moves >> 9) | (sw_moves >> 18) \
+                    | (sw_moves >> 27) | (sw_moves >> 36) \
+                    | (sw_moves >> 45) | (sw_moves >> 54)
+        sw_moves &= directions[defs.SW][from_square]
+        sw_moves ^= directions[defs.SW][from_square]
+
+        valid_moves |= nw_moves | ne_moves | se_moves | sw_moves
+
+    if piece == defs.ROOK or piece == defs.QUEEN:
+        right_moves = directions[defs.EAST][from_square] & occupied_both
+        right_moves = (right_moves << 1) | (right_moves << 2) \
+                    | (right_moves << 3) | (right_moves << 4) \
+                    | (right_moves << 5) | (right_moves << 6)
+        right_moves &= directions[defs.EAST][from_square]
+        right_moves ^= directions[defs.EAST][from_square]
+
+        left_moves = directions[defs.WEST][from_square] & occupied_both
+        left_moves = (left_moves >> 1) | (left_moves >> 2) \
+                    | (left_moves >> 3) | (left_moves >> 4) \
+                    | (left_moves >> 5) | (left_moves >> 6)
+        left_moves &= directions[defs.WEST][from_square]
+        left_moves ^= directions[defs.WEST][from_square]
+
+        up_moves = directions[defs.NORTH][from_square] & occupied_both
+        up_moves = (up_moves << 8) | (up_moves << 16) \
+                    | (up_moves << 24) | (up_moves << 32) \
+                    | (up_moves << 40) | (up_moves << 48)
+        up_moves &= directions[defs.NORTH][from_square]
+        up_moves ^= directions[defs.NORTH][from_square]
+
+        down_moves = directions[defs.SOUTH][from_square] & occupied_both
+        down_moves = (down_moves >> 8) | (down_moves >> 16) \
+                    | (down_moves >> 24) | (down_moves >> 32) \
+                    | (down_moves >> 40) | (down_moves >> 48)
+        down_moves &= directions[defs.SOUTH][from_square]
+        down_moves ^= directions[defs.SOUTH][from_square]
+
+        valid_moves |= right_moves | left_moves | up_moves | down_moves
+
+    return valid_moves
+
+def generate_piece_moves_reference(state, color, piece, from_square):
+    """Same as generate_piece_moves, but uses slider_attacks_reference for bishops, rooks and queens."""
+    if piece == defs.BISHOP or piece == defs.ROOK or piece == defs.QUEEN:
+        return slider_attacks_reference(state.occupied[defs.BOTH], piece, from_square) \
+            & ~state.occupied[color]
+
+    return _generate_piece_moves_magic(state, color, piece, from_square)
+
+
+def bishop_attacks(occupied, square_idx):
+    """Returns the squares a bishop on square_idx attacks, given the occupied squares.
+
+       The first blocker in each direction is included, regardless of its color.
+    """
+    mask, magic, shift, attacks = cache.magic_bishop_idx[square_idx]
+    return attacks[((occupied & mask) * magic & cache.MASK_64) >> shift]
+
+def rook_attacks(occupied, square_idx):
+    """Returns the squares a rook on square_idx attacks, given the occupied squares.
+
+       The first blocker in each direction is included, regardless of its color.
+    """
+    mask, magic, shift, attacks = cache.magic_rook_idx[square_idx]
+    return attacks[((occupied & mask) * magic & cache.MASK_64) >> shift]
+
+def attackers_by(state, square_idx, attacker, occupied):
+    """Returns a 64bit int with the pieces of attacker that attack a square.
+
+       Sliders are blocked by the squares in occupied, which doesn't have to be the actual
+       occupancy of the state.
+    """
+    pieces = state.pieces[attacker]
+
+    return (cache.attacked_by_pawn_idx[attacker][square_idx] & pieces[defs.PAWN]) \
+        | (cache.moves_knight_idx[square_idx] & pieces[defs.KNIGHT]) \
+        | (cache.moves_king_idx[square_idx] & pieces[defs.KING]) \
+        | (bishop_attacks(occupied, square_idx) & (pieces[defs.BISHOP] | pieces[defs.QUEEN])) \
+        | (rook_attacks(occupied, square_idx) & (pieces[defs.ROOK] | pieces[defs.QUEEN]))
+
+def square_attacked(state, square_idx, attacker, occupied):
+    """Checks if a square is attacked by attacker, with sliders blocked by occupied.
+
+       Returns True or False.
+    """
+    pieces = state.pieces[attacker]
+
+    return bool((cache.attacked_by_pawn_idx[attacker][square_idx] & pieces[defs.PAWN])
+        or (cache.moves_knight_idx[square_idx] & pieces[defs.KNIGHT])
+        or (cache.moves_king_idx[square_idx] & pieces[defs.KING])
+        or (bishop_attacks(occupied, square_idx) & (pieces[defs.BISHOP] | pieces[defs.QUEEN]))
+        or (rook_attacks(occupied, square_idx) & (pieces[defs.ROOK] | pieces[defs.QUEEN])))
+
+def attackers_to(state, square_idx, occupied):
+    """Returns a 64bit int with the pieces of both colors that attack a square.
+
+       Sliders are blocked by the squares in occupied, and pieces that aren't in occupied
+       are left out, so that pieces can be taken off the board without changing the state.
+    """
+    white = state.pieces[defs.WHITE]
+    black = state.pieces[defs.BLACK]
+
+    return ((cache.attacked_by_pawn_idx[defs.WHITE][square_idx] & white[defs.PAWN])
+        | (cache.attacked_by_pawn_idx[defs.BLACK][square_idx] & black[defs.PAWN])
+        | (cache.moves_knight_idx[square_idx] & (white[defs.KNIGHT] | black[defs.KNIGHT]))
+        | (cache.moves_king_idx[square_idx] & (white[defs.KING] | black[defs.KING]))
+        | (bishop_attacks(occupied, square_idx)
+            & (white[defs.BISHOP] | white[defs.QUEEN] | black[defs.BISHOP] | black[defs.QUEEN]))
+        | (rook_attacks(occupied, square_idx)
+            & (white[defs.ROOK] | white[defs.QUEEN] | black[defs.ROOK] | black[defs.QUEEN]))) \
+        & occupied
+
+# Piece values used by see(). The king is worth more than everything else together, so
+# that capturing with it is never done into a defended square.
+see_values = (100, 325, 325, 500, 975, 20000)
+
+def see(state, move):
+    """Static exchange evaluation of a packed move.
+
+       Plays out the captures on the destination square of move, with each side always
+       capturing with its least valuable piece and stopping when that is better for it.
+       Sliders behind other pieces (x-rays) join in as the pieces in front of them capture.
+       Pins and checks are ignored.
+
+       Returns what the side to move wins (or loses, if negative) in see_values.
+    """
+    to_idx = move >> defs.MOVE_TO_SHIFT & 0x3f
+    piece = move >> defs.MOVE_PIECE_SHIFT & 7
+    capture = move >> defs.MOVE_CAPTURE_SHIFT & 7
+    promotion = move >> defs.MOVE_PROMOTION_SHIFT & 7
+
+    if move & defs.MOVE_CASTLE:
+        return 0
+
+    occupied = state.occupied[defs.BOTH] ^ (1 << (move & 0x3f))
+
+    gain = [see_values[capture] if capture != defs.NO_PIECE else 0]
+    if move & defs.MOVE_EN_PASSANT:
+        # The captured pawn isn't on the destination square.
+        occupied ^= 1 << (to_idx - 8 if state.turn == defs.WHITE else to_idx + 8)
+    if promotion:
+        gain[0] += see_values[promotion] - see_values[defs.PAWN]
+        piece = promotion
+
+    pieces = state.pieces
+    bishops_and_queens = pieces[defs.WHITE][defs.BISHOP] | pieces[defs.BLACK][defs.BISHOP] \
+        | pieces[defs.WHITE][defs.QUEEN] | pieces[defs.BLACK][defs.QUEEN]
+    rooks_and_queens = pieces[defs.WHITE][defs.ROOK] | pieces[defs.BLACK][defs.ROOK] \
+        | pieces[defs.WHITE][defs.QUEEN] | pieces[defs.BLACK][defs.QUEEN]
+
+    attackers = attackers_to(state, to_idx, occupied)
+    color = 1 - state.turn
+
+    # Build the swap list; gain[n] is what the side making capture n wins if the
+    # exchange stops after it.
+    while True:
+        color_attackers = attackers & state.occupied[color]
+        if not color_attackers:
+            break
+
+        for attacker in xrange(defs.KING + 1):
+            from_squares = color_attackers & pieces[color][attacker]
+            if from_squares:
+                break
+
+        gain.append(see_values[piece] - gain[-1])
+        # The side before is better off than this side whatever happens next, so this
+        # capture won't be made and the rest doesn't matter.
+        if max(-gain[-2], gain[-1]) < 0:
+            gain.pop()
+            break
+
+        piece = attacker
+        occupied ^= from_squares & -from_squares
+
+        # Uncover the sliders behind the piece that captured.
+        if attacker == defs.PAWN or attacker == defs.BISHOP or attacker == defs.QUEEN:
+            attackers |= bishop_attacks(occupied, to_idx) & bishops_and_queens
+        if attacker == defs.ROOK or attacker == defs.QUEEN:
+            attackers |= rook_attacks(occupied, to_idx) & rooks_and_queens
+        attackers &= occupied
+
+        color = 1 - color
+
+    # Each side can choose to not make its capture.
+    for n in xrange(len(gain) - 1, 0, -1):
+        gain[n - 1] = -max(-gain[n - 1], gain[n])
+
+    return gain[0]
+
 def is_attacked(state, squares, attacker):
     """Checks if a set of squares are currently attacked by an attackers pieces
     
        Returns True or False.
     """
-    defender = 1 - attacker
     attacker_pieces = state.pieces[attacker]
+    occupied = state.occupied[defs.BOTH]
+
+    pawns = attacker_pieces[defs.PAWN]
+    knights = attacker_pieces[defs.KNIGHT]
+    king = attacker_pieces[defs.KING]
+    diagonal = attacker_pieces[defs.BISHOP] | attacker_pieces[defs.QUEEN]
+    straight = attacker_pieces[defs.ROOK] | attacker_pieces[defs.QUEEN]
+
+    attacked_by_pawn = cache.attacked_by_pawn_idx[attacker]
+    directions = cache.directions_idx
 
     while squares:
         square = squares & -squares
         squares &= squares - 1
+        square_idx = square.bit_length() - 1
 
         # Checking whether a pawn, knight or a king is attacking a square by using
         # bitwise and on the squares they can possibly attack from.
-        if attacker_pieces[defs.PAWN] & cache.attacked_by_pawn[attacker][square]:
+        if pawns & attacked_by_pawn[square_idx]:
             return True
 
-        if attacker_pieces[defs.KNIGHT] & cache.moves_knight[square]:
+        if knights & cache.moves_knight_idx[square_idx]:
             return True
 
-        if attacker_pieces[defs.KING] & cache.moves_king[square]:
+        if king & cache.moves_king_idx[square_idx]:
             return True
 
-        # TODO:
-        # This can be much faster if we check every direction (4 for bishop, 4 for rooks),
-        # and see if the direction from that square hits bishop_and_queen / rook_and_queen.
-        # We need to alternate between using the highest and the lowest bit to bitwise and
-        # both rook and bishop moves.
-        # http://www.talkchess.com/forum/viewtopic.php?t=30356
+        # Look along every ray from the square for the nearest piece, and see if it's a
+        # slider that moves along that ray. On the rays going up the board (or to the
+        # right), the nearest piece is the lowest bit; on the others it's the highest.
+        if diagonal:
+            for direction in _up_diagonals:
+                blockers = directions[direction][square_idx] & occupied
+                if blockers & -blockers & diagonal:
+                    return True
+            for direction in _down_diagonals:
+                blockers = directions[direction][square_idx] & occupied
+                if blockers and (1 << (blockers.bit_length() - 1)) & diagonal:
+                    return True
+
+        if straight:
+            blockers = directions[defs.NORTH][square_idx] & occupied
+            if blockers & -blockers & straight:
+                return True
+            blockers = directions[defs.EAST][square_idx] & occupied
+            if blockers & -blockers & straight:
+                return True
+            blockers = directions[defs.SOUTH][square_idx] & occupied
+            if blockers and (1 << (blockers.bit_length() - 1)) & straight:
+                return True
+            blockers = directions[defs.WEST][square_idx] & occupied
+            if blockers and (1 << (blockers.bit_length() - 1)) & straight:
+                return True
+
+    return False
+
+_up_diagonals = (defs.NE, defs.NW)
+_down_diagonals = (defs.SE, defs.SW)
+
+def is_attacked_reference(state, squares, attacker):
+    """The previous implementation of is_attacked, which generates bishop and rook moves from
+       the squares. Kept for testing is_attacked against; see moggio.test.check_is_attacked.
+    """
+    defender = 1 - attacker
+    attacker_pieces = state.pieces[attacker]
+
+    while squares:
+        square = squares & -squares
+        squares &= squares - 1
+        square_idx = square.bit_length() - 1
+
+        # Checking whether a pawn, knight or a king is attacking a square by using
+        # bitwise and on the squares they can possibly attack from.
+        if attacker_pieces[defs.PAWN] & cache.attacked_by_pawn_idx[attacker][square_idx]:
+            return True
+
+        if attacker_pieces[defs.KNIGHT] & cache.moves_knight_idx[square_idx]:
+            return True
+
+        if attacker_pieces[defs.KING] & cache.moves_king_idx[square_idx]:
+            return True
 
         # Pretend to generate moves from the defenders POV, and see if the valid moves fits with
         # a black bishop, rook or queen on the board.
@@ -245,3 +903,10 @@ def is_attacked(state, squares, attacker):
             return True
 
     return False
+
+# generate_piece_moves_reference needs the magic version for the other pieces, even when
+# generate_piece_moves has been replaced by the reference implementation for testing.
+_generate_piece_moves_magic = generate_piece_moves
+
+# moggio.test swaps is_attacked for is_attacked_reference when comparing them.
+_is_attacked_rays = is_attacked
@@ -0,0 +1,145 @@
+"""Staged move generation and ordering for the search."""
+
+import moggio.defines as defs
+import moggio.move
+
+# The stages of a MovePicker, in order.
+HASH_MOVE = 0
+GENERATE_CAPTURES = 1
+CAPTURES = 2
+KILLERS = 3
+QUIETS = 4
+BAD_CAPTURES = 5
+DONE = 6
+
+# Piece values used for MVV-LVA ordering; indexed by piece, with NO_PIECE (a promotion
+# that isn't a capture) last.
+_victim_values = (1, 3, 3, 5, 9, 0, 0, 0)
+_promotion_values = (0, 0, 0, 0, 9, 0, 0, 0)
+# moggio.move.see_values, with 0 for NO_PIECE (so that promotions without capture count as
+# capturing nothing).
+_see_values = moggio.move.see_values + (0, 0)
+
+def mvv_lva(move):
+    """Returns the ordering score of a capture or promotion: Most Valuable Victim, Least Valuable Attacker."""
+    return (_victim_values[move >> defs.MOVE_CAPTURE_SHIFT & 7]
+            + _promotion_values[move >> defs.MOVE_PROMOTION_SHIFT & 7]) * 8 \
+        - (move >> defs.MOVE_PIECE_SHIFT & 7)
+
+class MovePicker:
+
+    """Hands out the legal moves of a position one at a time, in the order a search wants them.
+
+        The order is the hash move, the captures (and promotions) by MVV-LVA, the killer
+        moves, the quiet moves by history score, and last the captures that lose material
+        according to static exchange evaluation. A stage is only generated when the
+        previous one has been used up, so a search that cuts off early doesn't pay for the
+        rest.
+
+        A search keeps one MovePicker per ply and calls reset() on it for every node, so that
+        the move lists are reused.
+
+        This class has the variables:
+        generated   - Number of moves generated since the last reset().
+    """
+
+    def __init__(self, history=None):
+        """history is a list of 4096 scores indexed by (move & 0xfff), i.e. from and to square."""
+        self.history = history
+        self.captures = []
+        self.quiets = []
+        self.bad_captures = []
+        self.stage = DONE
+        self.generated = 0
+
+    def reset(self, state, hash_move=0, killers=()):
+        """Prepares for handing out the moves of a new position."""
+        self.state = state
+        self.hash_move = hash_move
+        self.killers = killers
+        self.checks = moggio.move.checks_and_pins(state)
+        self.stage = HASH_MOVE
+        self.index = 0
+        self.generated = 0
+        del self.bad_captures[:]
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        """Returns the next move, or raises StopIteration when there are no more moves."""
+        while True:
+            stage = self.stage
+
+            if stage == CAPTURES:
+                if self.index < len(self.captures):
+                    move = self.captures[self.index]
+                    self.index += 1
+                    if move == self.hash_move:
+                        continue
+                    # Capturing a piece worth at least as much as the capturer can't lose.
+                    if _see_values[move >> defs.MOVE_PIECE_SHIFT & 7] \
+                        > _see_values[move >> defs.MOVE_CAPTURE_SHIFT & 7] \
+                        and moggio.move.see(self.state, move) < 0:
+                        self.bad_captures.append(move)
+                        continue
+                    return move
+
+                self.stage = KILLERS
+                self.index = 0
+
+            elif stage == QUIETS:
+                if self.index < len(self.quiets):
+                    move = self.quiets[self.index]
+                    self.index += 1
+                    if move != self.hash_move and move not in self.killers:
+                        return move
+                    continue
+
+                self.stage = BAD_CAPTURES
+                self.index = 0
+
+            elif stage == BAD_CAPTURES:
+                if self.index < len(self.bad_captures):
+                    move = self.bad_captures[self.index]
+                    self.index += 1
+                    return move
+
+                self.stage = DONE
+
+            elif stage == HASH_MOVE:
+                # Nothing is generated before the hash move, since it often causes a cutoff.
+                self.stage = GENERATE_CAPTURES
+                hash_move = self.hash_move
+                if hash_move and moggio.move.is_legal_move(self.state, hash_move, self.checks):
+                    return hash_move
+                self.hash_move = 0
+
+            elif stage == GENERATE_CAPTURES:
+                self.stage = CAPTURES
+                moggio.move.generate_legal_moves(self.state, self.captures, moggio.move.CAPTURES, self.checks)
+                self.captures.sort(key=mvv_lva, reverse=True)
+                self.generated += len(self.captures)
+
+            elif stage == KILLERS:
+                # Killers are quiet moves that caused a cutoff in a sibling node.
+                if self.index < len(self.killers):
+                    move = self.killers[self.index]
+                    self.index += 1
+                    if move and move != self.hash_move \
+                        and move >> defs.MOVE_CAPTURE_SHIFT & 7 == defs.NO_PIECE \
+                        and not move >> defs.MOVE_PROMOTION_SHIFT & 7 \
+                        and moggio.move.is_legal_move(self.state, move, self.checks):
+                        return move
+                    continue
+
+                self.stage = QUIETS
+                self.index = 0
+                moggio.move.generate_legal_moves(self.state, self.quiets, moggio.move.QUIETS, self.checks)
+                if self.history:
+                    history = self.history
+                    self.quiets.sort(key=lambda move: history[move & 0xfff], reverse=True)
+                self.generated += len(self.quiets)
+
+            else:
+                raise StopIteration
@@ -0,0 +1,331 @@
+"""Reading games from PGN files, and replaying their moves.
+
+   A PGN file is a sequence of games, each with a tag section ([Event "..."] and so on)
+   followed by movetext: the moves in SAN (Standard Algebraic Notation, like Nbd7, exd8=Q+
+   or O-O-O) with move numbers, and the result. The movetext may also have comments
+   ({...} or ; to the end of the line), variations ((...), which may be nested) and
+   numeric annotations ($1), which are all skipped.
+
+   Games are read one at a time as they are needed, so files of any size can be read:
+
+       for game in read_games(handle):
+           for state, move in replay(game):
+               ...
+"""
+
+import re
+import time
+
+import moggio.cache as cache
+import moggio.defines as defs
+import moggio.move
+import moggio.state
+import moggio.util as util
+
+RESULTS = ('1-0', '0-1', '1/2-1/2', '*')
+
+_TAG = re.compile(r'\[\s*(\w+)\s+"((?:[^"\\]|\\.)*)"\s*\]')
+# Comment and variation delimiters, numeric annotations, and everything else up to them.
+_TOKEN = re.compile(r'[{}();]|\$\d+|[^\s{}();$]+')
+# A move number in front of a move, like 12. or 12... (but not the 0 of 0-0).
+_MOVE_NUMBER = re.compile(r'\d+\.+')
+_SAN = re.compile(r'([NBRQK])?([a-h])?([1-8])?x?([a-h][1-8])(?:=?([NBRQ]))?[+#]?[!?]*$')
+
+_san_pieces = {'N': defs.KNIGHT, 'B': defs.BISHOP, 'R': defs.ROOK, 'Q': defs.QUEEN, 'K': defs.KING}
+
+class Game:
+
+    """A game read from a PGN file.
+
+        This class has the variables:
+        tags        - Dictionary of the tags, like tags['White'].
+        moves       - The moves of the game as SAN strings, without move numbers,
+                      comments and variations.
+        result      - The result at the end of the movetext, or the Result tag if there
+                      wasn't one, or '*'.
+    """
+
+    def __init__(self):
+        self.tags = {}
+        self.moves = []
+        self.result = None
+
+    def fen(self):
+        """Returns the FEN of the starting position."""
+        return self.tags.get('FEN', defs.FEN_INIT)
+
+def read_games(handle):
+    """Yields a Game for every game in a file object.
+
+       A game ends with its result, or where the tag section of the next game starts.
+    """
+    game = None
+    # Nesting level of variations, and whether a {...} comment continues from the last line.
+    variations = 0
+    comment = False
+
+    for line in handle:
+        if not comment:
+            stripped = line.strip()
+            if stripped.startswith('\xef\xbb\xbf'):
+                # A UTF-8 byte order mark.
+                stripped = stripped[3:]
+            if not stripped or stripped[0] == '%':
+                continue
+
+            if stripped[0] == '[' and not variations:
+                if game is not None and (game.moves or game.result):
+                    yield _finish(game)
+                    game = None
+                if game is None:
+                    game = Game()
+                match = _TAG.match(stripped)
+                if match:
+                    game.tags[match.group(1)] = match.group(2).replace('\\"', '"').replace('\\\\', '\\')
+                continue
+
+        if game is None:
+            game = Game()
+
+        # Most lines are nothing but moves.
+        if not comment and not variations and not _has_markup(line):
+            tokens = line.split()
+        else:
+            tokens = _TOKEN.findall(line)
+
+        moves = game.moves
+        for token in tokens:
+            if comment:
+                if token == '}':
+                    comment = False
+            elif token == '{':
+                comment = True
+            elif token == ';':
+                break
+            elif token == '(':
+                variations += 1
+            elif token == ')':
+                if variations:
+                    variations -= 1
+            elif variations or token[0] in '$!?':
+                continue
+            elif token in RESULTS:
+                game.result = token
+                yield _finish(game)
+                game = None
+                break
+            else:
+                # Move numbers like 12. or 12... may be written without a space before
+                # the move.
+                if token[0].isdigit():
+                    if token.isdigit():
+                        continue
+                    match = _MOVE_NUMBER.match(token)
+                    if match:
+                        token = token[match.end():]
+                        if not token:
+                            continue
+                moves.append(token)
+
+    if game is not None and (game.moves or game.tags):
+        yield _finish(game)
+
+def _has_markup(line):
+    return '{' in line or '(' in line or ';' in line or '$' in line
+
+def _finish(game):
+    if game.result is None:
+        game.result = game.tags.get('Result', '*')
+    return game
+
+def san_to_move(state, san):
+    """Returns the packed move written as san in a position.
+
+       The candidates for the move are found from the destination bitboards of
+       moggio.move.generate_piece_moves, for the pieces of the right kind on the file and
+       rank given in the SAN. Those can still leave the king in check, so the candidates are
+       then masked with the checks and pins of moggio.move.checks_and_pins, like
+       generate_legal_moves does (king moves and en passant go through is_legal_move, and
+       only the king can move in double check).
+       Raises ValueError if no piece can legally make the move, or if it's ambiguous.
+    """
+    color = state.turn
+    pieces = state.pieces[color]
+
+    if san[0] in 'O0':
+        castle = san.rstrip('+#!?')
+        king = pieces[defs.KING]
+        if castle in ('O-O', '0-0'):
+            to_square = king << 2
+        elif castle in ('O-O-O', '0-0-0'):
+            to_square = king >> 2
+        else:
+            raise ValueError("Invalid SAN: '%s'" % san)
+
+        if not moggio.move.generate_piece_moves(state, color, defs.KING, king) & to_square:
+            raise ValueError("Illegal move: '%s'" % san)
+        return moggio.move.pack_move(king.bit_length() - 1, to_square.bit_length() - 1, defs.KING,
+                                     flags=defs.MOVE_CASTLE)
+
+    match = _SAN.match(san)
+    if not match:
+        raise ValueError("Invalid SAN: '%s'" % san)
+    piece_char, file_char, rank_char, to_chars, promotion_char = match.groups()
+
+    piece = _san_pieces[piece_char] if piece_char else defs.PAWN
+    to_idx = (ord(to_chars[0]) - ord('a')) + (ord(to_chars[1]) - ord('1')) * 8
+    to_square = 1 << to_idx
+
+    from_mask = pieces[piece]
+    if file_char:
+        from_mask &= cache.file_masks[ord(file_char) - ord('a')]
+    elif piece == defs.PAWN:
+        # Pawns without a file in front only move straight ahead.
+        from_mask &= cache.file_masks[to_idx & 7]
+    if rank_char:
+        from_mask &= cache.rank_masks[ord(rank_char) - ord('1')]
+
+    candidates = []
+    while from_mask:
+        from_square = from_mask & -from_mask
+        from_mask &= from_mask - 1
+        if moggio.move.generate_piece_moves(state, color, piece, from_square) & to_square:
+            candidates.append(from_square.bit_length() - 1)
+
+    promotion = promotion_char and _san_pieces[promotion_char]
+    if piece == defs.PAWN and bool(promotion) != bool(to_square & cache.promotion_rank[color]):
+        raise ValueError("Invalid promotion: '%s'" % san)
+
+    moves = [_pack(state, from_idx, to_idx, piece, promotion) for from_idx in candidates]
+    if moves:
+        checks = moggio.move.checks_and_pins(state)
+        if piece == defs.KING or (piece == defs.PAWN and to_square == state.en_passant):
+            moves = [move for move in moves if moggio.move.is_legal_move(state, move, checks)]
+        else:
+            # The same masks generate_legal_moves applies to the moves of the other pieces.
+            checkers, check_mask, pinned, pin_rays = checks
+            # In double check, only the king can move.
+            if not checkers & (checkers - 1) and to_square & check_mask:
+                moves = [move for move, from_idx in zip(moves, candidates)
+                         if not pinned & (1 << from_idx) or to_square & pin_rays[1 << from_idx]]
+            else:
+                moves = []
+
+    if not moves:
+        raise ValueError("Illegal move: '%s'" % san)
+    if len(moves) > 1:
+        raise ValueError("Ambiguous move: '%s'" % san)
+    return moves[0]
+
+def _pack(state, from_idx, to_idx, piece, promotion):
+    """Packs a move with the captured piece and the flags that generate_legal_moves would set."""
+    to_square = 1 << to_idx
+    opponent_pieces = state.pieces[1 - state.turn]
+    flags = 0
+
+    capture = None
+    if to_square & state.occupied[1 - state.turn]:
+        for capture in xrange(defs.KING):
+            if to_square & opponent_pieces[capture]:
+                break
+    elif piece == defs.PAWN:
+        if to_square == state.en_passant:
+            capture = defs.PAWN
+            flags = defs.MOVE_EN_PASSANT
+        elif abs(to_idx - from_idx) == 16:
+            flags = defs.MOVE_DOUBLE_PUSH
+
+    return moggio.move.pack_move(from_idx, to_idx, piece, capture, promotion, flags)
+
+def move_to_san(state, move):
+    """Returns a legal packed move in SAN, as san_to_move reads it (with + and # for checks)."""
+    from_idx = move & 0x3f
+    to_idx = move >> defs.MOVE_TO_SHIFT & 0x3f
+    piece = move >> defs.MOVE_PIECE_SHIFT & 7
+    to_chars = util.square_to_chars(to_idx)
+    is_capture = move >> defs.MOVE_CAPTURE_SHIFT & 7 != defs.NO_PIECE
+
+    if move & defs.MOVE_CASTLE:
+        san = 'O-O' if to_idx > from_idx else 'O-O-O'
+    elif piece == defs.PAWN:
+        san = to_chars
+        if is_capture:
+            san = util.square_to_chars(from_idx)[0] + 'x' + san
+        promotion = move >> defs.MOVE_PROMOTION_SHIFT & 7
+        if promotion:
+            san += '=' + util.piece_to_char(defs.WHITE, promotion)
+    else:
+        # The other pieces of the same kind that can move to the same square.
+        others = [other & 0x3f for other in moggio.move.generate_legal_moves(state, [])
+                  if other >> defs.MOVE_PIECE_SHIFT & 7 == piece
+                  and other >> defs.MOVE_TO_SHIFT & 0x3f == to_idx and other & 0x3f != from_idx]
+
+        from_chars = util.square_to_chars(from_idx)
+        if not others:
+            disambiguation = ''
+        elif all(other & 7 != from_idx & 7 for other in others):
+            disambiguation = from_chars[0]
+        elif all(other >> 3 != from_idx >> 3 for other in others):
+            disambiguation = from_chars[1]
+        else:
+            disambiguation = from_chars
+
+        san = util.piece_to_char(defs.WHITE, piece) + disambiguation + ('x' if is_capture else '') + to_chars
+
+    state.make_move(move)
+    if moggio.move.is_attacked(state, state.pieces[state.turn][defs.KING], 1 - state.turn):
+        san += '#' if not moggio.move.count_legal_moves(state) else '+'
+    state.unmake_move(move)
+
+    return san
+
+def replay(game, state=None):
+    """Yields (state, move) for every move of a game: the position before the move, and the
+       packed move. The move is made when the next pair is asked for.
+
+       If state is given, it is set to the starting position and used instead of making a
+       new State, which is faster when replaying many games.
+       Raises ValueError at the first move that can't be read.
+    """
+    if state is None:
+        state = moggio.state.State(game.fen())
+    else:
+        state.set_fen(game.fen())
+
+    for san in game.moves:
+        move = san_to_move(state, san)
+        yield state, move
+
+        state.make_move(move)
+
+def benchmark(path, repetitions=1):
+    """Reads and replays every game of a PGN file, and prints the games and plies per second.
+
+       Returns (games per second, plies per second).
+    """
+    state = moggio.state.State()
+    games = plies = errors = 0
+    start = time.time()
+
+    for i in xrange(repetitions):
+        handle = open(path, 'r')
+        for game in read_games(handle):
+            games += 1
+            try:
+                for position, move in replay(game, state):
+                    plies += 1
+            except ValueError:
+                errors += 1
+        handle.close()
+    time_spent = max(time.time() - start, 1e-6)
+
+    print "%d games (%d with errors) and %d plies in %.2f seconds: %d games/second, %d plies/second" % \
+        (games, errors, plies, time_spent, games / time_spent, plies / time_spent)
+    return games / time_spent, plies / time_spent
+
+if __name__ == '__main__':
+    # python -m moggio.pgn file.pgn [repetitions] benchmarks reading and replaying a file.
+    import sys
+
+    cache.preprocess()
+    benchmark(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 1)
@@ -0,0 +1,400 @@
+"""Searching for the best move; negamax alpha-beta with iterative deepening and a transposition table.
+
+   At the leaves, a quiescence search resolves captures before the position is evaluated.
+"""
+
+import time
+
+import moggio.defines as defs
+import moggio.evaluate
+import moggio.hashtable as hashtable
+import moggio.kpk
+import moggio.move
+import moggio.movepicker as movepicker
+
+# Score of being mated at the root. Mates further away score closer to 0.
+MATE = 100000
+# Scores above this (or below -MATE_BOUND) are mate scores.
+MATE_BOUND = MATE - defs.MAX_PLY
+
+INFINITY = MATE + 1
+
+# How often (in nodes) the time limit is checked.
+_CHECK_INTERVAL = 1024
+
+# A capture is skipped in the quiescence search when even winning the captured piece plus
+# this margin can't bring the score up to alpha (delta pruning).
+DELTA_MARGIN = 200
+
+# Size of the pawn structure cache. Games have few distinct pawn structures, so it can
+# be small.
+PAWN_HASH_MB = 1
+
+def _print_info(search, depth, score, pv):
+    """The default reporting of a finished iteration."""
+    time_spent = time.time() - search.start_time
+
+    if abs(score) > MATE_BOUND:
+        moves_to_mate = (MATE - abs(score) + 1) / 2
+        score_str = 'mate %d' % (moves_to_mate if score > 0 else -moves_to_mate)
+    else:
+        score_str = 'cp %d' % score
+
+    print "depth %d score %s nodes %d qnodes %d time %d nps %d movegen %.1f pawnhits %.1f pv %s" % (
+        depth, score_str, search.nodes, search.qnodes, time_spent * 1000,
+        search.nodes / max(time_spent, 1e-3),
+        search.generated_per_node(), search.pawn_table.hit_rate() * 100,
+        ' '.join(moggio.move.move_uci(move) for move in pv))
+
+class Search:
+
+    """Searches a position for the best move.
+
+        A Search keeps its transposition table between calls to search(), so it should be
+        reused for consecutive positions of a game.
+
+        This class has the variables:
+        table       - The moggio.hashtable.TranspositionTable.
+        pawn_table  - The moggio.hashtable.PawnTable that the evaluation caches pawn
+                      structure scores in.
+        bitbase     - The moggio.kpk.Bitbase that king and pawn versus king positions
+                      are looked up in, or None.
+        info        - Called with (search, depth, score, pv) after every finished iteration.
+        progress    - Called with (search) every progress_interval seconds while searching,
+                      or None.
+        nodes       - Number of nodes searched by the last call to search(), including
+                      the quiescence nodes.
+        qnodes      - Number of those nodes that were searched by the quiescence search.
+        generated   - Number of moves generated by the last call to search().
+        expanded    - Number of nodes whose moves were generated by the last call to search().
+        killers     - Two quiet moves per ply that recently caused a beta cutoff.
+        history     - Score of every quiet move (indexed by move & 0xfff, i.e. from and to
+                      square), increased whenever it causes a beta cutoff.
+        start_time  - When the last call to search() started.
+        stopped     - Set when the search has been told to stop, or has reached a limit.
+    """
+
+    def __init__(self, hash_mb=16, info=_print_info, progress=None, progress_interval=1.0):
+        self.table = hashtable.TranspositionTable(hash_mb)
+        self.pawn_table = hashtable.PawnTable(PAWN_HASH_MB)
+        self.bitbase = moggio.kpk.shared()
+        self.info = info
+        self.progress = progress
+        self.progress_interval = progress_interval
+        self.nodes = 0
+        self.qnodes = 0
+        self.generated = 0
+        self.expanded = 0
+        self.start_time = 0
+        self.stopped = False
+        self.killers = [[0, 0] for i in xrange(defs.MAX_PLY)]
+        self.history = [0] * 4096
+        self._pickers = [movepicker.MovePicker(self.history) for i in xrange(defs.MAX_PLY)]
+        self._move_buffers = [[] for i in xrange(defs.MAX_PLY)]
+
+    def stop(self):
+        """Makes a running search return as soon as possible. Can be called from another thread."""
+        self.stopped = True
+
+    def generated_per_node(self):
+        """Returns the average number of moves generated in the nodes whose moves were generated."""
+        return float(self.generated) / max(self.expanded, 1)
+
+    def search(self, state, max_depth=defs.MAX_PLY - 1, max_nodes=None, max_time=None):
+        """Searches a position with iterative deepening until a limit is reached.
+
+           max_time is in seconds. When a limit is reached in the middle of an iteration, the
+           result of the last finished iteration is used. The state is left unchanged.
+
+           Returns (best move, score, principal variation); the moves are packed. The best
+           move is 0 if there are no legal moves.
+        """
+        self.state = state
+        self.nodes = 0
+        self.qnodes = 0
+        self.generated = 0
+        self.expanded = 0
+        self.stopped = False
+        for killers in self.killers:
+            killers[0] = killers[1] = 0
+        self.history[:] = [0] * 4096
+        self.start_time = time.time()
+        self.next_progress = self.start_time + self.progress_interval
+        self.max_nodes = max_nodes
+        self.deadline = max_time and self.start_time + max_time
+
+        root_moves = moggio.move.generate_legal_moves(state, [])
+        if not root_moves:
+            return 0, self._mate_or_stalemate(0), []
+
+        best_move = root_moves[0]
+        best_score = 0
+        pv = [best_move]
+
+        for depth in xrange(1, max_depth + 1):
+            score, move = self._search_root(root_moves, depth, best_move)
+            if self.stopped:
+                break
+
+            best_move = move
+            best_score = score
+            pv = self.principal_variation(depth)
+
+            if self.info:
+                self.info(self, depth, score, pv)
+
+            # No point in searching deeper when a forced mate has been found.
+            if abs(score) > MATE_BOUND and MATE - abs(score) <= depth:
+                break
+
+        return best_move, best_score, pv
+
+    def principal_variation(self, max_length):
+        """Follows the best moves in the transposition table from the root position."""
+        state = self.state
+        pv = []
+        seen = set()
+
+        while len(pv) < max_length and state.hash not in seen:
+            seen.add(state.hash)
+
+            entry = self.table.probe(state.hash)
+            if not entry or not entry[3]:
+                break
+
+            # The entry might belong to another position with the same index.
+            move = entry[3]
+            if move not in moggio.move.generate_legal_moves(state, []):
+                break
+
+            state.make_move(move)
+            pv.append(move)
+
+        for move in reversed(pv):
+            state.unmake_move(move)
+
+        return pv
+
+    def _search_root(self, moves, depth, first_move):
+        """Searches every root move, starting with first_move. Returns (score, best move)."""
+        state = self.state
+
+        moves.remove(first_move)
+        moves.insert(0, first_move)
+
+        alpha = -INFINITY
+        best_move = first_move
+        for move in moves:
+            state.make_move(move)
+            score = -self._negamax(depth - 1, -INFINITY, -alpha, 1)
+            state.unmake_move(move)
+
+            if self.stopped:
+                break
+
+            if score > alpha:
+                alpha = score
+                best_move = move
+
+        if not self.stopped:
+            self.table.store(state.hash, depth, alpha, hashtable.EXACT, best_move)
+
+        return alpha, best_move
+
+    def _negamax(self, depth, alpha, beta, ply):
+        """Returns the score of the position searched to depth, from the point of view of the player in turn."""
+        self.nodes += 1
+        if not self.nodes % _CHECK_INTERVAL:
+            self._check_limits()
+        if self.stopped:
+            return 0
+
+        state = self.state
+        table = self.table
+
+        # Repeating a position can't be better than a draw, so it's scored as one already
+        # at the first repetition.
+        if state.is_repetition():
+            return 0
+        if state.is_fifty_move_draw():
+            if not moggio.move.count_legal_moves(state):
+                return self._mate_or_stalemate(ply)
+            return 0
+
+        # Drawn KPK endings don't need to be searched. Won ones are, so that the search
+        # finds the way to promote.
+        if not state.phase and self.bitbase and self.bitbase.probe_state(state) is False:
+            return 0
+
+        if depth <= 0:
+            self.nodes -= 1
+            return self._quiescence(alpha, beta, ply)
+
+        hash_move = 0
+        entry = table.probe(state.hash)
+        if entry:
+            entry_depth, score, bound, hash_move = entry
+            if entry_depth >= depth:
+                score = _score_from_table(score, ply)
+                if bound == hashtable.EXACT:
+                    return score
+                elif bound == hashtable.LOWER and score >= beta:
+                    return score
+                elif bound == hashtable.UPPER and score <= alpha:
+                    return score
+
+        killers = self.killers[ply]
+        picker = self._pickers[ply]
+        picker.reset(state, hash_move, killers)
+
+        alpha_orig = alpha
+        best_score = -INFINITY
+        best_move = 0
+        for move in picker:
+            state.make_move(move)
+            score = -self._negamax(depth - 1, -beta, -alpha, ply + 1)
+            state.unmake_move(move)
+
+            if self.stopped:
+                return 0
+
+            if score > best_score:
+                best_score = score
+                best_move = move
+                if score > alpha:
+                    alpha = score
+                    if alpha >= beta:
+                        # Remember quiet moves that cause cutoffs, for ordering other nodes.
+                        if move >> defs.MOVE_CAPTURE_SHIFT & 7 == defs.NO_PIECE \
+                            and not move >> defs.MOVE_PROMOTION_SHIFT & 7:
+                            if move != killers[0]:
+                                killers[1] = killers[0]
+                                killers[0] = move
+                            self.history[move & 0xfff] += depth * depth
+                        break
+
+        self.generated += picker.generated
+        self.expanded += 1
+
+        if not best_move:
+            return self._mate_or_stalemate(ply)
+
+        if best_score <= alpha_orig:
+            bound = hashtable.UPPER
+        elif best_score >= beta:
+            bound = hashtable.LOWER
+        else:
+            bound = hashtable.EXACT
+        table.store(state.hash, depth, _score_to_table(best_score, ply), bound, best_move)
+
+        return best_score
+
+    def _quiescence(self, alpha, beta, ply):
+        """Searches captures and promotions until the position is quiet, and returns its score.
+
+           The player in turn can always stand pat, i.e. take the static evaluation instead
+           of capturing, except when in check; then every legal move is searched.
+        """
+        self.nodes += 1
+        self.qnodes += 1
+        if not self.nodes % _CHECK_INTERVAL:
+            self._check_limits()
+        if self.stopped:
+            return 0
+
+        state = self.state
+        if ply >= defs.MAX_PLY - 1:
+            return moggio.evaluate.evaluate(state, self.pawn_table)
+
+        checks = moggio.move.checks_and_pins(state)
+        in_check = checks[0]
+
+        if in_check:
+            moves = moggio.move.generate_legal_moves(state, self._move_buffers[ply], moggio.move.ALL, checks)
+            if not moves:
+                return -MATE + ply
+            stand_pat = -INFINITY
+        else:
+            stand_pat = moggio.evaluate.evaluate(state, self.pawn_table)
+            if stand_pat >= beta:
+                return stand_pat
+            if stand_pat > alpha:
+                alpha = stand_pat
+            moves = moggio.move.generate_legal_moves(state, self._move_buffers[ply], moggio.move.CAPTURES, checks)
+
+        moves.sort(key=movepicker.mvv_lva, reverse=True)
+
+        best_score = stand_pat
+        for move in moves:
+            if not in_check:
+                capture = move >> defs.MOVE_CAPTURE_SHIFT & 7
+                promotion = move >> defs.MOVE_PROMOTION_SHIFT & 7
+                if promotion:
+                    # Underpromotions are almost never better than a queen.
+                    if promotion != defs.QUEEN:
+                        continue
+                elif stand_pat + _capture_values[capture] + DELTA_MARGIN <= alpha:
+                    continue
+                if moggio.move.see(state, move) < 0:
+                    continue
+
+            state.make_move(move)
+            score = -self._quiescence(-beta, -alpha, ply + 1)
+            state.unmake_move(move)
+
+            if self.stopped:
+                return 0
+
+            if score > best_score:
+                best_score = score
+                if score > alpha:
+                    alpha = score
+                    if alpha >= beta:
+                        break
+
+        return best_score
+
+    def _mate_or_stalemate(self, ply):
+        """Returns the score of a position without legal moves."""
+        state = self.state
+        king = state.pieces[state.turn][defs.KING]
+
+        if moggio.move.is_attacked(state, king, 1 - state.turn):
+            return -MATE + ply
+        return 0
+
+    def _check_limits(self):
+        """Sets stopped if the node or time limit has been reached, and reports progress."""
+        if self.max_nodes and self.nodes >= self.max_nodes:
+            self.stopped = True
+
+        now = time.time()
+        if self.deadline and now >= self.deadline:
+            self.stopped = True
+
+        if self.progress and now >= self.next_progress:
+            self.next_progress = now + self.progress_interval
+            self.progress(self)
+
+# Values of captured pieces for delta pruning, indexed by piece (including NO_PIECE).
+_capture_values = moggio.evaluate.material_mg[:defs.KING] + (0, 0, 0)
+
+def _score_to_table(score, ply):
+    """Mate scores are stored relative to the position instead of the root."""
+    if score > MATE_BOUND:
+        return score + ply
+    elif score < -MATE_BOUND:
+        return score - ply
+    return score
+
+def _score_from_table(score, ply):
+    """Reverses _score_to_table."""
+    if score > MATE_BOUND:
+        return score - ply
+    elif score < -MATE_BOUND:
+        return score + ply
+    return score
+
+def search(state, max_depth=defs.MAX_PLY - 1, max_nodes=None, max_time=None, hash_mb=16):
+    """Searches a position with a new Search. See Search.search."""
+    return Search(hash_mb).search(state, max_depth, max_nodes, max_time)
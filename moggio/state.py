@@ -1,9 +1,38 @@
 import moggio.util as util
 import moggio.defines as defs
 import moggio.cache as cache
+import moggio.evaluate as evaluate
 
 """Includes the State class."""
 
+# If set, make_move recomputes the Zobrist hash from scratch after every move and checks
+# that it's equal to the incrementally updated one. Very slow; only for debugging.
+DEBUG_HASH = False
+
+# If set, make_move recomputes the evaluation scores from scratch after every move and checks
+# that they're equal to the incrementally updated ones. Very slow; only for debugging.
+DEBUG_EVAL = False
+
+# Tables used by set_fen. The board characters map to either the number of empty squares
+# or (color, piece, Zobrist keys, midgame scores, endgame scores, phase). They refer to the
+# tables in moggio.cache, which are filled in by moggio.cache.preprocess().
+_fen_board = dict((str(n), n) for n in xrange(1, 9))
+for _color, _piece in defs.COLOR_PIECES:
+    _fen_board[util.piece_to_char(_color, _piece)] = (
+        _color, _piece, cache.zobrist_pieces[_color][_piece],
+        cache.psqt_mg[_color][_piece], cache.psqt_eg[_color][_piece],
+        evaluate.phase_values[_piece])
+del _color, _piece
+
+_fen_turn = {'w': defs.WHITE, 'b': defs.BLACK, 'W': defs.WHITE, 'B': defs.BLACK}
+_fen_castling = {'K': defs.H1, 'Q': defs.A1, 'k': defs.H8, 'q': defs.A8}
+_fen_squares = dict((util.square_to_chars(idx), 1 << idx) for idx in xrange(64))
+
+# The number of hashes of earlier positions that copy() keeps. Positions from before the
+# last 100 moves without captures and pawn moves don't matter, since the game is then
+# drawn by the fifty-move rule.
+MAX_KEPT_KEYS = 100
+
 class State:
 
     """Represents the state of a position on the chess board.
@@ -14,10 +43,25 @@ class State:
         castling    - Castling availability.
         en_passant  - En passant availability.
         occupied    - Which squares are occupied by white, black, or both.
+        hash        - 64bit Zobrist hash of the position, updated incrementally by make_move.
+        score_mg    - Midgame material and piece-square score (see moggio.evaluate), updated by make_move.
+        score_eg    - Endgame material and piece-square score, updated by make_move.
+        phase       - Game phase (see moggio.evaluate), updated by make_move.
+        undo        - Stack of [capture, castling, en_passant, hash, score_mg, score_eg,
+                      phase, halfmove_clock] records, one per ply, used by unmake_move to
+                      restore the state. Records are added by make_move as they're needed,
+                      and reused after that.
+        ply         - Number of moves made with make_move that hasn't been unmade yet.
+        halfmove_clock  - Number of moves since the last capture or pawn move, updated by make_move.
+        fullmove_number - Number of the move, starting at 1 and increased after black moves.
+        keys        - Stack with the hash of every earlier position, most recent last; see
+                      is_repetition. Like undo, it grows as needed.
+        key_count   - Number of hashes in keys.
     """
 
     def __init__(self, fen=None):
         """If fen is not given, the instance will represent an empty board."""
+        self.undo = None
         if fen:
             self.set_fen(fen)
 
@@ -33,10 +77,31 @@ class State:
         self.occupied = [
             0, 0, 0 # WHITE, BLACK, BOTH
         ]
+        self.hash = 0
+        self.score_mg = 0
+        self.score_eg = 0
+        self.phase = 0
+        self.ply = 0
+        self.halfmove_clock = 0
+        self.fullmove_number = 1
+        self.key_count = 0
+
+        # Nothing in the undo and key stacks is used before it's written, so existing ones
+        # are kept. This makes calling set_fen on the same State over and over cheap.
+        if self.undo is None:
+            self.undo = []
+            self.keys = []
 
     def copy(self):
-        """Makes an independent copy of a state instance"""
+        """Makes an independent copy of a state instance
+
+           The undo stack is not copied, so moves made before the copy can't be unmade on it.
+           The hashes of the positions since the last capture or pawn move are copied (at
+           most MAX_KEPT_KEYS of them), so repetitions of positions before the copy are
+           still found.
+        """
         s = State()
+        s.undo = []
 
         s.pieces = (
             self.pieces[0][:],
@@ -46,138 +111,353 @@ class State:
         s.castling = self.castling
         s.en_passant = self.en_passant
         s.occupied = self.occupied[:]
+        s.hash = self.hash
+        s.score_mg = self.score_mg
+        s.score_eg = self.score_eg
+        s.phase = self.phase
+        s.halfmove_clock = self.halfmove_clock
+        s.fullmove_number = self.fullmove_number
+        s.ply = 0
+
+        kept = min(self.halfmove_clock, self.key_count, MAX_KEPT_KEYS)
+        s.keys = self.keys[self.key_count - kept:self.key_count]
+        s.key_count = kept
 
         return s
 
+    def compute_hash(self):
+        """Calculates the Zobrist hash of the position from scratch."""
+        ret = cache.zobrist_castling[self.castling] ^ cache.zobrist_en_passant[self.en_passant]
+        if self.turn == defs.BLACK:
+            ret ^= cache.zobrist_turn
+
+        for color, piece in defs.COLOR_PIECES:
+            zobrist = cache.zobrist_pieces[color][piece]
+            bits = self.pieces[color][piece]
+            while bits:
+                square = bits & -bits
+                bits &= bits - 1
+                ret ^= zobrist[square]
+
+        return ret
+
     def make_move(self, move):
-        opponent = 1 - self.turn
+        """Applies a move to the state. It can be taken back with unmake_move.
+
+           The move is either a moggio.move.Move or a packed move (see moggio.move.pack_move).
+        """
+        color = self.turn
+        opponent = 1 - color
+        pieces = self.pieces[color]
+        occupied = self.occupied
+
+        if type(move) is int:
+            # The layout is described in moggio.defines.
+            from_square = 1 << (move & 0x3f)
+            to_square = 1 << (move >> 6 & 0x3f)
+            from_piece = move >> 12 & 7
+            capture = move >> 15 & 7
+            if capture == defs.NO_PIECE:
+                capture = None
+            promotion = move >> 18 & 7
+        else:
+            from_square = move.from_square
+            to_square = move.to_square
+            from_piece = move.from_piece
+            capture = move.capture
+            promotion = move.promotion
+
+        # Remember what can't be recalculated from the move when unmaking it.
+        try:
+            record = self.undo[self.ply]
+        except IndexError:
+            record = [None, 0, 0, 0, 0, 0, 0, 0]
+            self.undo.append(record)
+        record[0] = capture
+        record[1] = self.castling
+        record[2] = self.en_passant
+        record[3] = self.hash
+        record[4] = self.score_mg
+        record[5] = self.score_eg
+        record[6] = self.phase
+        record[7] = self.halfmove_clock
+        self.ply += 1
+
+        try:
+            self.keys[self.key_count] = self.hash
+        except IndexError:
+            self.keys.append(self.hash)
+        self.key_count += 1
+
+        if capture != None or from_piece == defs.PAWN:
+            self.halfmove_clock = 0
+        else:
+            self.halfmove_clock += 1
+        if color == defs.BLACK:
+            self.fullmove_number += 1
+
+        zobrist = cache.zobrist_pieces[color]
+        hash = self.hash ^ cache.zobrist_turn \
+            ^ cache.zobrist_castling[self.castling] ^ cache.zobrist_en_passant[self.en_passant]
+
+        # The evaluation scores are updated like the hash, by subtracting the value of the
+        # piece where it was and adding it where it ends up.
+        psqt_mg = cache.psqt_mg[color]
+        psqt_eg = cache.psqt_eg[color]
+        score_mg = self.score_mg - psqt_mg[from_piece][from_square]
+        score_eg = self.score_eg - psqt_eg[from_piece][from_square]
 
         # Remove the piece that moved from the board.
-        self.pieces[self.turn][move.from_piece] ^= move.from_square
-        self.occupied[self.turn] ^= move.from_square
+        pieces[from_piece] ^= from_square
+        hash ^= zobrist[from_piece][from_square]
 
         # If it is a capture, we need to remove the opponent piece as well.
-        if move.capture != None:
+        if capture != None:
             # Remember to clear castling availability if we capture a rook.
-            if self.castling & move.to_square:
-                self.castling &= ~move.to_square
+            if self.castling & to_square:
+                self.castling &= ~to_square
 
-            to_remove_square = move.to_square
-            if move.from_piece == defs.PAWN and move.to_square & self.en_passant:
+            to_remove_square = to_square
+            if from_piece == defs.PAWN and to_square & self.en_passant:
                 # The piece captured with en passant; we need to clear the board of the captured piece.
                 # We simply use the pawn move square of the opponent to find out which square to clear.
-                to_remove_square = cache.moves_pawn_one[opponent][move.to_square]
+                to_remove_square = cache.moves_pawn_one[opponent][to_square]
 
             # Remove the captured piece off the board.
-            self.pieces[opponent][move.capture] ^= to_remove_square
-            self.occupied[opponent] ^= to_remove_square
+            self.pieces[opponent][capture] ^= to_remove_square
+            occupied[opponent] ^= to_remove_square
+            hash ^= cache.zobrist_pieces[opponent][capture][to_remove_square]
+            score_mg -= cache.psqt_mg[opponent][capture][to_remove_square]
+            score_eg -= cache.psqt_eg[opponent][capture][to_remove_square]
+            self.phase -= evaluate.phase_values[capture]
 
         # Update the board with the new position of the piece.
-        if move.promotion:
-            self.pieces[self.turn][move.promotion] ^= move.to_square
+        if promotion:
+            pieces[promotion] ^= to_square
+            hash ^= zobrist[promotion][to_square]
+            score_mg += psqt_mg[promotion][to_square]
+            score_eg += psqt_eg[promotion][to_square]
+            self.phase += evaluate.phase_values[promotion]
         else:
-            self.pieces[self.turn][move.from_piece] ^= move.to_square
+            pieces[from_piece] ^= to_square
+            hash ^= zobrist[from_piece][to_square]
+            score_mg += psqt_mg[from_piece][to_square]
+            score_eg += psqt_eg[from_piece][to_square]
 
         # Update "occupied" with the same piece as above.
-        self.occupied[self.turn] ^= move.to_square
-        
+        occupied[color] ^= from_square | to_square
+
         self.en_passant = 0
 
-        if move.from_piece == defs.KING:
+        if from_piece == defs.KING:
             #TODO: This can be made more efficient by caching more stuff..
             # We could first see if the move was >1 step (one bitwise and and one lookup),
             # then we could have a cache element where cached[to_square] gives the place where
             # the rook should be positioned (one bitwise xor and one lookup).
-            left_castle = cache.castling_availability[self.turn][0][move.from_square]
-            if (left_castle << 2) & move.to_square:
-                self.pieces[self.turn][defs.ROOK] ^= left_castle | left_castle << 3
-                self.occupied[self.turn] ^= left_castle | left_castle << 3
-
-            right_castle = cache.castling_availability[self.turn][1][move.from_square]
-            if (right_castle >> 1) & move.to_square:
-                self.pieces[self.turn][defs.ROOK] ^= right_castle | right_castle >> 2
-                self.occupied[self.turn] ^= right_castle | right_castle >> 2
+            left_castle = cache.castling_availability[color][0][from_square]
+            if (left_castle << 2) & to_square:
+                pieces[defs.ROOK] ^= left_castle | left_castle << 3
+                occupied[color] ^= left_castle | left_castle << 3
+                hash ^= zobrist[defs.ROOK][left_castle] ^ zobrist[defs.ROOK][left_castle << 3]
+                score_mg += psqt_mg[defs.ROOK][left_castle << 3] - psqt_mg[defs.ROOK][left_castle]
+                score_eg += psqt_eg[defs.ROOK][left_castle << 3] - psqt_eg[defs.ROOK][left_castle]
+
+            right_castle = cache.castling_availability[color][1][from_square]
+            if (right_castle >> 1) & to_square:
+                pieces[defs.ROOK] ^= right_castle | right_castle >> 2
+                occupied[color] ^= right_castle | right_castle >> 2
+                hash ^= zobrist[defs.ROOK][right_castle] ^ zobrist[defs.ROOK][right_castle >> 2]
+                score_mg += psqt_mg[defs.ROOK][right_castle >> 2] - psqt_mg[defs.ROOK][right_castle]
+                score_eg += psqt_eg[defs.ROOK][right_castle >> 2] - psqt_eg[defs.ROOK][right_castle]
 
             # Clear the appropriate castling availability.
-            self.castling &= ~cache.castling_by_color[self.turn]
+            self.castling &= ~cache.castling_by_color[color]
 
-        elif move.from_piece == defs.ROOK:
+        elif from_piece == defs.ROOK:
             # Clear the appropriate castling availability.
-            self.castling &= ~move.from_square
+            self.castling &= ~from_square
 
         # Clear / set en_passant
-        elif move.from_piece == defs.PAWN:
-            if ~cache.moves_pawn_one[self.turn][move.from_square] & move.to_square & cache.moves_pawn_two[self.turn][move.from_square]:
-                self.en_passant = cache.moves_pawn_one[self.turn][move.from_square]
-        
-        self.turn ^= 1
-        self.occupied[defs.BOTH] = \
-            self.occupied[defs.WHITE] | self.occupied[defs.BLACK]
+        elif from_piece == defs.PAWN:
+            if ~cache.moves_pawn_one[color][from_square] & to_square & cache.moves_pawn_two[color][from_square]:
+                self.en_passant = cache.moves_pawn_one[color][from_square]
+
+        self.turn = opponent
+        occupied[defs.BOTH] = occupied[defs.WHITE] | occupied[defs.BLACK]
+
+        self.hash = hash ^ cache.zobrist_castling[self.castling] ^ cache.zobrist_en_passant[self.en_passant]
+        if DEBUG_HASH:
+            assert self.hash == self.compute_hash(), "Zobrist hash mismatch after %s" % move
+
+        self.score_mg = score_mg
+        self.score_eg = score_eg
+        if DEBUG_EVAL:
+            assert (score_mg, score_eg, self.phase) == evaluate.compute_scores(self), \
+                "Evaluation mismatch after %s" % move
+
+    def unmake_move(self, move):
+        """Takes back the last move made with make_move.
+
+           Moves must be unmade in the reverse order of how they were made.
+        """
+        self.ply -= 1
+        capture, self.castling, self.en_passant, self.hash, \
+            self.score_mg, self.score_eg, self.phase, self.halfmove_clock = self.undo[self.ply]
+        self.key_count -= 1
+
+        opponent = self.turn
+        color = 1 - opponent
+        self.turn = color
+        if color == defs.BLACK:
+            self.fullmove_number -= 1
+        pieces = self.pieces[color]
+        occupied = self.occupied
+
+        if type(move) is int:
+            from_square = 1 << (move & 0x3f)
+            to_square = 1 << (move >> 6 & 0x3f)
+            from_piece = move >> 12 & 7
+            promotion = move >> 18 & 7
+        else:
+            from_square = move.from_square
+            to_square = move.to_square
+            from_piece = move.from_piece
+            promotion = move.promotion
+
+        # Put the piece that moved back where it came from.
+        pieces[from_piece] ^= from_square
+        if promotion:
+            pieces[promotion] ^= to_square
+        else:
+            pieces[from_piece] ^= to_square
+        occupied[color] ^= from_square | to_square
+
+        # Put back the captured piece, which is somewhere else if it was captured en passant.
+        if capture != None:
+            to_remove_square = to_square
+            if from_piece == defs.PAWN and to_square & self.en_passant:
+                to_remove_square = cache.moves_pawn_one[opponent][to_square]
+
+            self.pieces[opponent][capture] ^= to_remove_square
+            occupied[opponent] ^= to_remove_square
+
+        # Put the rook back if the move was a castle.
+        elif from_piece == defs.KING:
+            left_castle = cache.castling_availability[color][0][from_square]
+            if (left_castle << 2) & to_square:
+                pieces[defs.ROOK] ^= left_castle | left_castle << 3
+                occupied[color] ^= left_castle | left_castle << 3
+
+            right_castle = cache.castling_availability[color][1][from_square]
+            if (right_castle >> 1) & to_square:
+                pieces[defs.ROOK] ^= right_castle | right_castle >> 2
+                occupied[color] ^= right_castle | right_castle >> 2
+
+        occupied[defs.BOTH] = occupied[defs.WHITE] | occupied[defs.BLACK]
+
+    def is_repetition(self):
+        """Checks if the position has occurred before.
+
+           Only the positions since the last capture or pawn move can be the same as this
+           one, and only every second of those has the same player in turn, so this takes
+           time proportional to the halfmove clock rather than to the length of the game.
+        """
+        key = self.hash
+        keys = self.keys
+
+        end = self.key_count - self.halfmove_clock
+        if end < 0:
+            end = 0
+
+        # A position can't repeat until both players have made two moves.
+        idx = self.key_count - 4
+        while idx >= end:
+            if keys[idx] == key:
+                return True
+            idx -= 2
+
+        return False
+
+    def is_fifty_move_draw(self):
+        """Checks if fifty moves by each player have been made without captures or pawn moves.
+
+           A checkmate on the last move takes precedence, which this doesn't check.
+        """
+        return self.halfmove_clock >= 100
 
     def set_fen(self, fen):
         """Sets the board according to Forsyth-Edwards Notation.
         
            See http://en.wikipedia.org/wiki/Forsyth%E2%80%93Edwards_Notation for more information.
+           The halfmove and fullmove numbers are optional, and default to 0 and 1.
         """
         self.reset()
 
         fen_parts = fen.split()
-        numbers = map(str, range(1, 10))
-
-        # Set up the position
-        fen_position = fen_parts.pop(0)
-        piece_idx = 8 * 7 # Starting on the A8.
-
-        for c in fen_position:
-            if c == '/':
-                piece_idx -= 2 * 8
-            elif c in numbers:
-                piece_idx += int(c)
-            else:
-                try:
-                    piece = util.char_to_piece(c)
-                    color = util.char_to_color(c)
-                    self.pieces[color][piece] |= (1 << piece_idx)
-                except KeyError:
+        if len(fen_parts) < 4:
+            raise Exception("Invalid FEN: '%s'" % fen)
+
+        # Set up the position, rank 8 first. Every character is looked up in a table, which
+        # gives the number of squares to skip or the piece and the keys and scores to add.
+        ranks = fen_parts[0].split('/')
+        if len(ranks) != 8:
+            raise Exception("Invalid FEN: '%s'" % fen)
+
+        pieces = self.pieces
+        occupied = self.occupied
+        hash = score_mg = score_eg = phase = 0
+
+        for y, rank in enumerate(ranks):
+            square = 1 << ((7 - y) * 8)
+            end_square = square << 8
+            for c in rank:
+                entry = _fen_board.get(c)
+                if entry is None or square >= end_square:
                     raise Exception("Invalid FEN: '%s'" % fen)
-                else:
-                    piece_idx += 1
+                if type(entry) is int:
+                    square <<= entry
+                    continue
 
-        # Update self.occupied with the occupied squares in self.pieces.
-        self.occupied[defs.WHITE] = self.occupied[defs.BLACK] = self.occupied[defs.BOTH] = 0
-        for color, piece in defs.COLOR_PIECES:
-            self.occupied[color] |= self.pieces[color][piece]
-            self.occupied[defs.BOTH] |= self.pieces[color][piece]
+                color, piece, zobrist, psqt_mg, psqt_eg, piece_phase = entry
+                pieces[color][piece] |= square
+                occupied[color] |= square
+                hash ^= zobrist[square]
+                score_mg += psqt_mg[square]
+                score_eg += psqt_eg[square]
+                phase += piece_phase
+                square <<= 1
 
-        # Set active color.
-        fen_color = fen_parts.pop(0)
+            if square != end_square:
+                raise Exception("Invalid FEN: '%s'" % fen)
 
-        if fen_color.lower() == 'w':
-            self.turn = defs.WHITE
-        elif fen_color.lower() == 'b':
-            self.turn = defs.BLACK
-        else:
+        occupied[defs.BOTH] = occupied[defs.WHITE] | occupied[defs.BLACK]
+
+        # Set active color.
+        try:
+            self.turn = _fen_turn[fen_parts[1]]
+        except KeyError:
             raise Exception("Invalid FEN: '%s'" % fen)
 
         # Set castling availability.
-        fen_castling = fen_parts.pop(0)
-        for c in fen_castling:
-            if c == 'Q':
-                self.castling |= defs.A1
-            elif c == 'K':
-                self.castling |= defs.H1
-            elif c == 'q':
-                self.castling |= defs.A8
-            elif c == 'k':
-                self.castling |= defs.H8
+        for c in fen_parts[2]:
+            self.castling |= _fen_castling.get(c, 0)
 
         # Set en passant.
-        fen_passant = fen_parts.pop(0)
+        fen_passant = fen_parts[3]
         if fen_passant != '-':
-            square_idx = util.chars_to_square(fen_passant)
-            self.en_passant = (1 << square_idx)
-
-        # TODO: Halfmove and Fullmove numbers from FEN.
+            self.en_passant = _fen_squares.get(fen_passant.lower(), 0)
+
+        # Set the halfmove and fullmove numbers.
+        if len(fen_parts) >= 6:
+            self.halfmove_clock = int(fen_parts[4])
+            self.fullmove_number = int(fen_parts[5])
+
+        if self.turn == defs.BLACK:
+            hash ^= cache.zobrist_turn
+        self.hash = hash ^ cache.zobrist_castling[self.castling] ^ cache.zobrist_en_passant[self.en_passant]
+        self.score_mg = score_mg
+        self.score_eg = score_eg
+        self.phase = phase
 
     def __str__(self):
         """Makes a pretty string, representing a position."""
@@ -1,15 +1,26 @@
 """Class used for testing the engine; perft and divide are found here"""
 
+import moggio.cache
 import moggio.move
 import moggio.defines as defs
+import moggio.epd
+import moggio.hashtable
 import moggio.state
+import moggio.util
 import sys
 import time
 
-def perft(state, depth, verbose=True):
+# One move list per ply, reused by perft so that it doesn't allocate a list for every node.
+_move_buffers = [[] for i in xrange(defs.MAX_PLY)]
+
+def perft(state, depth, verbose=True, table=None):
     """
         Given a position, it will recursivly apply every possible
-        move for a given depth and count the leaf nodes.
+        move for a given depth and count the leaf nodes. The last ply
+        is counted with moggio.move.count_legal_moves instead of made.
+
+        If table is a moggio.hashtable.PerftTable, node counts of positions that
+        have already been searched to the same depth are looked up in it.
     """
     if depth == 0:
         res = moggio.move.is_attacked(
@@ -20,75 +31,837 @@ def perft(state, depth, verbose=True):
 
         return not res
 
-    moves = moggio.move.generate_moves(state)
+    if depth == 1 and not verbose:
+        # The frontier only needs the number of legal moves, which can be counted without
+        # making them. The position itself might be illegal, though.
+        if moggio.move.is_attacked(state, state.pieces[1 - state.turn][defs.KING], state.turn):
+            return 0
+        return moggio.move.count_legal_moves(state)
+
+    if table and not verbose:
+        nodes = table.probe(state.hash, depth)
+        if nodes is not None:
+            return nodes
+
+    moves = moggio.move.generate_moves_packed(state, _move_buffers[state.ply])
 
     if not moves: # Also checks for invalid positions (if generate_moves finds a king capture, it returns None)
         return 0
 
     nodes = 0
     for move in moves:
-        duplicate = state.copy()
-        duplicate.make_move(move)
-
-        res = perft(duplicate, depth - 1, False);
+        state.make_move(move)
+        res = perft(state, depth - 1, False, table);
+        state.unmake_move(move)
 
         if verbose and res:
-            print "%s: %d" % (move, res)
+            print "%s: %d" % (moggio.move.move_str(move), res)
+
+        nodes += res
+
+    if table:
+        table.store(state.hash, depth, nodes)
+
+    return nodes
+
+def perft_legal(state, depth, verbose=True, table=None):
+    """Same as perft, but uses the legal move generator.
+
+       Since every generated move is legal, the leaves don't have to be checked.
+       Like perft, the last ply is counted with moggio.move.count_legal_moves.
+    """
+    if depth == 0:
+        return 1
+
+    if depth == 1 and not verbose:
+        return moggio.move.count_legal_moves(state)
+
+    if table and not verbose:
+        nodes = table.probe(state.hash, depth)
+        if nodes is not None:
+            return nodes
+
+    moves = moggio.move.generate_legal_moves(state, _move_buffers[state.ply])
+
+    nodes = 0
+    for move in moves:
+        state.make_move(move)
+        res = perft_legal(state, depth - 1, False, table);
+        state.unmake_move(move)
+
+        if verbose:
+            print "%s: %d" % (moggio.move.move_str(move), res)
+
+        nodes += res
+
+    if table:
+        table.store(state.hash, depth, nodes)
+
+    return nodes
+
+def divide(state, depth, table=None, workers=1):
+    """Like perft, but prints the node count of every move.
+
+       If workers is more than 1, the moves are searched in parallel by a pool of that many
+       processes; see parallel_divide. The table isn't shared with the workers.
+    """
+    if workers > 1:
+        return parallel_divide(state, depth, workers)
+
+    return perft(state, depth, True, table)
+
+# Used by the worker processes of parallel_divide and perftsuite.
+_worker_table = None
+
+def _init_worker(hash_mb):
+    """Prepares a worker process: makes sure the cache is generated and allocates its hash table."""
+    global _worker_table
+
+    if not moggio.cache.preprocessed:
+        moggio.cache.preprocess()
+
+    _worker_table = None
+    if hash_mb:
+        _worker_table = moggio.hashtable.PerftTable(hash_mb)
+
+def _perft_moves(args):
+    """Makes a sequence of moves and runs perft on the resulting position. Runs in a worker process."""
+    state, moves, depth = args
+
+    for move in moves:
+        state.make_move(move)
+
+    return perft(state, depth, False, _worker_table)
+
+def parallel_divide(state, depth, workers=None, hash_mb=0):
+    """Like divide, but the moves are searched in parallel by a pool of worker processes.
+
+       If there are fewer root moves than workers, the moves at depth 2 are split between
+       the workers as well. workers defaults to the number of CPUs, and every worker gets
+       its own hash table of hash_mb megabytes.
+    """
+    import multiprocessing
+    workers = workers or multiprocessing.cpu_count()
+
+    moves = moggio.move.generate_moves(state)
+    if not moves:
+        return 0
+
+    # Each task is a (root move index, moves to make) pair.
+    tasks = []
+    for idx, move in enumerate(moves):
+        if len(moves) >= workers or depth < 3:
+            tasks.append((idx, [move]))
+            continue
+
+        state.make_move(move)
+        replies = moggio.move.generate_moves(state)
+        state.unmake_move(move)
+
+        # generate_moves returns None if the root move leaves the king in check.
+        for reply in replies or ():
+            tasks.append((idx, [move, reply]))
+
+    start_time = time.time()
+    pool = multiprocessing.Pool(workers, _init_worker, (hash_mb,))
+    try:
+        results = pool.map(_perft_moves,
+                           [(state, task_moves, depth - len(task_moves)) for idx, task_moves in tasks],
+                           chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+    move_nodes = [0] * len(moves)
+    for (idx, task_moves), res in zip(tasks, results):
+        move_nodes[idx] += res
 
+    nodes = 0
+    for move, res in zip(moves, move_nodes):
+        if res:
+            print "%s: %d" % (move, res)
         nodes += res
-        #state.unmake_move(move)
+
+    time_spent = time.time() - start_time
+    print "%d nodes in %.2f seconds with nps=%d (%d workers)" % \
+        (nodes, time_spent, nodes / max(time_spent, 1e-9), workers)
 
     return nodes
 
-def divide(state, depth):
-    return perft(state, depth, True)
+def _perft_line(lineno, fen, operations, max_depth, table, write, legal=False):
+    """Runs perft (or perft_legal) on one position of the perft suite, writing the results with write.
+
+       operations are the EPD operations of the position, with the correct node counts as
+       D1, D2 and so on. Returns the number of errors (0 or 1) and the number of nodes searched.
+    """
+    position = moggio.state.State(fen)
+
+    write('%d' % lineno)
 
-def perftsuite(max_depth=2):
+    errors = 0
+    nodes = 0
+    for depth in xrange(1, max_depth + 1):
+        if legal:
+            result = perft_legal(position, depth, False, table)
+        else:
+            result = perft(position, depth, False, table)
+        nodes += result
+
+        write('\t%d=%d' % (depth, result))
+
+        correct_result = int(operations['D%d' % depth][0])
+
+        if result != correct_result:
+            errors += 1
+            write("FAIL!  diff=%d depth=%d me=%d correct=%d fen=%s" % (abs(result - correct_result), depth, result, correct_result, fen));
+            break
+
+    return errors, nodes
+
+def _perft_line_worker(args):
+    """Runs _perft_line in a worker process, and returns its output along with the results."""
+    lineno, fen, operations, max_depth, legal = args
+
+    output = []
+    errors, nodes = _perft_line(lineno, fen, operations, max_depth, _worker_table, output.append, legal)
+
+    return ''.join(output), errors, nodes
+
+def _write_flush(text):
+    sys.stdout.write(text)
+    sys.stdout.flush()
+
+def perftsuite(max_depth=2, hash_mb=0, workers=1, legal=False):
     """Runs 126 startion position through perft() and checks if the nodecount is correct
 
        This tests the move generation and make/unmake moves of moggio, and should always
        have 0/126 failed.
+
+       If hash_mb is given, perft uses a hash table of that many megabytes, and its hit rate
+       is reported at the end.
+
+       If workers is more than 1 (or None, meaning one per CPU), the lines are shared between
+       a pool of worker processes, each with its own hash table. The output is printed in the
+       same order as when running on a single process, and the nps is the aggregate of all workers.
+
+       If legal is set, perft_legal is used instead of perft.
     """
     handle = open('perftsuite.esp', 'r')
-    lineno = 0
+    positions = enumerate(moggio.epd.read_epd(handle), 1)
+    count = 0
+
     errors = 0
     total_nodes = 0
+    table = None
 
     start_time = time.time()
-    for line in handle.readlines():
-        lineno += 1
-        line = line.strip()
+    if workers == 1:
+        if hash_mb:
+            table = moggio.hashtable.PerftTable(hash_mb)
+
+        for lineno, (fen, operations) in positions:
+            count += 1
+            line_errors, nodes = _perft_line(lineno, fen, operations, max_depth, table, _write_flush, legal)
+            errors += line_errors
+            total_nodes += nodes
+
+            time_spent = time.time() - start_time
+            sys.stdout.write(' nps=%d\n' % (total_nodes / time_spent))
+    else:
+        import multiprocessing
+        workers = workers or multiprocessing.cpu_count()
+        pool = multiprocessing.Pool(workers, _init_worker, (hash_mb,))
+
+        try:
+            # imap returns the results in order, so the output is the same as on a single process.
+            tasks = ((lineno, fen, operations, max_depth, legal) for lineno, (fen, operations) in positions)
+            for output, line_errors, nodes in pool.imap(_perft_line_worker, tasks):
+                count += 1
+                errors += line_errors
+                total_nodes += nodes
+
+                time_spent = time.time() - start_time
+                _write_flush('%s nps=%d\n' % (output, total_nodes / time_spent))
+        finally:
+            pool.close()
+            pool.join()
+
+    handle.close()
+    total_time = time.time() - start_time
+
+    print "\nFailed tests: %d/%d" % (errors, count)
+    print "%d nodes in %.2f seconds with nps=%d" % (total_nodes, total_time, total_nodes / total_time)
+    if table:
+        print "Hash table: %d/%d hits (%.1f%%) in %d entries" % \
+            (table.hits, table.probes, table.hit_rate() * 100, table.size)
+    elif workers != 1:
+        print "%d workers" % workers
+
+    return errors, total_nodes, total_time
+
+def check_sliders(samples=1000):
+    """Cross-checks the magic bitboards against the reference ray implementation.
+
+       Every square is tested against a number of random occupancies. Returns the number of mismatches.
+    """
+    import random
+    rng = random.Random(0)
+    errors = 0
+
+    for square_idx in xrange(64):
+        square = 1 << square_idx
+        for i in xrange(samples):
+            occupied = rng.getrandbits(64) & rng.getrandbits(64)
+
+            for piece in (defs.BISHOP, defs.ROOK, defs.QUEEN):
+                state = moggio.state.State()
+                state.reset()
+                state.occupied = [0, occupied, occupied]
+
+                magic = moggio.move.generate_piece_moves(state, defs.WHITE, piece, square)
+                reference = moggio.move.slider_attacks_reference(occupied, piece, square)
+                if magic != reference:
+                    errors += 1
+                    print "Mismatch for piece %d on %s with occupied=0x%016x" % \
+                        (piece, moggio.util.square_to_chars(square_idx), occupied)
+
+    print "Slider mismatches: %d" % errors
+    return errors
+
+def check_batch(random_moves=8):
+    """Cross-checks moggio.batch (which needs NumPy) against the scalar move generation.
+
+       The positions are the perft suite and the positions reached from them by random legal
+       moves. Returns the number of mismatches.
+    """
+    import random
+    import moggio.batch
+    import moggio.evaluate
+    rng = random.Random(0)
+
+    states = []
+    for state in _suite_states():
+        states.append(state.copy())
+        for i in xrange(random_moves):
+            moves = moggio.move.generate_legal_moves(state, [])
+            if not moves:
+                break
+            state.make_move(rng.choice(moves))
+            states.append(state.copy())
+
+    start = time.time()
+    batch = moggio.batch.Batch(states)
+    attacks, mobility = batch.piece_attacks()
+    color_attacks = batch.attacks()
+    material = batch.material()
+    batch_time = time.time() - start
+
+    popcount = lambda bits: bin(bits).count('1')
+
+    errors = 0
+    start = time.time()
+    for n, state in enumerate(states):
+        occupied = state.occupied[defs.BOTH]
+
+        for color in (defs.WHITE, defs.BLACK):
+            piece_attacks = [0] * 6
+            color_mobility = 0
+            color_material = 0
+
+            for piece in xrange(6):
+                bits = state.pieces[color][piece]
+                color_material += moggio.evaluate.material_mg[piece] * popcount(bits)
+                while bits:
+                    square = bits & -bits
+                    bits &= bits - 1
+                    square_idx = square.bit_length() - 1
+
+                    if piece == defs.PAWN:
+                        piece_attacks[piece] |= moggio.cache.attacks_pawn_idx[color][square_idx]
+                    elif piece == defs.KNIGHT:
+                        piece_attacks[piece] |= moggio.cache.moves_knight_idx[square_idx]
+                    elif piece == defs.KING:
+                        piece_attacks[piece] |= moggio.cache.moves_king_idx[square_idx]
+                        color_mobility += popcount(moggio.cache.moves_king_idx[square_idx] & ~state.occupied[color])
+                    if piece in (defs.BISHOP, defs.QUEEN):
+                        piece_attacks[piece] |= moggio.move.bishop_attacks(occupied, square_idx)
+                    if piece in (defs.ROOK, defs.QUEEN):
+                        piece_attacks[piece] |= moggio.move.rook_attacks(occupied, square_idx)
+                    if piece not in (defs.PAWN, defs.KING):
+                        color_mobility += popcount(moggio.move.generate_piece_moves(state, color, piece, square))
+
+            attacked = 0
+            for square_idx in xrange(64):
+                if moggio.move.attackers_by(state, square_idx, color, occupied):
+                    attacked |= 1 << square_idx
+
+            if [int(bits) for bits in attacks[color, :, n]] != piece_attacks \
+                or int(color_attacks[color][n]) != attacked \
+                or mobility[color][n] != color_mobility:
+                errors += 1
+                print "Mismatch for color %d in position %d:\n%s" % (color, n, state)
+
+            if color == defs.WHITE:
+                white_material = color_material
+            elif material[n] != white_material - color_material:
+                errors += 1
+                print "Material mismatch in position %d:\n%s" % (n, state)
+    scalar_time = time.time() - start
+
+    print "Batch mismatches: %d in %d positions" % (errors, len(states))
+    print "Batch: %.3f seconds, scalar checks: %.3f seconds" % (batch_time, scalar_time)
+    return errors
+
+def slider_benchmark(max_depth=2):
+    """Runs perftsuite() with the magic bitboards and with the reference ray implementation, and compares the nps."""
+    magic_errors, magic_nodes, magic_time = perftsuite(max_depth)
+
+    moggio.move.generate_piece_moves = moggio.move.generate_piece_moves_reference
+    try:
+        ray_errors, ray_nodes, ray_time = perftsuite(max_depth)
+    finally:
+        moggio.move.generate_piece_moves = moggio.move._generate_piece_moves_magic
+
+    magic_nps = magic_nodes / magic_time
+    ray_nps = ray_nodes / ray_time
+    print "\nmagic: nps=%d failed=%d" % (magic_nps, magic_errors)
+    print "rays:  nps=%d failed=%d" % (ray_nps, ray_errors)
+    print "speedup: %.2fx" % (magic_nps / ray_nps)
+
+def check_is_attacked(random_moves=8):
+    """Cross-checks is_attacked against is_attacked_reference.
+
+       Every square is tested for attacks by both colors, in the perft suite positions and
+       the positions reached from them by random legal moves. Returns the number of mismatches.
+    """
+    import random
+    rng = random.Random(0)
+    errors = 0
+    tests = 0
+
+    for state in _suite_states():
+        for i in xrange(random_moves + 1):
+            for square_idx in xrange(64):
+                for attacker in (defs.WHITE, defs.BLACK):
+                    tests += 1
+                    if moggio.move.is_attacked(state, 1 << square_idx, attacker) \
+                        != moggio.move.is_attacked_reference(state, 1 << square_idx, attacker):
+                        errors += 1
+                        print "Mismatch for %s attacked by %d in:\n%s" % \
+                            (moggio.util.square_to_chars(square_idx), attacker, state)
 
-        if not line:
+            moves = moggio.move.generate_legal_moves(state, [])
+            if not moves:
+                break
+            state.make_move(rng.choice(moves))
+
+    print "is_attacked mismatches: %d/%d" % (errors, tests)
+    return errors
+
+def attack_benchmark(max_depth=3):
+    """Runs perftsuite() with is_attacked and with is_attacked_reference, and compares the nps."""
+    rays_errors, rays_nodes, rays_time = perftsuite(max_depth)
+
+    moggio.move.is_attacked = moggio.move.is_attacked_reference
+    try:
+        reference_errors, reference_nodes, reference_time = perftsuite(max_depth)
+    finally:
+        moggio.move.is_attacked = moggio.move._is_attacked_rays
+
+    rays_nps = rays_nodes / rays_time
+    reference_nps = reference_nodes / reference_time
+    print "\nrays:      nps=%d failed=%d" % (rays_nps, rays_errors)
+    print "reference: nps=%d failed=%d" % (reference_nps, reference_errors)
+    print "speedup: %.2fx" % (rays_nps / reference_nps)
+
+def _kpk_search(state, strong, depth, memo):
+    """Solves a KPK position by brute force, for check_kpk.
+
+       Returns True if it's won for strong (the side with the pawn), False if it's a draw,
+       or None if that isn't decided within depth plies. A promotion wins unless the new
+       piece can be captured or the opponent is stalemated.
+    """
+    key = state.hash
+    if key in memo:
+        result, searched = memo[key]
+        if result is not None or searched >= depth:
+            return result
+
+    moves = moggio.move.generate_legal_moves(state, [])
+    in_check = moggio.move.is_attacked(state, state.pieces[state.turn][defs.KING], 1 - state.turn)
+    pawns = state.pieces[strong][defs.PAWN]
+
+    if not moves:
+        result = state.turn != strong and in_check
+    elif not pawns:
+        # The pawn has been captured, or has promoted and it's the weak side's turn.
+        promoted = state.occupied[strong] & ~state.pieces[strong][defs.KING]
+        result = bool(promoted) and not any(
+            moggio.move.move_to_idx(move) == promoted.bit_length() - 1 for move in moves)
+    elif not depth:
+        result = None
+    else:
+        # The strong side needs one winning move, the weak side one drawing move.
+        decided = state.turn != strong
+        result = decided
+        for move in moves:
+            state.make_move(move)
+            child = _kpk_search(state, strong, depth - 1, memo)
+            state.unmake_move(move)
+            if child is None:
+                result = None
+            elif child != decided:
+                result = child
+                break
+
+    memo[key] = (result, depth)
+    return result
+
+def check_kpk(samples=300, depth=11, bitbase=None):
+    """Cross-checks the KPK bitbase against a brute force search of random positions.
+
+       Only positions that the search decides within depth plies are compared. Returns the
+       number of mismatches.
+    """
+    import random
+    import moggio.kpk
+    if bitbase is None:
+        bitbase = moggio.kpk.shared()
+
+    rng = random.Random(0)
+    memo = {}
+    errors = 0
+    compared = 0
+    start = time.time()
+
+    for i in xrange(samples):
+        while True:
+            strong = rng.choice((defs.WHITE, defs.BLACK))
+            squares = rng.sample(xrange(64), 3)
+            if squares[2] / 8 in (0, 7):
+                continue
+            board = ['1'] * 64
+            board[squares[0]] = 'K'
+            board[squares[1]] = 'k'
+            board[squares[2]] = 'P' if strong == defs.WHITE else 'p'
+            ranks = [''.join(board[y * 8:y * 8 + 8]) for y in xrange(7, -1, -1)]
+            fen = '%s %s - - 0 1' % ('/'.join(ranks), rng.choice('wb'))
+
+            state = moggio.state.State(fen)
+            # The side that isn't in turn can't be in check, and the kings can't touch.
+            if not moggio.move.is_attacked(state, state.pieces[1 - state.turn][defs.KING], state.turn):
+                break
+
+        expected = _kpk_search(state, strong, depth, memo)
+        if expected is None:
             continue
 
-        fen, answers = line.split(';', 1)
-        depth_answers = map(int, answers.split(';'))
+        compared += 1
+        if bitbase.probe_state(state) != expected:
+            errors += 1
+            print "Mismatch: bitbase says %s, search says %s in %s" % \
+                (bitbase.probe_state(state), expected, fen)
+
+    print "KPK mismatches: %d/%d decided positions (of %d) in %.1f seconds" % \
+        (errors, compared, samples, time.time() - start)
+    return errors
+
+# Positions with pawns on the first and last ranks, which set_fen accepts.
+_back_rank_pawns = (
+    '4k2P/8/8/8/8/8/6P1/p3K3 w - - 0 1',
+    'P3k2p/6p1/8/8/8/8/1P6/3pK2P b - - 0 1',
+)
 
-        position = moggio.state.State(fen)
+def check_pawn_table(random_moves=40, size_mb=1.0 / 64):
+    """Cross-checks evaluate with and without a pawn hash table.
 
-        sys.stdout.write('%d' % lineno)
-        sys.stdout.flush()
+       Every position is evaluated without the table, and then twice with it: once to store
+       the pawn structure and once to find it. The positions are the perft suite, the
+       positions reached from them by random legal moves and a few with pawns on the first
+       and last ranks. The table is kept small, so that entries get replaced. Returns the
+       number of mismatches.
+    """
+    import random
+    import moggio.evaluate
+    rng = random.Random(0)
+    table = moggio.hashtable.PawnTable(size_mb)
+    errors = 0
+    tests = 0
+
+    states = _suite_states() + [moggio.state.State(fen) for fen in _back_rank_pawns]
+    for state in states:
+        for i in xrange(random_moves + 1):
+            expected = moggio.evaluate.evaluate(state)
+            for probe in xrange(2):
+                tests += 1
+                score = moggio.evaluate.evaluate(state, table)
+                if score != expected:
+                    errors += 1
+                    print "Mismatch: %d with the table, %d without in:\n%s" % (score, expected, state)
+
+            moves = moggio.move.generate_legal_moves(state, [])
+            if not moves:
+                break
+            state.make_move(rng.choice(moves))
+
+    print "Pawn table mismatches: %d/%d (hit rate %.2f)" % (errors, tests, table.hit_rate())
+    return errors
+
+def check_search_depth(fen='8/8/8/4k3/8/8/4P3/4K3 w - - 0 1'):
+    """Searches a trivially drawn position to the maximum depth.
+
+       The KPK bitbase makes every iteration take next to no time, so this reaches depths
+       that normal positions never do. The position is searched both as it is and after a
+       move has been made on it. Returns the number of searches that failed.
+    """
+    import moggio.search
+    errors = 0
+
+    state = moggio.state.State(fen)
+    moves = moggio.move.generate_legal_moves(state, [])
+    for made in (None, moves[0]):
+        if made:
+            state.make_move(made)
+        search = moggio.search.Search(1, info=None)
+        try:
+            move, score, pv = search.search(state, defs.MAX_PLY - 1)
+        except Exception, e:
+            errors += 1
+            print "Search failed after %d nodes: %r" % (search.nodes, e)
+            continue
+        if score != 0:
+            errors += 1
+            print "Expected a draw, got score %d" % score
 
-        for depth in xrange(1, max_depth + 1):
-            result = perft(position.copy(), depth, False)
-            total_nodes += result
+    print "Max depth searches failed: %d/2" % errors
+    return errors
 
-            sys.stdout.write('\t%d=%d' % (depth, result))
-            sys.stdout.flush()
+def check_repetition(random_moves=200):
+    """Cross-checks State.is_repetition against a scan of every position played.
 
-            correct_result = depth_answers[depth - 1]
+       Random games are played from the perft suite positions. Half of the moves take back
+       the last move of the same player, so that positions repeat. Now and then the last
+       move is unmade, or the game goes on from a copy() of the state, which keeps only
+       the hashes since the last capture or pawn move. A game ends at the fifty-move rule,
+       after which copies don't have to remember every position. Returns the number of
+       mismatches.
+    """
+    import random
+    rng = random.Random(0)
+    errors = 0
+    tests = 0
+
+    for state in _suite_states():
+        # The hash before every move, and whether the move was a capture or a pawn move.
+        played = []
+        # Moves made before the last copy can't be unmade.
+        copied = 0
+        for i in xrange(random_moves):
+            expected = False
+            for key, irreversible, move in reversed(played):
+                if irreversible:
+                    break
+                if key == state.hash:
+                    expected = True
+                    break
 
-            if result != correct_result:
+            tests += 1
+            if state.is_repetition() != expected:
                 errors += 1
-                sys.stdout.write("FAIL!  diff=%d depth=%d me=%d correct=%d fen=%s" % (abs(result - correct_result), depth, result, correct_result, fen));
+                print "Mismatch: is_repetition says %s after %d moves in:\n%s" % \
+                    (state.is_repetition(), len(played), state)
+
+            moves = moggio.move.generate_legal_moves(state, [])
+            if not moves or state.is_fifty_move_draw():
                 break
 
-        time_spent = time.time() - start_time
-        sys.stdout.write(' nps=%d\n' % (total_nodes / time_spent))
+            choice = rng.random()
+            if choice < 0.05 and len(played) > copied:
+                state.unmake_move(played.pop()[2])
+                continue
+            if choice < 0.1:
+                state = state.copy()
+                copied = len(played)
+
+            move = rng.choice(moves)
+            if choice < 0.6 and len(played) >= 2:
+                last = played[-2][2]
+                back = [other for other in moves if other & 0x3f == last >> 6 & 0x3f
+                        and other >> 6 & 0x3f == last & 0x3f]
+                if back:
+                    move = back[0]
+
+            irreversible = move >> 15 & 7 != defs.NO_PIECE or move >> 12 & 7 == defs.PAWN
+            played.append((state.hash, irreversible, move))
+            state.make_move(move)
 
+    print "is_repetition mismatches: %d/%d" % (errors, tests)
+    return errors
+
+# Moves that san_to_move must reject: pinned pieces, the king walking into check, moves
+# that don't resolve a check, and ambiguous or impossible moves.
+_illegal_san = (
+    ('4k3/4r3/8/8/8/8/4B3/4K3 w - - 0 1', 'Bd3'),
+    ('rnb1kbnr/ppp1pppp/8/8/4p3/3qK3/PPPP1PPP/RNBQ1BNR w kq - 0 4', 'Ke2'),
+    ('4k3/8/8/8/8/8/8/R3K2r w Q - 0 1', 'Rb1'),
+    ('4k3/8/8/8/8/8/4K3/R6R w - - 0 1', 'Rd1'),
+    ('4k3/8/8/8/8/8/8/2N1K1N1 w - - 0 1', 'Ne2'),
+    ('4k3/8/8/2KPp2r/8/8/8/8 w - e6 0 1', 'dxe6'),
+    ('4k3/8/8/8/8/8/4r3/4K3 w - - 0 1', 'O-O'),
+    ('4k3/8/8/8/8/8/8/4K3 w - - 0 1', 'e4'),
+    ('4r2k/8/8/8/1b6/3N4/8/4K3 w - - 0 1', 'Nxb4'),
+)
+
+# Games with castling written with zeros, also right after a move number.
+_zero_castling = (
+    '1. e4 e5 2. Nf3 Nc6 3. Bc4 Bc5 4. 0-0 Nf6 5.d3 0-0 *',
+    '1. d4 d5 2. Nc3 Nc6 3. Bf4 Bf5 4. Qd2 Qd7 5.0-0-0 0-0-0 *',
+)
+
+def check_pgn(random_moves=40):
+    """Checks SAN and PGN round trips of moggio.pgn.
+
+       Random games are played from the perft suite positions. Every legal move on the way
+       is written with move_to_san and read back with san_to_move, and every game is written
+       as PGN (with comments, variations and annotations, over several lines) and replayed
+       from read_games. Also checks that the games in _zero_castling are read like the same
+       games written with O-O, and that the moves in _illegal_san are rejected. Returns the
+       number of failures.
+    """
+    import random
+    import StringIO
+    import moggio.pgn
+    rng = random.Random(0)
+    errors = 0
+    tests = 0
+    text = []
+    expected = []
+
+    handle = open('perftsuite.esp', 'r')
+    for fen, operations in moggio.epd.read_epd(handle):
+        state = moggio.state.State(fen)
+        tokens = []
+        for i in xrange(random_moves):
+            moves = moggio.move.generate_legal_moves(state, [])
+            if not moves:
+                break
+
+            for move in moves:
+                tests += 1
+                san = moggio.pgn.move_to_san(state, move)
+                try:
+                    resolved = moggio.pgn.san_to_move(state, san)
+                except ValueError, e:
+                    resolved = e
+                if resolved != move:
+                    errors += 1
+                    print "%s (%s) was read as %r in:\n%s" % (san, moggio.move.move_uci(move), resolved, state)
+
+            move = rng.choice(moves)
+            if state.turn == defs.WHITE:
+                tokens.append('%d.' % state.fullmove_number)
+            elif not tokens:
+                tokens.append('%d...' % state.fullmove_number)
+            tokens.append(moggio.pgn.move_to_san(state, move))
+            if not i % 7:
+                tokens.append('{ a comment; (not a variation }')
+            if not i % 11:
+                # Replaying fails if the variation isn't skipped, since it repeats the move.
+                tokens.append('$%d ( %s { nested } ( %s ) )' % (i, tokens[-1], tokens[-1]))
+            state.make_move(move)
+
+        expected.append(state.hash)
+        lines = ['[Event "check_pgn"]', '[SetUp "1"]', '[FEN "%s"]' % fen, '']
+        for j in xrange(0, len(tokens), 6):
+            lines.append(' '.join(tokens[j:j + 6]))
+        lines[-1] += ' *'
+        text.append('\n'.join(lines) + '\n\n')
     handle.close()
-    total_time = time.time() - start_time
 
-    print "\nFailed tests: %d/%d" % (errors, lineno)
-    print "%d nodes in %.2f seconds with nps=%d" % (total_nodes, total_time, total_nodes / total_time)
+    games = list(moggio.pgn.read_games(StringIO.StringIO(''.join(text))))
+    if len(games) != len(expected):
+        errors += 1
+        print "Read %d games instead of %d" % (len(games), len(expected))
+    for game, hash in zip(games, expected):
+        tests += 1
+        try:
+            state = moggio.state.State()
+            for state, move in moggio.pgn.replay(game, state):
+                pass
+            if state.hash != hash:
+                errors += 1
+                print "Replaying %s ended in another position" % game.fen()
+        except ValueError, e:
+            errors += 1
+            print "Replaying %s failed: %s" % (game.fen(), e)
+
+    for text in _zero_castling:
+        tests += 1
+        hashes = []
+        for game_text in (text, text.replace('0', 'O')):
+            try:
+                state = moggio.state.State()
+                for game in moggio.pgn.read_games(StringIO.StringIO(game_text)):
+                    for state, move in moggio.pgn.replay(game, state):
+                        pass
+                hashes.append(state.hash)
+            except ValueError, e:
+                hashes.append(e)
+        if hashes[0] != hashes[1]:
+            errors += 1
+            print "Replaying %s failed: %s" % (text, hashes[0])
+
+    for fen, san in _illegal_san:
+        tests += 1
+        try:
+            moggio.pgn.san_to_move(moggio.state.State(fen), san)
+        except ValueError:
+            continue
+        errors += 1
+        print "Illegal move %s was accepted in %s" % (san, fen)
+
+    print "PGN round trip failures: %d/%d" % (errors, tests)
+    return errors
+
+def _suite_states():
+    """Returns a State for every position in the perft suite."""
+    handle = open('perftsuite.esp', 'r')
+    states = [state for state, operations in moggio.epd.read_positions(handle)]
+    handle.close()
+    return states
+
+# The square index-keyed move tables of moggio.cache that table_benchmark replaces.
+_idx_tables = ('attacks_pawn_idx', 'moves_pawn_one_idx', 'moves_pawn_two_idx', 'attacked_by_pawn_idx',
+               'moves_knight_idx', 'moves_king_idx', 'castling_availability_idx',
+               'magic_bishop_idx', 'magic_rook_idx')
+
+def _as_dicts(table):
+    """Returns a square index-keyed list (or a tuple of them) as dictionaries."""
+    if isinstance(table, tuple):
+        return tuple(_as_dicts(sub_table) for sub_table in table)
+    return dict(enumerate(table))
+
+def table_benchmark(max_depth=3):
+    """Runs perftsuite() with the square index-keyed move tables as lists, and as
+       dictionaries, and compares the nps.
+
+       The dictionaries are keyed by square index too, since the generator turns every
+       square into an index once before looking it up. So this compares the table layouts,
+       not the bit scan.
+    """
+    list_errors, list_nodes, list_time = perftsuite(max_depth)
+
+    tables = dict((name, getattr(moggio.cache, name)) for name in _idx_tables)
+    for name, table in tables.items():
+        setattr(moggio.cache, name, _as_dicts(table))
+    try:
+        dict_errors, dict_nodes, dict_time = perftsuite(max_depth)
+    finally:
+        for name, table in tables.items():
+            setattr(moggio.cache, name, table)
+
+    list_nps = list_nodes / list_time
+    dict_nps = dict_nodes / dict_time
+    print "\nlists:        nps=%d failed=%d" % (list_nps, list_errors)
+    print "dictionaries: nps=%d failed=%d" % (dict_nps, dict_errors)
+    print "speedup: %.2fx" % (list_nps / dict_nps)
@@ -0,0 +1,317 @@
+"""The UCI (Universal Chess Interface) protocol, for using moggio from chess GUIs and match runners.
+
+   Commands are read by the main thread, and searches run on a thread of their own, so that
+   stop (and isready) are handled while searching. The search itself stops at time and node
+   limits.
+"""
+
+import sys
+import threading
+import time
+
+import moggio.book
+import moggio.defines as defs
+import moggio.move
+import moggio.search
+import moggio.state
+import moggio.test
+
+NAME = 'moggio'
+AUTHOR = 'Helge Milde'
+
+# Options shown to the GUI.
+HASH_DEFAULT = 16
+HASH_MAX = 1024
+
+# How often (in seconds) info nodes/nps/hashfull is sent while searching.
+PROGRESS_INTERVAL = 1.0
+
+# Time kept in reserve when thinking on the clock, in seconds.
+MOVE_OVERHEAD = 0.05
+# Number of moves the remaining time is divided between when there's no movestogo.
+MOVES_TO_GO = 30
+
+def think_time(time_left, increment=0, moves_to_go=None):
+    """Returns how many seconds to spend on a move, given the time left on the clock."""
+    moves_to_go = moves_to_go or MOVES_TO_GO
+    budget = time_left / moves_to_go + increment * 3 / 4
+    return max(min(budget, time_left / 2) - MOVE_OVERHEAD, 0.01)
+
+def parse_move(state, text):
+    """Returns the packed legal move written as text in UCI notation (like e2e4 or a7a8q), or None."""
+    for move in moggio.move.generate_legal_moves(state, []):
+        if moggio.move.move_uci(move) == text:
+            return move
+    return None
+
+class Engine:
+
+    """Keeps the state of a UCI session and executes commands.
+
+        This class has the variables:
+        state       - The position given by the last position command.
+        search      - The moggio.search.Search that is used for every go command.
+        thread      - The thread of the running search, or None.
+        stop_requested - threading.Event that is set by stop, for searches that mustn't
+                      send bestmove before that (go infinite).
+        best_move   - Best move of the last finished iteration of the running search, or 0.
+        book        - The moggio.book.Book that moves are played from before searching, or None.
+        output      - File that responses are written to.
+    """
+
+    def __init__(self, output=sys.stdout):
+        self.output = output
+        self.lock = threading.Lock()
+        self.state = moggio.state.State(defs.FEN_INIT)
+        self.search = self._new_search(HASH_DEFAULT)
+        self.thread = None
+        self.stop_requested = threading.Event()
+        self.best_move = 0
+        self.book = None
+
+    def _new_search(self, hash_mb):
+        return moggio.search.Search(hash_mb, self._send_info, self._send_progress, PROGRESS_INTERVAL)
+
+    def send(self, line):
+        """Writes a line to the GUI. Can be called from both threads."""
+        with self.lock:
+            self.output.write(line + '\n')
+            self.output.flush()
+
+    def loop(self, input=sys.stdin):
+        """Reads and executes commands until quit or end of input."""
+        while True:
+            line = input.readline()
+            if not line or not self.command(line):
+                break
+        self.stop()
+
+    def command(self, line):
+        """Executes a single command. Returns False when the engine should quit."""
+        tokens = line.split()
+        if not tokens:
+            return True
+
+        name, args = tokens[0], tokens[1:]
+
+        if name == 'quit':
+            return False
+
+        # A malformed command is answered with an info string, instead of taking the engine
+        # (and the GUI's connection to it) down.
+        try:
+            if name == 'uci':
+                self.send('id name %s' % NAME)
+                self.send('id author %s' % AUTHOR)
+                self.send('option name Hash type spin default %d min 1 max %d' % (HASH_DEFAULT, HASH_MAX))
+                self.send('option name BookFile type string default <empty>')
+                self.send('uciok')
+            elif name == 'isready':
+                self.send('readyok')
+            elif name == 'stop':
+                self.stop()
+            elif name == 'ucinewgame':
+                self.stop()
+                self.search.table.clear()
+                self.search.pawn_table.clear()
+            elif name == 'setoption':
+                self.stop()
+                self.set_option(args)
+            elif name == 'position':
+                self.stop()
+                self.set_position(args)
+            elif name == 'go':
+                self.stop()
+                self.go(args)
+            elif name == 'perft':
+                self.stop()
+                self.perft(int(args[0]) if args else 1)
+            else:
+                self.send('info string unknown command %s' % name)
+        except Exception, e:
+            self.send('info string %s failed: %s' % (name, e))
+
+        return True
+
+    def set_option(self, args):
+        """setoption name <name> value <value>"""
+        if 'value' not in args:
+            return
+        name = ' '.join(args[1:args.index('value')]).lower()
+        value = ' '.join(args[args.index('value') + 1:])
+
+        if name == 'hash':
+            self.search = self._new_search(max(1, min(int(value), HASH_MAX)))
+        elif name == 'bookfile':
+            if self.book:
+                self.book.close()
+                self.book = None
+            if value and value != '<empty>':
+                try:
+                    self.book = moggio.book.Book(value)
+                except (IOError, OSError), e:
+                    self.send('info string could not open book %s: %s' % (value, e))
+
+    def set_position(self, args):
+        """position [startpos | fen <fen>] [moves <move> ...]"""
+        if 'moves' in args:
+            moves = args[args.index('moves') + 1:]
+            args = args[:args.index('moves')]
+        else:
+            moves = []
+
+        if args and args[0] == 'fen':
+            fen = ' '.join(args[1:])
+            try:
+                state = moggio.state.State(fen)
+            except Exception, e:
+                # The previous position is kept.
+                self.send('info string invalid fen %s: %s' % (fen, e))
+                return
+        else:
+            state = moggio.state.State(defs.FEN_INIT)
+
+        for text in moves:
+            move = parse_move(state, text)
+            if move is None:
+                self.send('info string illegal move %s' % text)
+                break
+            state.make_move(move)
+
+        self.state = state
+
+    def go(self, args):
+        """go [depth N] [nodes N] [movetime MS] [wtime MS btime MS winc MS binc MS movestogo N] [infinite]
+
+           Plays a move from the book if there is one, and otherwise starts a search on a
+           thread of its own, which sends bestmove when it's done.
+        """
+        if self.book and 'infinite' not in args:
+            move = self.book.choice(self.state)
+            if move:
+                self.send('info string book move')
+                self.send('bestmove %s' % moggio.move.move_uci(move))
+                return
+
+        options = {}
+        for i, arg in enumerate(args):
+            if arg in ('depth', 'nodes', 'movetime', 'wtime', 'btime', 'winc', 'binc', 'movestogo') \
+                and i + 1 < len(args):
+                try:
+                    options[arg] = int(args[i + 1])
+                except ValueError:
+                    # Searching without the limit still answers with a bestmove.
+                    self.send('info string invalid %s %s' % (arg, args[i + 1]))
+
+        max_depth = options.get('depth', defs.MAX_PLY - 1)
+        max_nodes = options.get('nodes')
+        max_time = None
+
+        if 'movetime' in options:
+            max_time = options['movetime'] / 1000.0
+        elif 'infinite' not in args:
+            if self.state.turn == defs.WHITE:
+                time_left, increment = options.get('wtime'), options.get('winc', 0)
+            else:
+                time_left, increment = options.get('btime'), options.get('binc', 0)
+            if time_left is not None:
+                max_time = think_time(time_left / 1000.0, increment / 1000.0, options.get('movestogo'))
+
+        # Played if the search fails before finishing an iteration.
+        moves = moggio.move.generate_legal_moves(self.state, [])
+        fallback = moves[0] if moves else 0
+
+        self.best_move = 0
+        self.stop_requested = threading.Event()
+
+        # The search gets its own copy, so that position can't change it while searching.
+        state = self.state.copy()
+        self.thread = threading.Thread(target=self._search,
+                                       args=(state, max_depth, max_nodes, max_time, 'infinite' in args, fallback))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _search(self, state, max_depth, max_nodes, max_time, infinite, fallback):
+        """Runs a search and sends bestmove, also when the search fails.
+
+           With go infinite, bestmove is held back until stop (or quit), even if the search
+           finishes first.
+        """
+        best_move = 0
+        try:
+            best_move = self.search.search(state, max_depth, max_nodes, max_time)[0]
+        except Exception, e:
+            self.send('info string search failed: %r' % e)
+        finally:
+            if not best_move:
+                best_move = self.best_move or fallback
+            if infinite:
+                self.stop_requested.wait()
+            self.send('bestmove %s' % (moggio.move.move_uci(best_move) if best_move else '0000'))
+
+    def stop(self):
+        """Stops the running search, if any, and waits for it to send bestmove."""
+        thread = self.thread
+        if not thread:
+            return
+
+        self.stop_requested.set()
+        # The search might not have started yet, in which case it would clear the flag.
+        while thread.is_alive():
+            self.search.stop()
+            thread.join(0.01)
+        self.thread = None
+
+    def perft(self, depth):
+        """Sends the node count below every legal move, and the total."""
+        if depth < 1:
+            self.send('info string perft depth must be at least 1')
+            return
+
+        state = self.state.copy()
+        start = time.time()
+        total = 0
+
+        for move in moggio.move.generate_legal_moves(state, []):
+            state.make_move(move)
+            nodes = moggio.test.perft_legal(state, depth - 1, False)
+            state.unmake_move(move)
+
+            self.send('%s: %d' % (moggio.move.move_uci(move), nodes))
+            total += nodes
+
+        time_spent = time.time() - start
+        self.send('')
+        self.send('Nodes searched: %d' % total)
+        self.send('info string time %d nps %d' % (time_spent * 1000, total / max(time_spent, 1e-3)))
+
+    def _send_info(self, search, depth, score, pv):
+        """Sends the result of a finished iteration."""
+        if pv:
+            self.best_move = pv[0]
+        time_spent = time.time() - search.start_time
+
+        if abs(score) > moggio.search.MATE_BOUND:
+            moves_to_mate = (moggio.search.MATE - abs(score) + 1) / 2
+            score_str = 'mate %d' % (moves_to_mate if score > 0 else -moves_to_mate)
+        else:
+            score_str = 'cp %d' % score
+
+        self.send('info depth %d score %s nodes %d nps %d time %d hashfull %d pv %s' % (
+            depth, score_str, search.nodes, search.nodes / max(time_spent, 1e-3),
+            time_spent * 1000, search.table.hashfull(),
+            ' '.join(moggio.move.move_uci(move) for move in pv)))
+
+    def _send_progress(self, search):
+        """Sends the throughput of the running search."""
+        time_spent = time.time() - search.start_time
+        self.send('info nodes %d nps %d time %d hashfull %d' % (
+            search.nodes, search.nodes / max(time_spent, 1e-3),
+            time_spent * 1000, search.table.hashfull()))
+
+def main():
+    """Runs a UCI session on stdin and stdout."""
+    import moggio.cache
+    moggio.cache.preprocess()
+
+    Engine().loop()